@@ -0,0 +1,83 @@
+"""
+Compares the BigQuery cost of the aggregation modes from their job history.
+
+The aggregator labels every job with `aggregation_mode` (per_query or consolidated) and
+`aggregation_script`. This reads INFORMATION_SCHEMA.JOBS for the labelled jobs and reports,
+per mode, the bytes processed, bytes billed and slot time of an average run (all scripts
+started within the same scheduler tick).
+
+Usage: python benchmarks/aggregation_cost.py [--region region-us] [--days 1]
+Run it after the aggregator has spent some time in each mode.
+"""
+import argparse
+import os
+import sys
+
+AGGREGATOR_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_aggregator')
+sys.path.insert(0, AGGREGATOR_DIR)
+os.chdir(AGGREGATOR_DIR)
+
+from google.cloud import bigquery  # noqa: E402
+from google.oauth2 import service_account  # noqa: E402
+from config import creds, scopes  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--region", default="region-us")
+    parser.add_argument("--days", type=int, default=1)
+    args = parser.parse_args()
+
+    bqcreds = service_account.Credentials.from_service_account_file(creds, scopes=scopes)
+    client = bigquery.Client(credentials=bqcreds, project=bqcreds.project_id)
+
+    query = f"""
+    WITH jobs AS (
+      SELECT
+        (SELECT value FROM UNNEST(labels) WHERE key = 'aggregation_mode') AS mode,
+        TIMESTAMP_TRUNC(creation_time, MINUTE) AS run,
+        total_bytes_processed,
+        total_bytes_billed,
+        total_slot_ms
+      FROM `{args.region}`.INFORMATION_SCHEMA.JOBS
+      WHERE creation_time > TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL @days DAY)
+        AND statement_type = 'SCRIPT'
+        AND EXISTS (SELECT 1 FROM UNNEST(labels) WHERE key = 'aggregation_mode')
+    ),
+    runs AS (
+      SELECT
+        mode,
+        run,
+        COUNT(*) AS scripts,
+        SUM(total_bytes_processed) AS bytes_processed,
+        SUM(total_bytes_billed) AS bytes_billed,
+        SUM(total_slot_ms) AS slot_ms
+      FROM jobs
+      GROUP BY mode, run
+    )
+    SELECT
+      mode,
+      COUNT(*) AS runs,
+      AVG(scripts) AS scripts_per_run,
+      AVG(bytes_processed) AS bytes_processed,
+      AVG(bytes_billed) AS bytes_billed,
+      AVG(slot_ms) AS slot_ms
+    FROM runs
+    GROUP BY mode
+    ORDER BY mode
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[bigquery.ScalarQueryParameter("days", "INT64", args.days)])
+    rows = list(client.query(query, job_config=job_config).result())
+    if not rows:
+        print("No labelled aggregation jobs found")
+        return
+
+    print(f"{'mode':<14} {'runs':>6} {'scripts':>8} {'MB processed':>14} {'MB billed':>11} {'slot ms':>10}")
+    for row in rows:
+        print(f"{row['mode']:<14} {row['runs']:>6} {row['scripts_per_run']:>8.1f} "
+              f"{(row['bytes_processed'] or 0) / 1e6:>14.1f} {(row['bytes_billed'] or 0) / 1e6:>11.1f} "
+              f"{row['slot_ms'] or 0:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+"""
+End-to-end benchmark of the ingestion service and the aggregator on the local backend.
+
+Both services run in-process against a fresh SQLite database in a temporary directory, with their
+own config.json switched to the local backend and the metrics cache off. Requests go through the
+FastAPI app over httpx's ASGI transport, so routing, validation, admission and the batch writer are
+all included. It measures:
+- ingest: /ingest-gcp events/s and p50/p99 latency at each --concurrency level,
+- metrics: /get_metrics and /get_metrics_parallel latency for each --range-days width and --pages
+  count (the number of pages the seeded events are spread over),
+- freshness: the time from an accepted event until /get_metrics returns it, with the aggregator's
+  run_all_queries called in a loop, and the duration of those runs.
+
+Results are written as JSON to --output. Pass --baseline with the output of an earlier commit to
+print the relative change of every measurement.
+
+Usage: python benchmarks/end_to_end.py [--events 2000] [--concurrency 1,8,32] [--pages 10,1000]
+       [--range-days 1,7,30] [--output benchmark.json] [--baseline previous.json]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import httpx
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+EVENT_NAMES = ["page_viewed", "page_scroll", "product_added_to_cart", "checkout_completed"]
+
+
+def load_service(service: str, workdir: str, overrides: dict) -> dict:
+    """
+    Import a service's modules with a config.json in `workdir` derived from its own. The services
+    share module names (config, bigquery, ...), so they are removed from sys.modules afterwards and
+    the other service can be loaded next; the returned modules keep their own references.
+    """
+    service_dir = os.path.abspath(os.path.join(ROOT, service))
+    with open(os.path.join(service_dir, 'config.json'), 'r') as f:
+        config = json.load(f)
+    for section, values in overrides.items():
+        config.setdefault(section, {}).update(values)
+    os.makedirs(workdir, exist_ok=True)
+    with open(os.path.join(workdir, 'config.json'), 'w') as f:
+        json.dump(config, f)
+
+    os.chdir(workdir)
+    sys.path.insert(0, service_dir)
+    before = set(sys.modules)
+    try:
+        modules = {name: __import__(name) for name in (['main', 'bigquery'] if service == 'ingestion_and_metrics' else ['bigquery'])}
+    finally:
+        sys.path.remove(service_dir)
+        for name in set(sys.modules) - before:
+            if (getattr(sys.modules[name], '__file__', None) or '').startswith(service_dir):
+                del sys.modules[name]
+    return modules
+
+
+def make_event(page_url: str, event_time: datetime, rng: random.Random) -> dict:
+    event_name = rng.choice(EVENT_NAMES)
+    return {
+        "platform": "web",
+        "event_time": event_time.isoformat(),
+        "event_name": event_name,
+        "event_id": str(uuid.uuid4()),
+        "session_id": f"sess-{rng.randrange(10 ** 6)}",
+        "page_url": page_url,
+        "order_value": round(rng.uniform(5, 200), 2) if event_name == "checkout_completed" else None,
+        "percent_scroll": rng.choice([25, 50, 75, 100]) if event_name in ("page_scroll", "page_viewed") else None,
+    }
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)] if values else 0.0
+
+
+def latency_summary(latencies: list[float]) -> dict:
+    return {
+        "requests": len(latencies),
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "mean_ms": sum(latencies) / len(latencies) * 1000 if latencies else 0.0,
+    }
+
+
+async def wait_for_writer(writer, expected_rows: int, timeout: float = 60) -> None:
+    deadline = time.perf_counter() + timeout
+    while writer.rows_written + writer.rows_failed < expected_rows:
+        if time.perf_counter() > deadline:
+            raise RuntimeError(f"Writer flushed {writer.rows_written} of {expected_rows} rows")
+        await asyncio.sleep(0.05)
+
+
+async def bench_ingest(http: httpx.AsyncClient, writer, events: int, concurrency: int, rng: random.Random) -> dict:
+    now = datetime.now(timezone.utc)
+    payloads = [json.dumps(make_event(f"https://ingest.example/{i % 100}", now, rng)) for i in range(events)]
+    latencies, failures = [], 0
+    flushed = writer.rows_written + writer.rows_failed
+
+    async def worker(offset: int):
+        nonlocal failures
+        for payload in payloads[offset::concurrency]:
+            started = time.perf_counter()
+            response = await http.post("/ingest-gcp", content=payload, headers={"content-type": "application/json"})
+            latencies.append(time.perf_counter() - started)
+            failures += response.status_code != 202
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(offset) for offset in range(concurrency)))
+    accepted = time.perf_counter() - started
+    await wait_for_writer(writer, flushed + events - failures)
+    written = time.perf_counter() - started
+    return {
+        "concurrency": concurrency,
+        "events": events,
+        "failures": failures,
+        "events_per_s": events / accepted,
+        "written_events_per_s": events / written,
+        **latency_summary(latencies),
+    }
+
+
+async def bench_metrics(http: httpx.AsyncClient, pages: int, range_days: list[int], requests: int, rng: random.Random) -> list[dict]:
+    today = datetime.now(timezone.utc).date()
+    results = []
+    for days in range_days:
+        for endpoint in ("/get_metrics", "/get_metrics_parallel"):
+            latencies, not_found, failures = [], 0, 0
+            for _ in range(requests):
+                body = {
+                    "page_url": f"https://pages-{pages}.example/{rng.randrange(pages)}",
+                    "start_date": (today - timedelta(days=days - 1)).isoformat(),
+                    "end_date": today.isoformat(),
+                }
+                started = time.perf_counter()
+                response = await http.post(endpoint, json=body)
+                latencies.append(time.perf_counter() - started)
+                # Pages without events in the range are a 404, still a full query
+                not_found += response.status_code == 404
+                failures += response.status_code not in (200, 404)
+            results.append({"endpoint": endpoint, "pages": pages, "range_days": days, "not_found": not_found,
+                            "failures": failures, **latency_summary(latencies)})
+    return results
+
+
+async def bench_freshness(http: httpx.AsyncClient, aggregator, samples: int, rng: random.Random) -> dict:
+    lags, runs = [], []
+    for sample in range(samples):
+        page_url = f"https://fresh.example/{uuid.uuid4()}"
+        now = datetime.now(timezone.utc)
+        response = await http.post("/ingest-gcp", json=make_event(page_url, now, rng))
+        accepted = time.perf_counter()
+        if response.status_code != 202:
+            raise RuntimeError(f"Freshness event rejected with {response.status_code}")
+        body = {"page_url": page_url, "start_date": now.date().isoformat(), "end_date": now.date().isoformat()}
+        while True:
+            started = time.perf_counter()
+            await aggregator.run_all_queries()
+            runs.append(time.perf_counter() - started)
+            if (await http.post("/get_metrics", json=body)).status_code == 200:
+                lags.append(time.perf_counter() - accepted)
+                break
+            if time.perf_counter() - accepted > 60:
+                raise RuntimeError("Freshness event not visible after 60s")
+            await asyncio.sleep(0.05)
+    return {
+        "samples": samples,
+        "p50_s": percentile(lags, 0.5),
+        "max_s": max(lags),
+        "aggregation_runs": len(runs),
+        "aggregation_run_p50_s": percentile(runs, 0.5),
+        "aggregation_run_max_s": max(runs),
+    }
+
+
+def flatten(results: dict) -> dict[str, float]:
+    """
+    Measurements keyed by what was measured, to compare two result files.
+    """
+    flat = {}
+    for row in results.get("ingest", []):
+        for key in ("events_per_s", "written_events_per_s", "p50_ms", "p99_ms"):
+            flat[f"ingest c={row['concurrency']} {key}"] = row[key]
+    for row in results.get("metrics", []):
+        for key in ("p50_ms", "p99_ms"):
+            flat[f"{row['endpoint']} pages={row['pages']} days={row['range_days']} {key}"] = row[key]
+    for key, value in results.get("freshness", {}).items():
+        if key.endswith("_s"):
+            flat[f"freshness {key}"] = value
+    return flat
+
+
+def compare(results: dict, baseline: dict) -> None:
+    current, previous = flatten(results), flatten(baseline)
+    print(f"\nChange against {baseline.get('commit') or 'baseline'}:")
+    for key, value in current.items():
+        if previous.get(key):
+            print(f"  {key:<60} {previous[key]:>12.3f} -> {value:>12.3f} ({(value / previous[key] - 1) * 100:+.1f}%)")
+
+
+async def run(args) -> dict:
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix="analytics-bench-")
+    backend = {"type": "local", "database": os.path.join(workdir, "analytics.db")}
+    ingestion = load_service('ingestion_and_metrics', os.path.join(workdir, 'ingestion_and_metrics'), {
+        "backend": backend,
+        "spool": {"enabled": False},
+        "metrics_cache": {"enabled": False},
+        # Let every request through: the benchmark measures capacity, not shedding
+        "admission": {"enabled": False},
+    })
+    aggregator = load_service('data_aggregator', os.path.join(workdir, 'data_aggregator'), {
+        "backend": {**backend, "base_files": []},
+    })['bigquery']
+    logging.getLogger().setLevel(logging.WARNING)
+
+    app = ingestion['main'].app
+    writer = ingestion['main'].writer
+    results = {
+        "commit": git_commit(),
+        "started": datetime.now(timezone.utc).isoformat(),
+        "args": vars(args),
+        "workdir": workdir,
+    }
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as http:
+            results["ingest"] = [await bench_ingest(http, writer, args.events, concurrency, rng) for concurrency in args.concurrency]
+            for row in results["ingest"]:
+                print(f"ingest c={row['concurrency']:<4} {row['events_per_s']:>9.0f} events/s accepted, "
+                      f"{row['written_events_per_s']:>9.0f} written, p50 {row['p50_ms']:.2f} ms, p99 {row['p99_ms']:.2f} ms")
+
+            # Seed each page count with the same number of events over the widest range, then aggregate once
+            today = datetime.now(timezone.utc).replace(hour=12, minute=0, second=0, microsecond=0)
+            for pages in args.pages:
+                events = [make_event(f"https://pages-{pages}.example/{rng.randrange(pages)}",
+                                     today - timedelta(days=rng.randrange(max(args.range_days))), rng)
+                          for _ in range(args.seed_events)]
+                ingestion['bigquery'].insert_event_rows(events)
+            started = time.perf_counter()
+            await aggregator.run_all_queries()
+            results["seed_aggregation_s"] = time.perf_counter() - started
+            print(f"aggregated {args.seed_events * len(args.pages)} seeded events in {results['seed_aggregation_s']:.2f}s")
+
+            results["metrics"] = []
+            for pages in args.pages:
+                results["metrics"] += await bench_metrics(http, pages, args.range_days, args.requests, rng)
+            for row in results["metrics"]:
+                print(f"{row['endpoint']:<22} pages={row['pages']:<6} days={row['range_days']:<4} "
+                      f"p50 {row['p50_ms']:.2f} ms, p99 {row['p99_ms']:.2f} ms, {row['failures']} failures")
+
+            results["freshness"] = await bench_freshness(http, aggregator, args.freshness_samples, rng)
+            print(f"freshness p50 {results['freshness']['p50_s']:.2f}s, max {results['freshness']['max_s']:.2f}s, "
+                  f"aggregation run p50 {results['freshness']['aggregation_run_p50_s']:.2f}s")
+    return results
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def int_list(value: str) -> list[int]:
+    return [int(item) for item in value.split(",") if item.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=2000, help="events sent per concurrency level")
+    parser.add_argument("--concurrency", type=int_list, default=[1, 8, 32])
+    parser.add_argument("--pages", type=int_list, default=[10, 1000])
+    parser.add_argument("--range-days", type=int_list, default=[1, 7, 30])
+    parser.add_argument("--seed-events", type=int, default=20000, help="events seeded per page count")
+    parser.add_argument("--requests", type=int, default=100, help="requests per endpoint, page count and range")
+    parser.add_argument("--freshness-samples", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--baseline", help="result file of an earlier run to compare with")
+    args = parser.parse_args()
+    output = os.path.abspath(args.output)
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+
+    results = asyncio.run(run(args))
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+    if baseline:
+        with open(baseline, 'r') as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Microbenchmark for the per-event CPU cost of decoding and preparing an /ingest-gcp payload.
+
+Compares the original path (json.loads -> EventPayload(**body) -> model_dump -> isoformat)
+with the single-pass path used by the service (model_validate_json -> model_dump(mode='json')).
+
+Usage: python benchmarks/parse_event.py [--events N] [--repeat R]
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ingestion_and_metrics'))
+
+from classes import EventPayload  # noqa: E402
+from parsing import event_to_row, parse_event, parse_event_batch  # noqa: E402
+
+SAMPLE_EVENT = {
+    "platform": "web",
+    "event_time": "2024-05-29T12:34:56.789Z",
+    "event_name": "checkout_completed",
+    "event_id": "sh-a637288a-2BFD-449D-055F-051AEC5EECB2",
+    "user_id": "usr_5678",
+    "session_id": "sess-91011",
+    "page_url": "shopify-domain.myshopify.com",
+    "order_id": "ord_121314",
+    "order_value": 99.99,
+    "city": "Bangalore",
+    "country": "IN",
+    "user_agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
+    "language": "en-US",
+    "currency": "INR",
+    "user_email": "user@example.com",
+}
+
+
+def legacy_path(body: bytes) -> dict:
+    event_payload = EventPayload(**json.loads(body))
+    row = event_payload.model_dump()
+    row['event_time'] = row['event_time'].isoformat()
+    return row
+
+
+def fast_path(body: bytes) -> dict:
+    return event_to_row(parse_event(body))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    body = json.dumps(SAMPLE_EVENT).encode()
+    batch_body = json.dumps([SAMPLE_EVENT] * 500).encode()
+
+    def legacy_batch():
+        for item in json.loads(batch_body):
+            event_payload = EventPayload(**item)
+            row = event_payload.model_dump()
+            row['event_time'] = row['event_time'].isoformat()
+
+    def fast_batch():
+        events, _ = parse_event_batch(batch_body)
+        for event_payload in events:
+            event_to_row(event_payload)
+
+    cases = [
+        ("single event, legacy", lambda: legacy_path(body), args.events),
+        ("single event, fast", lambda: fast_path(body), args.events),
+        ("500-event array, legacy", legacy_batch, max(args.events // 500, 1)),
+        ("500-event array, fast", fast_batch, max(args.events // 500, 1)),
+    ]
+    for name, fn, number in cases:
+        best = min(timeit.repeat(fn, number=number, repeat=args.repeat))
+        per_event = best / (number * (500 if "array" in name else 1))
+        print(f"{name:<28} {per_event * 1e6:8.2f} us/event")
+
+
+if __name__ == "__main__":
+    main()
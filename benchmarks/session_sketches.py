@@ -0,0 +1,81 @@
+"""
+Accuracy and speed of HLL session sketches against summed daily distinct counts.
+
+Simulates sessions on one page over a date range, each session active on one or more consecutive
+days and seen across several aggregator runs per day. Compares, for the whole range:
+- exact distinct sessions,
+- the sum of per-run COUNT(DISTINCT session_id), which is what adding batch counts produced,
+- the sum of per-day counts from merged daily sketches (the stored number_of_sessions),
+- the union of the daily sketches (what the metrics endpoints now return).
+
+Uses the pure-Python sketch in common/hll.py, so no BigQuery access is needed.
+
+Usage: python benchmarks/session_sketches.py [--sessions N] [--days D] [--runs-per-day R] [--precision P]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from common import hll  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=200000)
+    parser.add_argument("--days", type=int, default=7)
+    parser.add_argument("--runs-per-day", type=int, default=24)
+    parser.add_argument("--precision", type=int, default=hll.DEFAULT_PRECISION)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    # (day, run) -> session ids seen in that aggregator run
+    batches: dict[tuple[int, int], list[str]] = {}
+    for i in range(args.sessions):
+        session_id = f"sess-{i}"
+        start_day = rng.randrange(args.days)
+        for day in range(start_day, min(start_day + rng.choice([1, 1, 1, 2, 3]), args.days)):
+            for run in rng.sample(range(args.runs_per_day), rng.randint(1, 3)):
+                batches.setdefault((day, run), []).append(session_id)
+
+    exact = args.sessions
+    summed_runs = sum(len(set(ids)) for ids in batches.values())
+
+    started = time.perf_counter()
+    run_sketches = {key: hll.init(ids, args.precision) for key, ids in batches.items()}
+    build_time = time.perf_counter() - started
+    events = sum(len(ids) for ids in batches.values())
+
+    started = time.perf_counter()
+    daily_sketches = [
+        hll.merge_partial(sketch for (day, _), sketch in run_sketches.items() if day == d)
+        for d in range(args.days)
+    ]
+    merge_time = time.perf_counter() - started
+    summed_days = sum(hll.extract(sketch) for sketch in daily_sketches)
+
+    started = time.perf_counter()
+    range_estimate = hll.merge(daily_sketches)
+    range_time = time.perf_counter() - started
+
+    def error(value):
+        return f"{(value - exact) / exact * 100:+7.2f}%"
+
+    print(f"exact distinct sessions         {exact:>10}")
+    print(f"sum of per-run distinct counts  {summed_runs:>10} {error(summed_runs)}")
+    print(f"sum of per-day sketch counts    {summed_days:>10} {error(summed_days)}")
+    print(f"union of daily sketches         {range_estimate:>10} {error(range_estimate)}")
+    print()
+    print(f"sketch size                     {len(daily_sketches[0])} bytes (precision {args.precision})")
+    print(f"build per-run sketches          {build_time / events * 1e6:.2f} us/event")
+    print(f"merge runs into days            {merge_time / len(run_sketches) * 1e3:.2f} ms/sketch")
+    label = f"merge {args.days} days for a range"
+    print(f"{label:<32}{range_time * 1e3:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,4 @@
+"""
+Modules shared by the metrics service and the aggregator. Each service's config.py puts the
+repository root on sys.path, so they are imported as `common.<module>` from either service.
+"""
@@ -0,0 +1,116 @@
+import hashlib
+import math
+from typing import Iterable
+
+DEFAULT_PRECISION = 15  # Same default as BigQuery's HLL_COUNT.INIT
+HASH_BITS = 64
+# Sketches merged per pass in merge_partial
+MERGE_BATCH = 256
+
+
+class HyperLogLog:
+    """
+    HyperLogLog distinct-count sketch with 2**precision one-byte registers.
+
+    Mirrors the HLL_COUNT functions the aggregator uses in BigQuery: `add` builds a sketch like
+    HLL_COUNT.INIT, `merge` combines sketches like HLL_COUNT.MERGE_PARTIAL and `count` estimates the
+    cardinality like HLL_COUNT.EXTRACT. The serialized form is specific to this class and cannot be
+    mixed with BigQuery sketches.
+    """
+
+    def __init__(self, precision: int = DEFAULT_PRECISION, registers: bytes | bytearray | None = None):
+        if not 4 <= precision <= 18:
+            raise ValueError("precision must be between 4 and 18")
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(registers) if registers is not None else bytearray(self.size)
+        if len(self.registers) != self.size:
+            raise ValueError("register count does not match the precision")
+
+    def add(self, value: str | bytes | None) -> None:
+        if value is None:
+            return
+        if isinstance(value, str):
+            value = value.encode()
+        x = int.from_bytes(hashlib.blake2b(value, digest_size=8).digest(), 'little')
+        index = x >> (HASH_BITS - self.precision)
+        # Position of the leftmost 1 bit in the remaining bits
+        remaining = x & ((1 << (HASH_BITS - self.precision)) - 1)
+        rank = HASH_BITS - self.precision - remaining.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, values: Iterable[str | bytes | None]) -> "HyperLogLog":
+        for value in values:
+            self.add(value)
+        return self
+
+    def merge(self, other: "HyperLogLog") -> "HyperLogLog":
+        """
+        Fold `other` into this sketch in place.
+        """
+        if other.precision != self.precision:
+            raise ValueError("cannot merge sketches of different precision")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self) -> int:
+        m = self.size
+        alpha = 0.7213 / (1 + 1.079 / m)
+        # Registers only take a few dozen distinct ranks, so count each rank instead of visiting every register
+        histogram = [self.registers.count(rank) for rank in range(HASH_BITS - self.precision + 2)]
+        estimate = alpha * m * m / sum(n * 2.0 ** -rank for rank, n in enumerate(histogram) if n)
+        if estimate <= 2.5 * m:
+            # Small range correction: linear counting while registers are still empty
+            zeros = histogram[0]
+            if zeros:
+                estimate = m * math.log(m / zeros)
+        return round(estimate)
+
+    def __len__(self) -> int:
+        return self.count()
+
+    def to_bytes(self) -> bytes:
+        return bytes([self.precision]) + bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "HyperLogLog":
+        return cls(precision=data[0], registers=data[1:])
+
+
+def init(values: Iterable[str | bytes | None], precision: int = DEFAULT_PRECISION) -> bytes:
+    """
+    Serialized sketch of `values` (HLL_COUNT.INIT).
+    """
+    return HyperLogLog(precision).update(values).to_bytes()
+
+
+def merge_partial(sketches: Iterable[bytes | None]) -> bytes | None:
+    """
+    Union of serialized sketches, ignoring NULLs (HLL_COUNT.MERGE_PARTIAL).
+    """
+    sketches = [sketch for sketch in sketches if sketch is not None]
+    if not sketches:
+        return None
+    precision = sketches[0][0]
+    if any(sketch[0] != precision for sketch in sketches):
+        raise ValueError("cannot merge sketches of different precision")
+    # Take the register-wise max of many sketches per pass, which is much faster than merging pairwise
+    registers = sketches[0][1:]
+    for start in range(1, len(sketches), MERGE_BATCH):
+        registers = bytes(map(max, registers, *(sketch[1:] for sketch in sketches[start:start + MERGE_BATCH])))
+    return bytes([precision]) + registers
+
+
+def extract(sketch: bytes | None) -> int:
+    """
+    Cardinality estimate of a serialized sketch (HLL_COUNT.EXTRACT).
+    """
+    return HyperLogLog.from_bytes(sketch).count() if sketch is not None else 0
+
+
+def merge(sketches: Iterable[bytes | None]) -> int:
+    """
+    Cardinality of the union of serialized sketches (HLL_COUNT.MERGE).
+    """
+    return extract(merge_partial(sketches))
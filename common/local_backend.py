@@ -0,0 +1,144 @@
+"""
+SQLite counterparts of the BigQuery features used by both services' local backends: the base table,
+BigQuery SQL translation, timestamps, and the COUNTIF and HLL_COUNT functions over hll.py sketches.
+"""
+import os
+import re
+import sqlite3
+from datetime import date, datetime, timezone
+from common import hll
+
+# Timestamps are stored as UTC text in this format so they compare correctly and work with date()
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# `_ingested_at` stands in for the base table's partition modification time
+BASE_TABLE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS "{table}" (
+    platform TEXT, event_time TEXT NOT NULL, event_name TEXT NOT NULL, event_id TEXT NOT NULL,
+    user_id TEXT, session_id TEXT, page_url TEXT, order_id TEXT, order_value REAL, city TEXT,
+    country TEXT, user_agent TEXT, language TEXT, currency TEXT, user_email TEXT,
+    percent_scroll REAL, product_id TEXT, product_price REAL, page_title TEXT,
+    _ingested_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now'))
+);
+CREATE INDEX IF NOT EXISTS "{table}_event_time" ON "{table}" (event_time);
+CREATE INDEX IF NOT EXISTS "{table}_ingested_at" ON "{table}" (_ingested_at);
+CREATE TABLE IF NOT EXISTS metadata_table (query_name TEXT PRIMARY KEY, last_event_time TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS _table_versions (table_name TEXT PRIMARY KEY, modified TEXT NOT NULL);
+"""
+
+BASE_COLUMNS = [
+    "platform", "event_time", "event_name", "event_id", "user_id", "session_id", "page_url", "order_id",
+    "order_value", "city", "country", "user_agent", "language", "currency", "user_email", "percent_scroll",
+    "product_id", "product_price", "page_title",
+]
+
+# BigQuery syntax rewritten for SQLite; everything else used by the queries is either shared
+# syntax or registered as a function in `connect`
+TRANSLATIONS = [
+    (re.compile(r"`(?:[\w-]+\.)*([\w-]+)`"), r'"\1"'),
+    (re.compile(r"IN\s+UNNEST\(@(\w+)\)", re.I), r"IN (SELECT value FROM json_each(:\1))"),
+    (re.compile(r"@(\w+)"), r":\1"),
+    (re.compile(r"HLL_COUNT\.MERGE_PARTIAL\(", re.I), "hll_merge_partial("),
+    (re.compile(r"HLL_COUNT\.MERGE\(", re.I), "hll_merge("),
+    (re.compile(r"HLL_COUNT\.INIT\(", re.I), "hll_init("),
+    (re.compile(r"HLL_COUNT\.EXTRACT\(", re.I), "hll_extract("),
+    (re.compile(r"DATE_TRUNC\((\w+), ISOWEEK\)", re.I), r"date(\1, 'weekday 0', '-6 days')"),
+    (re.compile(r"\bIF\(", re.I), "iif("),
+    (re.compile(r"\bLEAST\(", re.I), "min("),
+    (re.compile(r"\bGREATEST\(", re.I), "max("),
+    (re.compile(r"\bFLOAT64\b", re.I), "REAL"),
+    (re.compile(r"\bINT64\b", re.I), "INTEGER"),
+]
+
+
+def translate(query: str) -> str:
+    """
+    Rewrite a BigQuery standard SQL query into SQLite. Covers the syntax the metrics and aggregation
+    queries use, not BigQuery SQL in general.
+    """
+    for pattern, replacement in TRANSLATIONS:
+        query = pattern.sub(replacement, query)
+    return query
+
+
+def to_timestamp(value) -> str | None:
+    """
+    Normalize a timestamp (datetime or ISO string, naive meaning UTC) to the stored text form.
+    """
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace(' UTC', '').replace('Z', '+00:00'))
+    if isinstance(value, date) and not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.strftime(TIMESTAMP_FORMAT)
+
+
+def from_timestamp(value: str | None) -> datetime | None:
+    return datetime.strptime(value, TIMESTAMP_FORMAT).replace(tzinfo=timezone.utc) if value else None
+
+
+class _CountIf:
+    def __init__(self):
+        self.count = 0
+
+    def step(self, condition):
+        if condition:
+            self.count += 1
+
+    def finalize(self):
+        return self.count
+
+
+class _HllInit:
+    def __init__(self):
+        self.sketch = hll.HyperLogLog()
+        self.empty = True
+
+    def step(self, value):
+        if value is not None:
+            self.sketch.add(value)
+            self.empty = False
+
+    def finalize(self):
+        return None if self.empty else self.sketch.to_bytes()
+
+
+class _HllMergePartial:
+    def __init__(self):
+        self.sketches = []
+
+    def step(self, sketch):
+        self.sketches.append(sketch)
+
+    def finalize(self):
+        return hll.merge_partial(self.sketches)
+
+
+class _HllMerge(_HllMergePartial):
+    def finalize(self):
+        return hll.merge(self.sketches)
+
+
+def connect(database: str) -> sqlite3.Connection:
+    """
+    Open the local database with the BigQuery functions the translated queries rely on.
+    """
+    directory = os.path.dirname(os.path.abspath(database))
+    os.makedirs(directory, exist_ok=True)
+    connection = sqlite3.connect(database, timeout=30, check_same_thread=False)
+    connection.row_factory = sqlite3.Row
+    # WAL lets the aggregator write while the metrics service reads
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.create_aggregate("COUNTIF", 1, _CountIf)
+    connection.create_aggregate("hll_init", 1, _HllInit)
+    connection.create_aggregate("hll_merge_partial", 1, _HllMergePartial)
+    connection.create_aggregate("hll_merge", 1, _HllMerge)
+    connection.create_function("hll_extract", 1, hll.extract, deterministic=True)
+    connection.create_function("hll_union", 2, lambda a, b: hll.merge_partial([a, b]), deterministic=True)
+    connection.create_function("STARTS_WITH", 2, lambda value, prefix: None if value is None or prefix is None else value.startswith(prefix), deterministic=True)
+    connection.create_function("TIMESTAMP", 1, to_timestamp, deterministic=True)
+    return connection
@@ -0,0 +1,420 @@
+import glob
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
+from common.local_backend import EPOCH, BASE_TABLE_SCHEMA, BASE_COLUMNS, translate, to_timestamp, from_timestamp, connect
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+COLUMN_TYPES = {"INT64": "INTEGER", "FLOAT64": "REAL", "BYTES": "BLOB", "STRING": "TEXT"}
+
+# Upsert counterparts of queries.SESSIONS_MERGES: unqualified columns are the stored row
+LOCAL_MERGES = {
+    "number_of_sessions": "iif(sessions_sketch IS NULL, number_of_sessions + excluded.number_of_sessions, "
+                          "hll_extract(hll_union(sessions_sketch, excluded.sessions_sketch)))",
+    "sessions_sketch": "iif(sessions_sketch IS NULL, NULL, hll_union(sessions_sketch, excluded.sessions_sketch))",
+}
+
+
+# SQLite counterparts of the DATE_TRUNC periods of queries.ROLLUP_TARGETS
+LOCAL_PERIODS = {
+    "ISOWEEK": "date({date}, 'weekday 0', '-6 days')",
+    "MONTH": "date({date}, 'start of month')",
+}
+
+
+def read_events(path: str, offset: int) -> tuple[list[dict], int]:
+    """
+    Events appended to an NDJSON file since `offset`, and the offset after its last complete line.
+    Parquet files are read whole, once (offset 1 marks them done); they need pyarrow.
+    """
+    if path.endswith('.parquet'):
+        if offset:
+            return [], offset
+        import pyarrow.parquet as pq
+        return pq.read_table(path).to_pylist(), 1
+    if os.path.getsize(path) < offset:
+        # Truncated or rotated, start over
+        offset = 0
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read()
+    end = data.rfind(b'\n') + 1
+    return [json.loads(line) for line in data[:end].splitlines() if line.strip()], offset + end
+
+
+class LocalAggregator:
+    """
+    Runs the equivalents of the aggregation scripts against the local SQLite database.
+
+    Events come from the metrics service running on the local backend and from `base_files`, NDJSON
+    or Parquet files (globs allowed) imported incrementally before every run. The target tables and
+    watermarks are the ones of CONSOLIDATED_TARGETS, with SQLite upserts in place of MERGE, so each
+    table ends up with the same rows as with the BigQuery scripts. Late events are detected from the
+    base table's `_ingested_at` instead of partition modification times, and the dates written in
+    each target are recorded in `_partition_versions` for the rollups of `rollup_source_table_id`.
+    The dimension `cube` (queries.build_cube_target) is aggregated with one GROUP BY per grouping set.
+    """
+
+    def __init__(self, database: str, base_table_id: str, base_files: list[str], targets: list[dict],
+                 rollup_source_table_id: str | None = None, rollups: list[dict] | None = None, cube: dict | None = None):
+        self.database = os.path.abspath(database)
+        self.base_table = base_table_id.split('.')[-1]
+        self.base_files = base_files
+        self.targets = targets
+        self.rollup_source = rollup_source_table_id.split('.')[-1] if rollup_source_table_id else None
+        self.rollups = rollups or []
+        self.cube = cube
+        self.connection = connect(self.database)
+        # Transactions are opened explicitly, see _transaction
+        self.connection.isolation_level = None
+        self._lock = threading.Lock()
+        self.connection.executescript(
+            BASE_TABLE_SCHEMA.format(table=self.base_table)
+            + "CREATE TABLE IF NOT EXISTS _imported_files (path TEXT PRIMARY KEY, offset INTEGER NOT NULL);"
+            + "CREATE TABLE IF NOT EXISTS _partition_versions (table_name TEXT, event_date TEXT, modified TEXT NOT NULL, "
+              "PRIMARY KEY (table_name, event_date));")
+        self.create_tables(targets + ([cube] if cube else []))
+        self.create_rollup_tables(self.rollups)
+
+    @contextmanager
+    def _transaction(self):
+        # IMMEDIATE takes the write lock up front, so inserts from the metrics service wait for the run
+        with self._lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.connection
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    def create_tables(self, targets: list[dict]) -> None:
+        for target in targets:
+            if 'dimensions' in target:
+                self.create_cube_table(target)
+                continue
+            table = target['table_id'].split('.')[-1]
+            schema = "".join(f", {column} {COLUMN_TYPES[column_type]}" for column, (column_type, _) in target['columns'].items())
+            self.connection.execute(
+                f'CREATE TABLE IF NOT EXISTS "{table}" (page_url TEXT, event_date TEXT{schema}, PRIMARY KEY (page_url, event_date))')
+            existing = {row['name'] for row in self.connection.execute(f'PRAGMA table_info("{table}")')}
+            for column in target.get('added_columns', []):
+                if column not in existing:
+                    self.connection.execute(f'ALTER TABLE "{table}" ADD COLUMN {column} {COLUMN_TYPES[target["columns"][column][0]]}')
+
+    def create_cube_table(self, cube: dict) -> None:
+        table = cube['table_id'].split('.')[-1]
+        dimensions = "".join(f", {dimension} TEXT" for dimension in cube['dimensions'])
+        schema = "".join(f", {column} {COLUMN_TYPES[column_type]}" for column, (column_type, _) in cube['columns'].items())
+        self.connection.execute(f'CREATE TABLE IF NOT EXISTS "{table}" (page_url TEXT, event_date TEXT, grouping_set TEXT{dimensions}{schema})')
+        existing = {row['name'] for row in self.connection.execute(f'PRAGMA table_info("{table}")')}
+        for dimension in cube['dimensions']:
+            if dimension not in existing:
+                self.connection.execute(f'ALTER TABLE "{table}" ADD COLUMN {dimension} TEXT')
+        # The upsert key; dimensions outside a row's grouping set are NULL, which a primary key would not match
+        index = f'CREATE UNIQUE INDEX "{table}_key" ON "{table}" ({self._cube_key(cube)})'
+        current = self.connection.execute("SELECT sql FROM sqlite_master WHERE type = 'index' AND name = ?", (f"{table}_key",)).fetchone()
+        if current is None or current['sql'] != index:
+            self.connection.execute(f'DROP INDEX IF EXISTS "{table}_key"')
+            self.connection.execute(index)
+
+    def create_rollup_tables(self, rollups: list[dict]) -> None:
+        for rollup in rollups:
+            table = rollup['table_id'].split('.')[-1]
+            schema = "".join(f", {column} {COLUMN_TYPES[column_type]}" for column, (column_type, _) in rollup['columns'].items())
+            self.connection.execute(
+                f'CREATE TABLE IF NOT EXISTS "{table}" (page_url TEXT, period_start TEXT{schema}, PRIMARY KEY (page_url, period_start))')
+
+    def import_files(self) -> int:
+        imported = 0
+        with self._transaction() as connection:
+            for pattern in self.base_files:
+                for path in sorted(glob.glob(pattern)):
+                    row = connection.execute("SELECT offset FROM _imported_files WHERE path = ?", (path,)).fetchone()
+                    events, offset = read_events(path, row['offset'] if row else 0)
+                    connection.executemany(
+                        f'INSERT INTO "{self.base_table}" ({", ".join(BASE_COLUMNS)}) VALUES ({", ".join("?" for _ in BASE_COLUMNS)})',
+                        [tuple(to_timestamp(event.get(column)) if column == 'event_time' else event.get(column) for column in BASE_COLUMNS)
+                         for event in events])
+                    connection.execute(
+                        "INSERT INTO _imported_files (path, offset) VALUES (?, ?) ON CONFLICT (path) DO UPDATE SET offset = excluded.offset",
+                        (path, offset))
+                    imported += len(events)
+        if imported:
+            logger.info(f"Imported {imported} events from the base files")
+        return imported
+
+    def _watermarks(self) -> dict[str, str]:
+        return {row['query_name']: row['last_event_time'] for row in self.connection.execute("SELECT * FROM metadata_table")}
+
+    def _since(self, targets: list[dict], watermarks: dict[str, str]) -> dict[str, str]:
+        epoch = to_timestamp(EPOCH)
+        return {f"since_{i}": watermarks.get(target['query_name'], epoch) for i, target in enumerate(targets)}
+
+    def _aggregate(self, targets: list[dict], window: str, where: str, parameters: dict) -> list[sqlite3.Row]:
+        # Same per-target conditional aggregates as queries._aggregate_sql; `window` has an {i} placeholder
+        aggregates = []
+        for i, target in enumerate(targets):
+            target_window = window.format(i=i)
+            aggregates.append(f"COUNTIF(({target['rows']}) AND {target_window}) AS t{i}_events")
+            for column, (_, expression) in target['columns'].items():
+                aggregates.append(f"{expression.format(window=target_window)} AS t{i}_{column}")
+        query = f"""
+        SELECT page_url, date(event_time) AS event_date, {", ".join(aggregates)}, MAX(event_time) AS max_event_time
+        FROM "{self.base_table}"
+        WHERE {where}
+        GROUP BY page_url, event_date
+        """
+        return self.connection.execute(translate(query), parameters).fetchall()
+
+    @staticmethod
+    def _cube_key(cube: dict) -> str:
+        return "page_url, event_date, grouping_set, " + ", ".join(f"coalesce({dimension}, '')" for dimension in cube['dimensions'])
+
+    def _aggregate_cube(self, cube: dict, where: str, parameters: dict) -> list[tuple]:
+        # The cube rows of queries._scan_sql, with a UNION ALL of one GROUP BY per grouping set, as rows of the cube table
+        aggregates = ", ".join(f"{expression.format(window='TRUE')} AS {column}" for column, (_, expression) in cube['columns'].items())
+        selects = []
+        for grouping_set in cube['grouping_sets']:
+            values = ", ".join(f"coalesce({expression}, 'unknown') AS {dimension}" if dimension in grouping_set else f"NULL AS {dimension}"
+                               for dimension, expression in cube['dimensions'].items())
+            groups = ", ".join(f"coalesce({cube['dimensions'][dimension]}, 'unknown')" for dimension in grouping_set)
+            selects.append(f"""
+            SELECT page_url, date(event_time) AS event_date, '{",".join(grouping_set)}' AS grouping_set, {values}, {aggregates},
+              MAX(event_time) AS max_event_time
+            FROM "{self.base_table}"
+            WHERE {where}
+            GROUP BY page_url, event_date, {groups}""")
+        return [tuple(row) for row in self.connection.execute(translate(" UNION ALL ".join(selects)), parameters)]
+
+    def _touch(self, tables: list[str]) -> None:
+        # Version of each table, read by the metrics service to invalidate its cache
+        modified = to_timestamp(datetime.now(timezone.utc))
+        self.connection.executemany(
+            "INSERT INTO _table_versions (table_name, modified) VALUES (?, ?) ON CONFLICT (table_name) DO UPDATE SET modified = excluded.modified",
+            [(table, modified) for table in tables])
+
+    def _touch_partitions(self, table: str, dates) -> None:
+        # Modification time of each event_date, standing in for INFORMATION_SCHEMA.PARTITIONS
+        modified = to_timestamp(datetime.now(timezone.utc))
+        self.connection.executemany(
+            "INSERT INTO _partition_versions (table_name, event_date, modified) VALUES (?, ?, ?) "
+            "ON CONFLICT (table_name, event_date) DO UPDATE SET modified = excluded.modified",
+            [(table, event_date, modified) for event_date in dates])
+
+    def run_incremental(self, targets: list[dict]) -> int:
+        """
+        Merge the events past each target's watermark into its table, from one scan starting at the
+        oldest watermark (build_consolidated_query). Returns the rows merged.
+        """
+        merged = 0
+        with self._transaction() as connection:
+            parameters = self._since(targets, self._watermarks())
+            parameters['since_min'] = min(parameters.values())
+            rows = self._aggregate(targets, "event_time > :since_{i}", "event_time > :since_min", parameters)
+            if not rows:
+                return 0
+            new_max_event_time = max(row['max_event_time'] for row in rows)
+            for i, target in enumerate(targets):
+                columns = list(target['columns'])
+                updates = ", ".join(f"{column} = {LOCAL_MERGES[column] if column in target.get('merges', {}) else f'{column} + excluded.{column}'}"
+                                    for column in columns)
+                values = [(row['page_url'], row['event_date'], *(row[f't{i}_{column}'] for column in columns))
+                          for row in rows if row[f't{i}_events']]
+                table = target["table_id"].split(".")[-1]
+                connection.executemany(
+                    f'INSERT INTO "{table}" (page_url, event_date, {", ".join(columns)}) '
+                    f'VALUES (?, ?, {", ".join("?" for _ in columns)}) '
+                    f'ON CONFLICT (page_url, event_date) DO UPDATE SET {updates}', values)
+                self._touch_partitions(table, {value[1] for value in values})
+                merged += len(values)
+            connection.executemany(
+                "INSERT INTO metadata_table (query_name, last_event_time) VALUES (?, ?) "
+                "ON CONFLICT (query_name) DO UPDATE SET last_event_time = max(last_event_time, excluded.last_event_time)",
+                [(target['query_name'], new_max_event_time) for target in targets])
+            self._touch([target['table_id'].split('.')[-1] for target in targets] + ['metadata_table'])
+        return merged
+
+    def run_cube(self, cube: dict) -> int:
+        """
+        Merge the events past the cube's watermark into it (build_cube_query). Returns the rows merged.
+        """
+        table = cube['table_id'].split('.')[-1]
+        with self._transaction() as connection:
+            since = self._watermarks().get(cube['query_name'], to_timestamp(EPOCH))
+            rows = self._aggregate_cube(cube, "event_time > :since", {'since': since})
+            if not rows:
+                return 0
+            columns = ['page_url', 'event_date', 'grouping_set', *cube['dimensions'], *cube['columns']]
+            updates = ", ".join(f"{column} = {LOCAL_MERGES[column] if column in cube.get('merges', {}) else f'{column} + excluded.{column}'}"
+                                for column in cube['columns'])
+            connection.executemany(
+                f'INSERT INTO "{table}" ({", ".join(columns)}) VALUES ({", ".join("?" for _ in columns)}) '
+                f'ON CONFLICT ({self._cube_key(cube)}) DO UPDATE SET {updates}', [row[:-1] for row in rows])
+            self._touch_partitions(table, {row[1] for row in rows})
+            connection.execute(
+                "INSERT INTO metadata_table (query_name, last_event_time) VALUES (?, ?) "
+                "ON CONFLICT (query_name) DO UPDATE SET last_event_time = max(last_event_time, excluded.last_event_time)",
+                (cube['query_name'], max(row[-1] for row in rows)))
+            self._touch([table, 'metadata_table'])
+        return len(rows)
+
+    def overwrite_dates(self, targets: list[dict], dates: list[str], watermarks: dict[str, str]) -> int:
+        """
+        Rebuild `dates` in every target from the events up to the target's watermark (_recompute_sql
+        and _swap_sql). Call it inside a transaction; returns the rows written.
+        """
+        cubes = [target for target in targets if 'dimensions' in target]
+        targets = [target for target in targets if 'dimensions' not in target]
+        parameters = self._since(targets, watermarks)
+        parameters['dates'] = json.dumps(dates)
+        in_dates = "IN (SELECT value FROM json_each(:dates))"
+        rows = self._aggregate(targets, "event_time <= :since_{i}", f"date(event_time) {in_dates}", parameters) if targets else []
+        written = 0
+        for cube in cubes:
+            table = cube['table_id'].split('.')[-1]
+            since = watermarks.get(cube['query_name'], to_timestamp(EPOCH))
+            values = self._aggregate_cube(cube, f"date(event_time) {in_dates} AND event_time <= :since",
+                                          {'dates': parameters['dates'], 'since': since})
+            columns = ['page_url', 'event_date', 'grouping_set', *cube['dimensions'], *cube['columns']]
+            self.connection.execute(f'DELETE FROM "{table}" WHERE event_date {in_dates}', {'dates': parameters['dates']})
+            self.connection.executemany(
+                f'INSERT INTO "{table}" ({", ".join(columns)}) VALUES ({", ".join("?" for _ in columns)})', [row[:-1] for row in values])
+            self._touch_partitions(table, dates)
+            written += len(values)
+        for i, target in enumerate(targets):
+            table = target['table_id'].split('.')[-1]
+            columns = list(target['columns'])
+            values = [(row['page_url'], row['event_date'], *(row[f't{i}_{column}'] for column in columns))
+                      for row in rows if row[f't{i}_events']]
+            self.connection.execute(f'DELETE FROM "{table}" WHERE event_date {in_dates}', {'dates': parameters['dates']})
+            self.connection.executemany(
+                f'INSERT INTO "{table}" (page_url, event_date, {", ".join(columns)}) VALUES (?, ?, {", ".join("?" for _ in columns)})', values)
+            self._touch_partitions(table, dates)
+            written += len(values)
+        self._touch([target['table_id'].split('.')[-1] for target in targets + cubes])
+        return written
+
+    def recompute_late(self, targets: list[dict]) -> int:
+        """
+        Rebuild the dates that received events since the last check, up to the newest watermark
+        (build_late_events_query). The first call only records the current time.
+        """
+        with self._transaction() as connection:
+            watermarks = self._watermarks()
+            checked_until = watermarks.get('late_events_query')
+            if checked_until is None:
+                connection.execute("INSERT INTO metadata_table (query_name, last_event_time) "
+                                   "VALUES ('late_events_query', strftime('%Y-%m-%d %H:%M:%f', 'now'))")
+                return 0
+            since = self._since(targets, watermarks)
+            dirty = connection.execute(
+                f'SELECT date(event_time) AS event_date, MAX(_ingested_at) AS ingested_at FROM "{self.base_table}" '
+                "WHERE _ingested_at > ? AND date(event_time) <= date(?) GROUP BY event_date",
+                (checked_until, max(since.values()))).fetchall()
+            if not dirty:
+                return 0
+            written = self.overwrite_dates(targets, [row['event_date'] for row in dirty], watermarks)
+            connection.execute("UPDATE metadata_table SET last_event_time = ? WHERE query_name = 'late_events_query'",
+                               (max(row['ingested_at'] for row in dirty),))
+        return written
+
+    def rebuild_range(self, targets: list[dict], start_date: date, end_date: date) -> int:
+        """
+        Rebuild the event_dates from `start_date` to `end_date` in `targets`, in one transaction
+        (build_backfill_scan_query and build_backfill_swap_query).
+        """
+        dates = [(start_date + timedelta(days=day)).isoformat() for day in range((end_date - start_date).days + 1)]
+        with self._transaction():
+            return self.overwrite_dates(targets, dates, self._watermarks())
+
+    def run_rollups(self, rollups: list[dict]) -> int:
+        """
+        Rebuild the periods of `rollups` containing a date of the source table written since the last
+        call, from its daily rows (build_rollups_query). Returns the rows written.
+        """
+        if self.rollup_source is None:
+            return 0
+        with self._transaction() as connection:
+            checked_until = self._watermarks().get('rollups_query', to_timestamp(EPOCH))
+            dirty = connection.execute(
+                "SELECT event_date, modified FROM _partition_versions WHERE table_name = ? AND modified > ?",
+                (self.rollup_source, checked_until)).fetchall()
+            if not dirty:
+                return 0
+            dates = json.dumps([row['event_date'] for row in dirty])
+            written = 0
+            for rollup in rollups:
+                table = rollup['table_id'].split('.')[-1]
+                columns = list(rollup['columns'])
+                aggregates = ", ".join(f"{expression} AS {column}" for column, (_, expression) in rollup['columns'].items())
+                period = LOCAL_PERIODS[rollup['period']]
+                periods = f"(SELECT DISTINCT {period.format(date='value')} FROM json_each(:dates))"
+                connection.execute(f'DELETE FROM "{table}" WHERE period_start IN {periods}', {'dates': dates})
+                cursor = connection.execute(translate(f"""
+                INSERT INTO "{table}" (page_url, period_start, {", ".join(columns)})
+                SELECT page_url, {period.format(date='event_date')} AS period_start, {aggregates}
+                FROM "{self.rollup_source}"
+                WHERE {period.format(date='event_date')} IN {periods}
+                GROUP BY page_url, period_start
+                """), {'dates': dates})
+                written += cursor.rowcount
+            connection.execute(
+                "INSERT INTO metadata_table (query_name, last_event_time) VALUES ('rollups_query', ?) "
+                "ON CONFLICT (query_name) DO UPDATE SET last_event_time = excluded.last_event_time",
+                (max(row['modified'] for row in dirty),))
+            self._touch([rollup['table_id'].split('.')[-1] for rollup in rollups] + ['metadata_table'])
+        return written
+
+    def run_script(self, name: str) -> dict:
+        """
+        Run the local equivalent of the aggregation script `name`, reporting like bigquery.run_query.
+        """
+        started = time.perf_counter()
+        self.import_files()
+        if name == "late_events_query":
+            rows_merged = self.recompute_late(self.targets + ([self.cube] if self.cube else []))
+        elif name == "rollups_query":
+            rows_merged = self.run_rollups(self.rollups)
+        elif self.cube is not None and name == self.cube['query_name']:
+            rows_merged = self.run_cube(self.cube)
+        elif name == "consolidated_query":
+            # The BigQuery script aggregates the cube in the same scan
+            rows_merged = self.run_incremental(self.targets) + (self.run_cube(self.cube) if self.cube else 0)
+        else:
+            rows_merged = self.run_incremental([target for target in self.targets if target['query_name'] == name])
+        return {
+            "name": name,
+            "duration_s": time.perf_counter() - started,
+            "total_bytes_processed": 0,
+            "total_bytes_billed": 0,
+            "slot_millis": 0,
+            "rows_merged": rows_merged,
+        }
+
+    def get_backlog(self, watermark_names: list[str], count_late_partitions: bool) -> tuple[datetime | None, datetime | None, int]:
+        """
+        Same measurement as bigquery.get_backlog, counting the dates with late events as partitions.
+        """
+        self.import_files()
+        with self._lock:
+            watermarks = self._watermarks()
+            tracked = [watermarks[name] for name in watermark_names if name in watermarks]
+            watermark = min(tracked) if len(tracked) == len(watermark_names) else None
+            latest_event_time = self.connection.execute(
+                f'SELECT MAX(event_time) FROM "{self.base_table}" WHERE event_time > ?',
+                (watermark or to_timestamp(EPOCH),)).fetchone()[0]
+            late_partitions = 0
+            checked_until = watermarks.get('late_events_query')
+            if count_late_partitions and checked_until is not None and tracked:
+                late_partitions = self.connection.execute(
+                    f'SELECT COUNT(DISTINCT date(event_time)) FROM "{self.base_table}" WHERE _ingested_at > ? AND date(event_time) <= date(?)',
+                    (checked_until, max(tracked))).fetchone()[0]
+        return from_timestamp(watermark), from_timestamp(latest_event_time), late_partitions
@@ -0,0 +1,222 @@
+"""
+Rebuild the metric tables over a date range.
+
+The range is split into chunks of `--chunk-days` event dates. Each chunk is recomputed into temp
+tables by one scan script, and up to `--concurrency` scans run at once. The recomputed partitions
+are then swapped into every selected metric table by one transaction per chunk, one chunk at a
+time (see build_backfill_scan_query and build_backfill_swap_query). Finished chunks are recorded in
+a checkpoint file, so an interrupted backfill picks up where it stopped when it is started again
+with the same arguments. Only events up to each table's watermark are rebuilt; later events are
+left to the scheduler. A scheduled run that merges between a chunk's watermark read and its swap
+would be overwritten, so the aggregator at `--aggregator-url` is paused for the duration of the
+backfill; with `--no-pause`, stop the scheduler yourself. When page_daily_metrics is rebuilt, its
+weekly and monthly rollups are refreshed at the end. The dimension cube is rebuilt as
+"dimension_metrics", e.g. after adding a dimension to it.
+
+Usage: python backfill.py --start 2024-01-01 --end 2024-12-31 [--metrics sessions,scroll]
+       [--chunk-days 7] [--concurrency 8] [--checkpoint backfill_checkpoint.json] [--restart]
+       [--aggregator-url http://localhost:8000] [--no-pause]
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, timedelta
+from bigquery import create_tables, scan_range, swap_range, refresh_rollups
+from queries import CONSOLIDATED_TARGETS, CUBE_TARGET
+from config import maintain_rollups, maintain_cube, backfill_chunk_days, backfill_concurrency, backfill_checkpoint_file, backfill_retries, backfill_aggregator_url
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Metric names accepted by --metrics, e.g. "sessions" for the sessions_query target
+METRICS = {target['query_name'].removesuffix('_query'): target
+           for target in CONSOLIDATED_TARGETS + ([CUBE_TARGET] if maintain_cube else [])}
+
+# BigQuery aborts concurrent transactions that mutate the same table, so swaps run one at a time
+swap_lock = threading.Lock()
+
+# The aggregator is paused for PAUSE_SECONDS at a time, renewed every PAUSE_RENEW_SECONDS
+PAUSE_SECONDS = 300
+PAUSE_RENEW_SECONDS = 60
+
+
+def split_range(start: date, end: date, chunk_days: int) -> list[tuple[date, date]]:
+    chunks = []
+    while start <= end:
+        chunk_end = min(start + timedelta(days=chunk_days - 1), end)
+        chunks.append((start, chunk_end))
+        start = chunk_end + timedelta(days=1)
+    return chunks
+
+
+class Checkpoint:
+    """
+    Chunks already rebuilt by a backfill, persisted after every chunk.
+    """
+
+    def __init__(self, path: str, job: dict, restart: bool = False):
+        self.path = path
+        self.job = job
+        self.completed: set[str] = set()
+        self._lock = threading.Lock()
+        if os.path.exists(path) and not restart:
+            with open(path, 'r') as f:
+                saved = json.load(f)
+            if saved.get('job') != job:
+                raise SystemExit(f"{path} belongs to a different backfill ({saved.get('job')}); pass --restart to discard it")
+            self.completed = set(saved.get('completed', []))
+
+    def done(self, chunk_start: date) -> bool:
+        return chunk_start.isoformat() in self.completed
+
+    def mark_done(self, chunk_start: date) -> None:
+        with self._lock:
+            self.completed.add(chunk_start.isoformat())
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({"job": self.job, "completed": sorted(self.completed)}, f)
+            os.replace(tmp_path, self.path)
+
+
+class AggregatorPause:
+    """
+    Keeps the aggregator's scheduled runs paused (POST /pause) until `stop`, which resumes them.
+    The pause expires on its own if the backfill dies without resuming.
+    """
+
+    def __init__(self, url: str):
+        self.url = url.rstrip('/')
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._renew, daemon=True)
+
+    def _post(self, path: str) -> None:
+        # /pause waits for a run in progress to finish
+        request = urllib.request.Request(f"{self.url}{path}", method="POST")
+        with urllib.request.urlopen(request, timeout=PAUSE_SECONDS):
+            pass
+
+    def start(self) -> None:
+        self._post(f"/pause?seconds={PAUSE_SECONDS}")
+        self._thread.start()
+
+    def _renew(self) -> None:
+        while not self._stopped.wait(PAUSE_RENEW_SECONDS):
+            try:
+                self._post(f"/pause?seconds={PAUSE_SECONDS}")
+            except Exception as e:
+                logger.warning(f"Failed to renew the aggregator pause: {e}")
+
+    def stop(self) -> None:
+        self._stopped.set()
+        try:
+            self._post("/resume")
+        except Exception as e:
+            logger.warning(f"Failed to resume the aggregator, it resumes when the pause expires: {e}")
+
+
+def with_retries(step, targets: list[dict], chunk: tuple[date, date], retries: int) -> int:
+    for attempt in range(retries + 1):
+        try:
+            return step(targets, chunk[0], chunk[1])
+        except Exception as e:
+            if attempt == retries:
+                raise
+            backoff = 2 ** attempt * 5
+            logger.warning(f"Chunk {chunk[0]}..{chunk[1]} failed, retrying in {backoff}s: {e}")
+            time.sleep(backoff)
+
+
+def run_chunk(targets: list[dict], chunk: tuple[date, date], retries: int) -> int:
+    """
+    Rebuild one chunk; returns the bytes it processed. Scans write their own temp tables and swaps
+    overwrite the chunk's partitions, so retrying either after a failure is safe.
+    """
+    scanned = with_retries(scan_range, targets, chunk, retries)
+    with swap_lock:
+        return scanned + with_retries(swap_range, targets, chunk, retries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--start", type=date.fromisoformat, required=True)
+    parser.add_argument("--end", type=date.fromisoformat, required=True)
+    parser.add_argument("--metrics", default=",".join(METRICS), help=f"comma separated, from: {', '.join(METRICS)}")
+    parser.add_argument("--chunk-days", type=int, default=backfill_chunk_days)
+    parser.add_argument("--concurrency", type=int, default=backfill_concurrency)
+    parser.add_argument("--checkpoint", default=backfill_checkpoint_file)
+    parser.add_argument("--retries", type=int, default=backfill_retries)
+    parser.add_argument("--restart", action="store_true", help="ignore an existing checkpoint")
+    parser.add_argument("--aggregator-url", default=backfill_aggregator_url)
+    parser.add_argument("--no-pause", action="store_true", help="don't pause the aggregator; stop it yourself")
+    args = parser.parse_args()
+
+    metrics = [metric.strip() for metric in args.metrics.split(",") if metric.strip()]
+    unknown = [metric for metric in metrics if metric not in METRICS]
+    if unknown:
+        parser.error(f"unknown metrics: {', '.join(unknown)}")
+    if args.end < args.start or args.chunk_days < 1:
+        parser.error("invalid date range or chunk size")
+    targets = [METRICS[metric] for metric in metrics]
+
+    job = {"start": args.start.isoformat(), "end": args.end.isoformat(), "metrics": metrics, "chunk_days": args.chunk_days}
+    checkpoint = Checkpoint(args.checkpoint, job, restart=args.restart)
+    chunks = split_range(args.start, args.end, args.chunk_days)
+    pending = [chunk for chunk in chunks if not checkpoint.done(chunk[0])]
+    logger.info(f"Backfilling {', '.join(metrics)} from {args.start} to {args.end}: "
+                f"{len(pending)} of {len(chunks)} chunks left, {args.concurrency} at a time")
+
+    # Create any missing tables once, rather than from concurrent chunks
+    create_tables(targets)
+
+    pause = None
+    if not args.no_pause:
+        pause = AggregatorPause(args.aggregator_url)
+        try:
+            pause.start()
+        except Exception as e:
+            raise SystemExit(f"Failed to pause the aggregator at {args.aggregator_url} ({e}); "
+                             f"stop its scheduler and pass --no-pause")
+        logger.info(f"Paused the aggregator at {args.aggregator_url}")
+    try:
+        started = time.perf_counter()
+        done_days = 0
+        done_bytes = 0
+        failed = []
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            futures = {executor.submit(run_chunk, targets, chunk, args.retries): chunk for chunk in pending}
+            for future in as_completed(futures):
+                chunk = futures[future]
+                try:
+                    done_bytes += future.result()
+                except Exception as e:
+                    failed.append(chunk)
+                    logger.error(f"Chunk {chunk[0]}..{chunk[1]} failed: {e}")
+                    continue
+                checkpoint.mark_done(chunk[0])
+                done_days += (chunk[1] - chunk[0]).days + 1
+                elapsed = time.perf_counter() - started
+                logger.info(f"Rebuilt {chunk[0]}..{chunk[1]} ({len(checkpoint.completed)}/{len(chunks)} chunks): "
+                            f"{done_days / elapsed * 60:.1f} days/min, {done_bytes / elapsed / 1e6:.1f} MB/s")
+
+        if maintain_rollups and "page_daily_metrics" in metrics and done_days:
+            refresh_rollups()
+            logger.info("Refreshed the weekly and monthly rollups")
+
+        elapsed = time.perf_counter() - started
+        logger.info(f"Backfill finished in {elapsed:.0f}s: {done_days} days, {done_bytes / 1e9:.2f} GB processed, "
+                    f"{len(failed)} chunks failed")
+    finally:
+        if pause is not None:
+            pause.stop()
+
+    if failed:
+        raise SystemExit(f"{len(failed)} chunks failed; run the same command again to retry them")
+
+
+if __name__ == "__main__":
+    main()
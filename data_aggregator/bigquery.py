@@ -1,41 +1,235 @@
 import logging
+import time
+from collections import deque
+from datetime import date, datetime
 from google.cloud import bigquery
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
 from google.oauth2 import service_account
-from queries import checkout_completed_query, sessions_query, scroll_query, add_to_cart_query, total_revenue_query
-from config import scopes, creds
+from config import scopes, creds, backend, local_database, local_base_files, aggregation_mode, dataset_id, base_table_id, base_table_name, page_daily_metrics_table_id, recompute_late_partitions, maintain_rollups, maintain_cube
+from backends import LocalAggregator
+from common.instrumentation import registry
+from queries import checkout_completed_query, sessions_query, scroll_query, add_to_cart_query, total_revenue_query, page_daily_metrics_query, consolidated_query, late_events_query, rollups_query, dimension_metrics_query, CONSOLIDATED_TARGETS, ROLLUP_TARGETS, CUBE_TARGET, build_backfill_scan_query, build_backfill_swap_query, build_create_tables_query
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-bqcreds = service_account.Credentials.from_service_account_file(
-    creds,
-    scopes=scopes
-)
-client = bigquery.Client(credentials=bqcreds, project=bqcreds.project_id)
+SCRIPT_SECONDS = registry.histogram("aggregation_script_seconds", "Duration of the aggregation scripts", ("script",))
+SCRIPT_BYTES_PROCESSED = registry.counter("aggregation_bytes_processed_total", "Bytes processed by the aggregation scripts", ("script",))
+SCRIPT_BYTES_BILLED = registry.counter("aggregation_bytes_billed_total", "Bytes billed for the aggregation scripts", ("script",))
+SCRIPT_SLOT_MILLIS = registry.counter("aggregation_slot_millis_total", "Slot milliseconds used by the aggregation scripts", ("script",))
+SCRIPT_ROWS_MERGED = registry.counter("aggregation_rows_merged_total", "Rows merged by the aggregation scripts", ("script",))
+SCRIPT_FAILURES = registry.counter("aggregation_script_failures_total", "Aggregation scripts that raised", ("script",))
+
+if backend == "local":
+    # Runs the scripts' equivalents on SQLite; see backends.LocalAggregator
+    logger.info(f"Using the local backend at {local_database}")
+    client = None
+    local = LocalAggregator(local_database, base_table_id, local_base_files, CONSOLIDATED_TARGETS,
+                            page_daily_metrics_table_id, ROLLUP_TARGETS, CUBE_TARGET if maintain_cube else None)
+elif backend == "bigquery":
+    bqcreds = service_account.Credentials.from_service_account_file(
+        creds,
+        scopes=scopes
+    )
+    client = bigquery.Client(credentials=bqcreds, project=bqcreds.project_id)
+    local = None
+else:
+    raise ValueError(f"Unknown backend: {backend}")
 
 # Create an event loop and executor for the async functions
 loop = asyncio.get_event_loop()
 executor = ThreadPoolExecutor(max_workers=4)
 
-queries = {
+per_query_queries = {
     "add_to_cart_query": f'{add_to_cart_query}',
     "sessions_query": f'{sessions_query}',
     "checkout_completed_query": f'{checkout_completed_query}',
     "scroll_query": f'{scroll_query}',
     "total_revenue_query": f'{total_revenue_query}',
+    "page_daily_metrics_query": f'{page_daily_metrics_query}',
+}
+
+consolidated_queries = {
+    "consolidated_query": f'{consolidated_query}',
 }
 
-def run_query(query: str):
-    query_job = client.query(query)
+if aggregation_mode == "per_query":
+    queries = per_query_queries
+elif aggregation_mode == "consolidated":
+    queries = consolidated_queries
+else:
+    raise ValueError(f"Unknown aggregation mode: {aggregation_mode}")
+
+if maintain_cube and aggregation_mode == "per_query":
+    # In consolidated mode the cube is aggregated by the consolidated scan
+    queries = {**queries, "dimension_metrics_query": dimension_metrics_query}
+
+# Cost of the most recent runs, to compare the aggregation modes
+run_history = deque(maxlen=100)
+
+
+# Watermarks kept in the metadata table, one per target table (shared by both modes)
+watermark_names = [target['query_name'] for target in CONSOLIDATED_TARGETS + ([CUBE_TARGET] if maintain_cube else [])]
+
+
+def run_query(name: str, query: str) -> dict:
+    try:
+        result = execute_script(name, query)
+    except Exception:
+        SCRIPT_FAILURES.labels(name).inc()
+        raise
+    SCRIPT_SECONDS.labels(name).observe(result['duration_s'])
+    SCRIPT_BYTES_PROCESSED.labels(name).inc(result['total_bytes_processed'])
+    SCRIPT_BYTES_BILLED.labels(name).inc(result['total_bytes_billed'])
+    SCRIPT_SLOT_MILLIS.labels(name).inc(result['slot_millis'])
+    SCRIPT_ROWS_MERGED.labels(name).inc(result['rows_merged'])
+    return result
+
+
+def execute_script(name: str, query: str) -> dict:
+    if local is not None:
+        return local.run_script(name)
+    # Labels let the jobs of each mode be found in INFORMATION_SCHEMA.JOBS (see benchmarks/aggregation_cost.py)
+    job_config = bigquery.QueryJobConfig(labels={"aggregation_mode": aggregation_mode, "aggregation_script": name})
+    started = time.perf_counter()
+    query_job = client.query(query, job_config=job_config)
     query_job.result()
+    duration = time.perf_counter() - started
 
-# Async function to run queries concurrently
-async def run_all_queries():
+    # A script's rows merged are reported on its child MERGE statements
     try:
-        tasks = [loop.run_in_executor(executor, run_query, query) for query in queries.values()]
-        await asyncio.gather(*tasks)
+        rows_merged = sum(
+            child.num_dml_affected_rows or 0
+            for child in client.list_jobs(parent_job=query_job.job_id)
+            if getattr(child, 'statement_type', None) == 'MERGE'
+        )
     except Exception as e:
-        logger.exception("Queries were not run", e)
\ No newline at end of file
+        logger.warning(f"Failed to list the statements of {name}: {e}")
+        rows_merged = 0
+    return {
+        "name": name,
+        "duration_s": duration,
+        "total_bytes_processed": query_job.total_bytes_processed or 0,
+        "total_bytes_billed": query_job.total_bytes_billed or 0,
+        "slot_millis": query_job.slot_millis or 0,
+        "rows_merged": rows_merged,
+    }
+
+
+# Async function to run queries concurrently
+async def run_all_queries() -> list[dict]:
+    tasks = [loop.run_in_executor(executor, run_query, name, query) for name, query in queries.items()]
+    results = await asyncio.gather(*tasks)
+    if recompute_late_partitions:
+        # Reads the watermarks the scripts above just moved, so it has to run after them
+        results.append(await loop.run_in_executor(executor, run_query, "late_events_query", late_events_query))
+    if maintain_rollups:
+        # Rolls up the daily rows every script above may have written
+        results.append(await loop.run_in_executor(executor, run_query, "rollups_query", rollups_query))
+
+    run = {
+        "mode": aggregation_mode,
+        "scripts": len(results),
+        "total_bytes_processed": sum(result['total_bytes_processed'] for result in results),
+        "total_bytes_billed": sum(result['total_bytes_billed'] for result in results),
+        "slot_millis": sum(result['slot_millis'] for result in results),
+    }
+    run_history.append(run)
+    logger.info(f"Aggregation run ({aggregation_mode}): {run['scripts']} scripts, "
+                f"{run['total_bytes_processed'] / 1e6:.1f} MB processed, "
+                f"{run['total_bytes_billed'] / 1e6:.1f} MB billed, {run['slot_millis']} slot ms")
+    return results
+
+
+def get_backlog() -> tuple[datetime | None, datetime | None, int]:
+    """
+    The oldest aggregation watermark, the latest event time in the base table after it, and the
+    number of partitions behind the watermarks modified since the late events script last ran.
+    Watermarks are read with a (free) table read; the event time query only scans the partitions
+    past the watermark.
+    """
+    if local is not None:
+        return local.get_backlog(watermark_names, recompute_late_partitions)
+    watermarks = {row['query_name']: row['last_event_time'] for row in client.list_rows(f"{dataset_id}.metadata_table")}
+    tracked = [watermarks[name] for name in watermark_names if name in watermarks]
+    watermark = min(tracked) if len(tracked) == len(watermark_names) else None
+    checked_until = watermarks.get('late_events_query')
+
+    query_parameters = [bigquery.ScalarQueryParameter("watermark", "TIMESTAMP", watermark or datetime(1970, 1, 1))]
+    late_partitions = "0"
+    if recompute_late_partitions and checked_until is not None and tracked:
+        late_partitions = f"""(
+      SELECT COUNT(*)
+      FROM `{dataset_id}.INFORMATION_SCHEMA.PARTITIONS`
+      WHERE table_name = '{base_table_name}'
+        AND partition_id NOT IN ('__NULL__', '__UNPARTITIONED__')
+        AND last_modified_time > @checked_until
+        AND PARSE_DATE('%Y%m%d', partition_id) <= DATE(@latest_watermark)
+    )"""
+        query_parameters += [
+            bigquery.ScalarQueryParameter("checked_until", "TIMESTAMP", checked_until),
+            bigquery.ScalarQueryParameter("latest_watermark", "TIMESTAMP", max(tracked)),
+        ]
+    query = f"""
+    SELECT
+      (SELECT MAX(event_time) FROM `{base_table_id}` WHERE event_time > @watermark) AS latest_event_time,
+      {late_partitions} AS late_partitions
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=query_parameters)
+    rows = list(client.query(query, job_config=job_config).result())
+    if not rows:
+        return watermark, None, 0
+    return watermark, rows[0]['latest_event_time'], rows[0]['late_partitions']
+
+
+def aggregation_stats() -> dict:
+    runs = len(run_history)
+    return {
+        "mode": aggregation_mode,
+        "runs": runs,
+        "last_run": run_history[-1] if runs else None,
+        "avg_bytes_processed": sum(run["total_bytes_processed"] for run in run_history) / runs if runs else 0,
+        "avg_slot_millis": sum(run["slot_millis"] for run in run_history) / runs if runs else 0,
+    }
+
+
+def create_tables(targets: list[dict]) -> None:
+    if local is not None:
+        local.create_tables(targets)
+        return
+    client.query(build_create_tables_query(targets)).result()
+
+
+def refresh_rollups() -> dict:
+    """
+    Roll up the daily page metrics modified since the last aggregation run (e.g. by a backfill).
+    """
+    return run_query("rollups_query", rollups_query)
+
+
+def scan_range(targets: list[dict], start_date: date, end_date: date) -> int:
+    """
+    Recompute the event_dates from `start_date` to `end_date` of `targets` into temp tables for
+    swap_range; returns the bytes processed. Scans of disjoint ranges can run concurrently.
+    """
+    if local is not None:
+        # The local backend recomputes and swaps in one step, in swap_range
+        return 0
+    query_job = client.query(build_backfill_scan_query(targets, start_date.isoformat(), end_date.isoformat()))
+    query_job.result()
+    return query_job.total_bytes_processed or 0
+
+
+def swap_range(targets: list[dict], start_date: date, end_date: date) -> int:
+    """
+    Overwrite the event_dates from `start_date` to `end_date` in `targets` with the rows of
+    scan_range, in one transaction; returns the bytes processed.
+    """
+    if local is not None:
+        local.rebuild_range(targets, start_date, end_date)
+        return 0
+    query_job = client.query(build_backfill_swap_query(targets, start_date.isoformat(), end_date.isoformat()))
+    query_job.result()
+    return query_job.total_bytes_processed or 0
@@ -1,4 +1,10 @@
 import json
+import os
+import sys
+
+# The modules shared by both services (common/) live at the repository root. Appended, so a copy
+# of common/ deployed next to the service takes precedence.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 
 def load_config(section: str):
     with open('config.json', 'r') as f:
@@ -13,6 +19,41 @@ sessions_table_id = ".".join([dataset_id, config['sessions_table']])
 checkout_completed_table_id = ".".join([dataset_id, config['checkout_completed_table']])
 revenue_table_id = ".".join([dataset_id, config['revenue_table']])
 scroll_table_id = ".".join([dataset_id, config['scroll_values_table']])
-base_table_id = ".".join([dataset_id, config['base_table']])
+page_daily_metrics_table_name = config.get('page_daily_metrics_table', 'page_daily_metrics')
+page_daily_metrics_table_id = ".".join([dataset_id, page_daily_metrics_table_name])
+page_weekly_metrics_table_id = ".".join([dataset_id, config.get('page_weekly_metrics_table', 'page_weekly_metrics')])
+page_monthly_metrics_table_id = ".".join([dataset_id, config.get('page_monthly_metrics_table', 'page_monthly_metrics')])
+dimension_metrics_table_id = ".".join([dataset_id, config.get('dimension_metrics_table', 'page_dimension_metrics')])
+base_table_name = config['base_table']
+base_table_id = ".".join([dataset_id, base_table_name])
 creds=config['credentials_file']
-scopes=config['scopes']
\ No newline at end of file
+scopes=config['scopes']
+
+backend_config = load_config(section='backend')
+# "bigquery", or "local" to aggregate into a SQLite database shared with the metrics service
+backend = backend_config.get('type', 'bigquery')
+local_database = backend_config.get('database', '../local/analytics.db')
+# NDJSON or Parquet event files imported into the local base table
+local_base_files = backend_config.get('base_files', [])
+
+aggregation_config = load_config(section='aggregation')
+# "per_query" runs one script per metric table, "consolidated" fills them all from a single scan
+aggregation_mode = aggregation_config.get('mode', 'per_query')
+min_interval = aggregation_config.get('min_interval_s', 60)
+max_interval = aggregation_config.get('max_interval_s', 900)
+misfire_grace_time = aggregation_config.get('misfire_grace_s', 30)
+recompute_late_partitions = aggregation_config.get('recompute_late_partitions', True)
+# Keep the weekly and monthly rollups of page_daily_metrics read by the metrics service
+maintain_rollups = aggregation_config.get('rollups', True)
+
+cube_config = load_config(section='cube')
+# Keep the dimension cube read by /get_metrics/breakdown, over every subset of `dimensions`
+maintain_cube = cube_config.get('enabled', True)
+cube_dimensions = cube_config.get('dimensions', ['platform', 'device'])
+
+backfill_config = load_config(section='backfill')
+backfill_chunk_days = backfill_config.get('chunk_days', 7)
+backfill_concurrency = backfill_config.get('concurrency', 8)
+backfill_retries = backfill_config.get('retries', 3)
+backfill_checkpoint_file = backfill_config.get('checkpoint_file', 'backfill_checkpoint.json')
+backfill_aggregator_url = backfill_config.get('aggregator_url', 'http://localhost:8000')
\ No newline at end of file
@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Awaitable, Callable
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class RunCoordinator:
+    """
+    Decides when the aggregation scripts run and makes sure runs never overlap.
+
+    Each `tick` first measures the backlog: `measure_backlog` returns the oldest watermark, the
+    latest event time in the base table and the number of older partitions that received late
+    events. Without new or late events the run is skipped and the
+    interval until the next tick doubles, up to `max_interval`; as soon as events arrive a run
+    starts and the interval drops back to `min_interval`. A tick that fires while a run is still
+    in progress is skipped rather than queued, so two runs can never merge the same increment.
+    The lock is per process: run a single aggregator instance. `pause` takes the lock, so it waits
+    for a run in progress, and keeps ticks from starting runs until the pause expires or `resume`
+    is called; backfill.py pauses the aggregator this way.
+    """
+
+    def __init__(self, run: Callable[[], Awaitable[list[dict]]],
+                 measure_backlog: Callable[[], tuple[datetime | None, datetime | None, int]],
+                 min_interval: float = 60, max_interval: float = 900):
+        self.run = run
+        self.measure_backlog = measure_backlog
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self._lock = asyncio.Lock()
+
+        self.watermark: datetime | None = None
+        self.latest_event_time: datetime | None = None
+        self.late_partitions = 0
+        self.runs = 0
+        self.failures = 0
+        self.skipped_overlapping = 0
+        self.idle_ticks = 0
+        self.skipped_paused = 0
+        self.paused_until = 0.0
+        self.last_run_started: datetime | None = None
+        self.last_run_duration = 0.0
+        self.query_stats: dict[str, dict] = defaultdict(dict)
+
+    async def tick(self) -> None:
+        if self._lock.locked():
+            self.skipped_overlapping += 1
+            logger.warning("Previous aggregation run is still in progress, skipping this one")
+            return
+        if self.paused():
+            self.skipped_paused += 1
+            logger.info("Aggregation is paused, skipping this run")
+            return
+
+        async with self._lock:
+            try:
+                self.watermark, self.latest_event_time, self.late_partitions = await asyncio.to_thread(self.measure_backlog)
+            except Exception as e:
+                # Without a backlog measurement, run anyway: the scripts are incremental
+                logger.error(f"Failed to measure the aggregation backlog: {e}")
+            else:
+                new_events = self.latest_event_time is not None and (self.watermark is None or self.latest_event_time > self.watermark)
+                if not new_events and not self.late_partitions:
+                    self.idle_ticks += 1
+                    self.interval = min(self.interval * 2, self.max_interval)
+                    logger.info(f"No new or late events, next aggregation check in {self.interval:.0f}s")
+                    return
+
+            self.last_run_started = datetime.now(timezone.utc)
+            started = time.perf_counter()
+            try:
+                results = await self.run()
+            except Exception as e:
+                self.failures += 1
+                logger.exception(f"Aggregation run failed: {e}")
+                return
+            finally:
+                self.last_run_duration = time.perf_counter() - started
+
+            self.runs += 1
+            self.interval = self.min_interval
+            self.late_partitions = 0
+            if self.latest_event_time is not None:
+                # The scripts merge everything up to at least the event time measured before the run
+                self.watermark = max(self.watermark, self.latest_event_time) if self.watermark else self.latest_event_time
+            for result in results:
+                stats = self.query_stats[result['name']]
+                stats.update(result)
+                stats['runs'] = stats.get('runs', 0) + 1
+                stats['total_rows_merged'] = stats.get('total_rows_merged', 0) + result['rows_merged']
+
+    def paused(self) -> bool:
+        return time.monotonic() < self.paused_until
+
+    async def pause(self, seconds: float) -> None:
+        """
+        Skip runs for the next `seconds`, once the run in progress (if any) has finished. Pausing
+        again extends or shortens the pause.
+        """
+        async with self._lock:
+            self.paused_until = time.monotonic() + seconds
+        logger.info(f"Aggregation paused for {seconds:.0f}s")
+
+    def resume(self) -> None:
+        self.paused_until = 0.0
+        logger.info("Aggregation resumed")
+
+    def backlog_seconds(self) -> float | None:
+        if self.latest_event_time is None or self.watermark is None:
+            return None
+        return max((self.latest_event_time - self.watermark).total_seconds(), 0.0)
+
+    def freshness_lag_seconds(self) -> float | None:
+        if self.watermark is None:
+            return None
+        return (datetime.now(timezone.utc) - self.watermark).total_seconds()
+
+    def status(self) -> dict:
+        return {
+            "running": self._lock.locked(),
+            "paused_s": max(self.paused_until - time.monotonic(), 0.0),
+            "interval_s": self.interval,
+            "runs": self.runs,
+            "failures": self.failures,
+            "skipped_overlapping": self.skipped_overlapping,
+            "skipped_paused": self.skipped_paused,
+            "idle_ticks": self.idle_ticks,
+            "last_run_started": self.last_run_started.isoformat() if self.last_run_started else None,
+            "last_run_duration_s": self.last_run_duration,
+            "watermark": self.watermark.isoformat() if self.watermark else None,
+            "latest_event_time": self.latest_event_time.isoformat() if self.latest_event_time else None,
+            "backlog_s": self.backlog_seconds(),
+            "late_partitions": self.late_partitions,
+            "freshness_lag_s": self.freshness_lag_seconds(),
+            "queries": dict(self.query_stats),
+        }
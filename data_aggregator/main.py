@@ -1,24 +1,72 @@
 import logging
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from bigquery import run_all_queries
+from bigquery import run_all_queries, aggregation_stats, get_backlog
+from coordinator import RunCoordinator
+from common.instrumentation import CONTENT_TYPE, registry
+from config import min_interval, max_interval, misfire_grace_time
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
-INTERVAL = 1
+JOB_ID = "aggregation"
+
+scheduler = AsyncIOScheduler()
+coordinator = RunCoordinator(run_all_queries, get_backlog, min_interval=min_interval, max_interval=max_interval)
+
+# Script costs are recorded by bigquery.run_query; the scheduling state is read when /metrics is scraped
+registry.callback("aggregation_freshness_lag_seconds", "Age of the oldest aggregation watermark", coordinator.freshness_lag_seconds)
+registry.callback("aggregation_backlog_seconds", "Event time between the oldest watermark and the latest event", coordinator.backlog_seconds)
+registry.callback("aggregation_late_partitions", "Partitions behind the watermarks with late events", lambda: coordinator.late_partitions)
+registry.callback("aggregation_interval_seconds", "Current interval between aggregation checks", lambda: coordinator.interval)
+registry.callback("aggregation_last_run_seconds", "Duration of the last aggregation run", lambda: coordinator.last_run_duration)
+registry.callback("aggregation_runs_total", "Aggregation ticks by outcome",
+                  lambda: {"completed": coordinator.runs, "failed": coordinator.failures,
+                           "idle": coordinator.idle_ticks, "overlapping": coordinator.skipped_overlapping,
+                           "paused": coordinator.skipped_paused},
+                  kind="counter", labelnames=("outcome",))
+
+async def scheduled_run():
+    interval = coordinator.interval
+    await coordinator.tick()
+    if coordinator.interval != interval:
+        scheduler.reschedule_job(JOB_ID, trigger='interval', seconds=coordinator.interval)
 
 def schedule_queries():
-    scheduler = AsyncIOScheduler()
-    scheduler.add_job(run_all_queries, 'interval', minutes=INTERVAL)
+    # One instance at a time; runs missed while busy are coalesced into a single one
+    scheduler.add_job(scheduled_run, 'interval', seconds=coordinator.interval, id=JOB_ID,
+                      max_instances=1, coalesce=True, misfire_grace_time=misfire_grace_time)
     scheduler.start()
 
 @app.on_event("startup")
 async def startup_event():
     schedule_queries()
 
+@app.get("/stats")
+async def stats():
+    return aggregation_stats()
+
+@app.get("/status")
+async def status():
+    return coordinator.status()
+
+@app.post("/pause")
+async def pause(seconds: float = 300):
+    # Returns once no run is in progress; backfill.py renews the pause while it runs
+    await coordinator.pause(seconds)
+    return coordinator.status()
+
+@app.post("/resume")
+async def resume():
+    coordinator.resume()
+    return coordinator.status()
+
+@app.get("/metrics")
+async def metrics():
+    return Response(registry.render(), media_type=CONTENT_TYPE)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
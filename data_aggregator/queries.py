@@ -1,4 +1,23 @@
-from config import dataset_id, base_table_id, checkout_completed_table_id, add_to_cart_table_id, sessions_table_id, revenue_table_id, scroll_table_id
+from itertools import combinations
+from config import dataset_id, base_table_id, base_table_name, checkout_completed_table_id, add_to_cart_table_id, sessions_table_id, revenue_table_id, scroll_table_id, page_daily_metrics_table_id, page_daily_metrics_table_name, page_weekly_metrics_table_id, page_monthly_metrics_table_id, dimension_metrics_table_id, cube_dimensions, maintain_cube
+
+
+def merge_sessions_sketch(target: str, source: str) -> str:
+    """
+    SQL merging two HLL session sketches. A NULL target sketch marks a row written before sessions
+    were sketched; it stays NULL, since a sketch of only the new sessions would undercount the row.
+    """
+    return f"IF({target} IS NULL, NULL, (SELECT HLL_COUNT.MERGE_PARTIAL(sketch) FROM UNNEST([{target}, {source}]) AS sketch))"
+
+
+def merge_session_count(target: str, source: str, target_sketch: str, source_sketch: str) -> str:
+    """
+    SQL for the daily session count after a merge: the cardinality of the merged sketch, so a session
+    seen in several aggregator runs counts once. Rows without a sketch keep adding the batch counts.
+    """
+    return (f"IF({target_sketch} IS NULL, {target} + {source}, "
+            f"HLL_COUNT.EXTRACT((SELECT HLL_COUNT.MERGE_PARTIAL(sketch) FROM UNNEST([{target_sketch}, {source_sketch}]) AS sketch)))")
+
 
 checkout_completed_query = f"""
 DECLARE last_processed_time TIMESTAMP;
@@ -146,6 +165,7 @@ SELECT
   page_url,
   DATE(event_time) AS event_date,
   COUNT(DISTINCT session_id) AS number_of_sessions,
+  HLL_COUNT.INIT(session_id) AS sessions_sketch,
   MAX(event_time) AS max_event_time
 FROM
   `{base_table_id}`
@@ -165,21 +185,27 @@ SET new_max_event_time = (
 CREATE TABLE IF NOT EXISTS `{sessions_table_id}` (
     page_url STRING,
     event_date DATE,
-    number_of_sessions INT64
+    number_of_sessions INT64,
+    sessions_sketch BYTES
 )
 PARTITION BY event_date
 CLUSTER BY page_url;
 
+-- Tables created before sessions were sketched gain the column; their existing rows keep a NULL sketch
+ALTER TABLE `{sessions_table_id}` ADD COLUMN IF NOT EXISTS sessions_sketch BYTES;
+
 IF new_max_event_time IS NOT NULL THEN
   -- Merge the new data with the existing data
   MERGE `{sessions_table_id}` T
   USING `{dataset_id}.temp_aggregated_sessions` S
   ON T.page_url = S.page_url AND T.event_date = S.event_date
   WHEN MATCHED THEN
-    UPDATE SET T.number_of_sessions = T.number_of_sessions + S.number_of_sessions
+    UPDATE SET
+      T.number_of_sessions = {merge_session_count('T.number_of_sessions', 'S.number_of_sessions', 'T.sessions_sketch', 'S.sessions_sketch')},
+      T.sessions_sketch = {merge_sessions_sketch('T.sessions_sketch', 'S.sessions_sketch')}
   WHEN NOT MATCHED THEN
-    INSERT (page_url, event_date, number_of_sessions)
-    VALUES (S.page_url, S.event_date, S.number_of_sessions);
+    INSERT (page_url, event_date, number_of_sessions, sessions_sketch)
+    VALUES (S.page_url, S.event_date, S.number_of_sessions, S.sessions_sketch);
 
   -- Update the last processed time in the metadata table
   UPDATE `{dataset_id}.metadata_table`
@@ -336,4 +362,735 @@ IF new_max_event_time IS NOT NULL THEN
   WHERE query_name = 'scroll_query';
 
 END IF;
-"""
\ No newline at end of file
+"""
+
+page_daily_metrics_query = f"""
+DECLARE last_processed_time TIMESTAMP;
+DECLARE new_max_event_time TIMESTAMP;
+
+-- Get the last processed time for 'page_daily_metrics_query'
+SET last_processed_time = (
+  SELECT COALESCE(MAX(last_event_time), TIMESTAMP('1970-01-01'))
+  FROM `{dataset_id}.metadata_table`
+  WHERE query_name = 'page_daily_metrics_query'
+);
+
+-- Aggregate every counter in a single scan of the new events
+CREATE OR REPLACE TABLE `{dataset_id}.temp_aggregated_page_daily_metrics`
+PARTITION BY event_date
+CLUSTER BY page_url AS
+SELECT
+  page_url,
+  DATE(event_time) AS event_date,
+  COUNT(DISTINCT session_id) AS number_of_sessions,
+  HLL_COUNT.INIT(session_id) AS sessions_sketch,
+  COUNTIF(event_name = 'product_added_to_cart') AS add_to_cart_events,
+  COUNTIF(event_name = 'checkout_completed') AS checkout_completed,
+  COALESCE(SUM(IF(event_name = 'checkout_completed', order_value, NULL)), 0) AS total_revenue,
+  COALESCE(SUM(IF(event_name IN ('page_scroll', 'page_viewed'), percent_scroll, NULL)), 0) AS total_scroll_sum,
+  COUNTIF(event_name IN ('page_scroll', 'page_viewed')) AS total_scroll_events,
+  MAX(event_time) AS max_event_time
+FROM
+  `{base_table_id}`
+WHERE
+  event_time > last_processed_time
+GROUP BY
+  page_url,
+  event_date;
+
+-- Check if there are new events to process
+SET new_max_event_time = (
+  SELECT MAX(max_event_time)
+  FROM `{dataset_id}.temp_aggregated_page_daily_metrics`
+);
+
+-- Create the wide, partitioned and clustered target table if it doesn't exist
+CREATE TABLE IF NOT EXISTS `{page_daily_metrics_table_id}` (
+  page_url STRING,
+  event_date DATE,
+  number_of_sessions INT64,
+  add_to_cart_events INT64,
+  checkout_completed INT64,
+  total_revenue FLOAT64,
+  total_scroll_sum FLOAT64,
+  total_scroll_events INT64,
+  sessions_sketch BYTES
+)
+PARTITION BY event_date
+CLUSTER BY page_url;
+
+-- Tables created before sessions were sketched gain the column; their existing rows keep a NULL sketch
+ALTER TABLE `{page_daily_metrics_table_id}` ADD COLUMN IF NOT EXISTS sessions_sketch BYTES;
+
+IF new_max_event_time IS NOT NULL THEN
+  -- Merge the new data with the existing data
+  MERGE `{page_daily_metrics_table_id}` T
+  USING `{dataset_id}.temp_aggregated_page_daily_metrics` S
+  ON T.page_url = S.page_url AND T.event_date = S.event_date
+  WHEN MATCHED THEN
+    UPDATE SET
+      T.number_of_sessions = {merge_session_count('T.number_of_sessions', 'S.number_of_sessions', 'T.sessions_sketch', 'S.sessions_sketch')},
+      T.sessions_sketch = {merge_sessions_sketch('T.sessions_sketch', 'S.sessions_sketch')},
+      T.add_to_cart_events = T.add_to_cart_events + S.add_to_cart_events,
+      T.checkout_completed = T.checkout_completed + S.checkout_completed,
+      T.total_revenue = T.total_revenue + S.total_revenue,
+      T.total_scroll_sum = T.total_scroll_sum + S.total_scroll_sum,
+      T.total_scroll_events = T.total_scroll_events + S.total_scroll_events
+  WHEN NOT MATCHED THEN
+    INSERT (page_url, event_date, number_of_sessions, add_to_cart_events, checkout_completed, total_revenue, total_scroll_sum, total_scroll_events, sessions_sketch)
+    VALUES (S.page_url, S.event_date, S.number_of_sessions, S.add_to_cart_events, S.checkout_completed, S.total_revenue, S.total_scroll_sum, S.total_scroll_events, S.sessions_sketch);
+
+  -- Update the last processed time in the metadata table, adding the row on the first run
+  MERGE `{dataset_id}.metadata_table` M
+  USING (SELECT 'page_daily_metrics_query' AS query_name) S
+  ON M.query_name = S.query_name
+  WHEN MATCHED THEN
+    UPDATE SET last_event_time = new_max_event_time
+  WHEN NOT MATCHED THEN
+    INSERT (query_name, last_event_time) VALUES (S.query_name, new_max_event_time);
+
+END IF;
+"""
+
+# Targets of the consolidated script. Each keeps its own watermark row in the metadata table
+# (shared with the per-query scripts above, so the two modes can be switched freely) and is
+# filled from the same scan with conditional aggregates restricted to events past its watermark.
+# Columns map to their type and aggregate over the events in `{window}`, relative to the target's
+# watermark.
+# Columns are merged by addition unless listed in `merges` (`{prefix}` stands for the target's
+# column prefix in the consolidated temp table); `added_columns` were added to the
+# table after it was first created.
+SESSIONS_MERGES = {
+    "number_of_sessions": merge_session_count("T.number_of_sessions", "S.{prefix}number_of_sessions", "T.sessions_sketch", "S.{prefix}sessions_sketch"),
+    "sessions_sketch": merge_sessions_sketch("T.sessions_sketch", "S.{prefix}sessions_sketch"),
+}
+
+# Every metric of a page, as kept per day in page_daily_metrics and per dimension value in the cube
+PAGE_METRICS_COLUMNS = {
+    "number_of_sessions": ("INT64", "COUNT(DISTINCT IF({window}, session_id, NULL))"),
+    "add_to_cart_events": ("INT64", "COUNTIF(event_name = 'product_added_to_cart' AND {window})"),
+    "checkout_completed": ("INT64", "COUNTIF(event_name = 'checkout_completed' AND {window})"),
+    "total_revenue": ("FLOAT64", "COALESCE(SUM(IF(event_name = 'checkout_completed' AND {window}, order_value, NULL)), 0)"),
+    "total_scroll_sum": ("FLOAT64", "COALESCE(SUM(IF(event_name IN ('page_scroll', 'page_viewed') AND {window}, percent_scroll, NULL)), 0)"),
+    "total_scroll_events": ("INT64", "COUNTIF(event_name IN ('page_scroll', 'page_viewed') AND {window})"),
+    "sessions_sketch": ("BYTES", "HLL_COUNT.INIT(IF({window}, session_id, NULL))"),
+}
+
+CONSOLIDATED_TARGETS = [
+    {
+        "query_name": "checkout_completed_query",
+        "table_id": checkout_completed_table_id,
+        "rows": "event_name = 'checkout_completed'",
+        "columns": {
+            "checkout_completed": ("INT64", "COUNTIF(event_name = 'checkout_completed' AND {window})"),
+        },
+    },
+    {
+        "query_name": "add_to_cart_query",
+        "table_id": add_to_cart_table_id,
+        "rows": "event_name = 'product_added_to_cart'",
+        "columns": {
+            "add_to_cart_events": ("INT64", "COUNTIF(event_name = 'product_added_to_cart' AND {window})"),
+        },
+    },
+    {
+        "query_name": "sessions_query",
+        "table_id": sessions_table_id,
+        "rows": "TRUE",
+        "columns": {
+            "number_of_sessions": ("INT64", "COUNT(DISTINCT IF({window}, session_id, NULL))"),
+            "sessions_sketch": ("BYTES", "HLL_COUNT.INIT(IF({window}, session_id, NULL))"),
+        },
+        "merges": SESSIONS_MERGES,
+        "added_columns": ["sessions_sketch"],
+    },
+    {
+        "query_name": "total_revenue_query",
+        "table_id": revenue_table_id,
+        "rows": "event_name = 'checkout_completed'",
+        "columns": {
+            "total_revenue": ("FLOAT64", "COALESCE(SUM(IF(event_name = 'checkout_completed' AND {window}, order_value, NULL)), 0)"),
+        },
+    },
+    {
+        "query_name": "scroll_query",
+        "table_id": scroll_table_id,
+        "rows": "event_name IN ('page_scroll', 'page_viewed')",
+        "columns": {
+            "total_scroll_sum": ("FLOAT64", "COALESCE(SUM(IF(event_name IN ('page_scroll', 'page_viewed') AND {window}, percent_scroll, NULL)), 0)"),
+            "total_events": ("INT64", "COUNTIF(event_name IN ('page_scroll', 'page_viewed') AND {window})"),
+        },
+    },
+    {
+        "query_name": "page_daily_metrics_query",
+        "table_id": page_daily_metrics_table_id,
+        "rows": "TRUE",
+        "columns": PAGE_METRICS_COLUMNS,
+        "merges": SESSIONS_MERGES,
+        "added_columns": ["sessions_sketch"],
+    },
+]
+
+
+def _watermark_sql(targets: list[dict]) -> tuple[list[str], list[str]]:
+    # One `since_<i>` variable per target holding its watermark
+    declares, watermarks = [], []
+    for i, target in enumerate(targets):
+        declares.append(f"DECLARE since_{i} TIMESTAMP;")
+        watermarks.append(f"""SET since_{i} = (
+  SELECT COALESCE(MAX(last_event_time), TIMESTAMP('1970-01-01'))
+  FROM `{dataset_id}.metadata_table`
+  WHERE query_name = '{target['query_name']}'
+);""")
+    return declares, watermarks
+
+
+def _aggregate_sql(i: int, target: dict, window: str) -> list[str]:
+    # `t<i>_events` counts the target's events per group; the per-metric tables only hold rows for groups that have some
+    aggregates = [f"  COUNTIF({target.get('rows', 'TRUE')} AND {window}) AS t{i}_events"]
+    for column, (_, expression) in target['columns'].items():
+        aggregates.append(f"  {expression.format(window=window)} AS t{i}_{column}")
+    return aggregates
+
+
+def _create_sql(target: dict) -> list[str]:
+    if 'dimensions' in target:
+        return _create_cube_sql(target)
+    schema = "".join(f",\n  {column} {column_type}" for column, (column_type, _) in target['columns'].items())
+    statements = [f"""CREATE TABLE IF NOT EXISTS `{target['table_id']}` (
+  page_url STRING,
+  event_date DATE{schema}
+)
+PARTITION BY event_date
+CLUSTER BY page_url;"""]
+    for column in target.get('added_columns', []):
+        statements.append(f"ALTER TABLE `{target['table_id']}` ADD COLUMN IF NOT EXISTS {column} {target['columns'][column][0]};")
+    return statements
+
+
+def _scan_sql(targets: list[dict], window: str, where: str) -> str:
+    """
+    SELECT aggregating every target per page_url and event_date from one scan of the base table
+    events matching `where`; `window` (with an {i} placeholder for the target's index) limits the
+    events each target counts. A dimension cube among `targets` adds its grouping sets to the same
+    scan, labelled with `grouping_set` ('' for the page_url and event_date rows of the others).
+    """
+    aggregates = []
+    for i, target in enumerate(targets):
+        aggregates += _aggregate_sql(i, target, window.format(i=i))
+    aggregate_columns = ",\n".join(f"  {aggregate}" for aggregate in aggregates)
+    cube = next((target for target in targets if 'dimensions' in target), None)
+    if cube is None:
+        return f"""  SELECT
+    page_url,
+    DATE(event_time) AS event_date,
+{aggregate_columns},
+    MAX(event_time) AS max_event_time
+  FROM
+    `{base_table_id}`
+  WHERE
+    {where}
+  GROUP BY
+    page_url,
+    event_date"""
+
+    dimensions = list(cube['dimensions'])
+    values = ",\n".join(f"      COALESCE({expression}, 'unknown') AS {dimension}" for dimension, expression in cube['dimensions'].items())
+    label = ", ".join(f"IF(GROUPING({dimension}) = 0, '{dimension}', NULL)" for dimension in dimensions)
+    grouping_sets = list(cube['grouping_sets'])
+    if len(targets) > 1:
+        # The page_url and event_date rows of the other targets
+        grouping_sets.insert(0, [])
+    grouping_sets_sql = ",\n".join(f"    ({', '.join(['page_url', 'event_date', *grouping_set])})" for grouping_set in grouping_sets)
+    return f"""  WITH events AS (
+    SELECT
+      page_url,
+      DATE(event_time) AS event_date,
+{values},
+      event_time,
+      event_name,
+      session_id,
+      order_value,
+      percent_scroll
+    FROM
+      `{base_table_id}`
+    WHERE
+      {where}
+  )
+  SELECT
+    page_url,
+    event_date,
+    ARRAY_TO_STRING([{label}], ',') AS grouping_set,
+    {', '.join(dimensions)},
+{aggregate_columns},
+    MAX(event_time) AS max_event_time
+  FROM
+    events
+  GROUP BY GROUPING SETS (
+{grouping_sets_sql}
+  )"""
+
+
+def _scan_rows(i: int, targets: list[dict]) -> str:
+    # Rows of the _scan_sql result that belong to target i
+    condition = f"t{i}_events > 0"
+    if 'dimensions' in targets[i]:
+        return f"grouping_set != '' AND {condition}"
+    if any('dimensions' in target for target in targets):
+        return f"grouping_set = '' AND {condition}"
+    return condition
+
+
+def _key_columns(target: dict) -> list[str]:
+    return ['page_url', 'event_date', *(['grouping_set', *target['dimensions']] if 'dimensions' in target else [])]
+
+
+def _merge_sql(i: int, targets: list[dict], temp_table_id: str) -> str:
+    # MERGE of target i's rows of the _scan_sql result in `temp_table_id` into its table. Cube rows
+    # match on their dimension values with IS NOT DISTINCT FROM, as the dimensions outside a row's
+    # grouping set are NULL.
+    target = targets[i]
+    columns = list(target['columns'])
+    merges = target.get('merges', {})
+    updates = ",\n      ".join(
+        f"T.{column} = " + (merges[column].format(prefix=f"t{i}_") if column in merges else f"T.{column} + S.t{i}_{column}")
+        for column in columns
+    )
+    keys = _key_columns(target)
+    on = "T.page_url = S.page_url AND T.event_date = S.event_date"
+    if 'dimensions' in target:
+        on += " AND T.grouping_set = S.grouping_set" + "".join(
+            f"\n    AND T.{dimension} IS NOT DISTINCT FROM S.{dimension}" for dimension in target['dimensions'])
+    return f"""  MERGE `{target['table_id']}` T
+  USING (SELECT * FROM `{temp_table_id}` WHERE {_scan_rows(i, targets)}) S
+  ON {on}
+  WHEN MATCHED THEN
+    UPDATE SET
+      {updates}
+  WHEN NOT MATCHED THEN
+    INSERT ({', '.join(keys + columns)})
+    VALUES ({', '.join([f'S.{key}' for key in keys] + [f'S.t{i}_{column}' for column in columns])});"""
+
+
+def build_consolidated_query(targets: list[dict]) -> str:
+    """
+    One script that scans the new events of the base table once, from the oldest watermark of
+    `targets`, and merges the per-target aggregates into each target table. A dimension cube among
+    `targets` is aggregated by the same scan.
+    """
+    declares, watermarks = _watermark_sql(targets)
+    creates = [statement for target in targets for statement in _create_sql(target)]
+    temp_table_id = f"{dataset_id}.temp_aggregated_consolidated"
+    merges = [_merge_sql(i, targets, temp_table_id) for i in range(len(targets))]
+    query_names = ", ".join(f"'{target['query_name']}'" for target in targets)
+    since_all = ", ".join(f"since_{i}" for i in range(len(targets)))
+    newline = "\n"
+    return f"""
+DECLARE last_processed_time TIMESTAMP;
+DECLARE new_max_event_time TIMESTAMP;
+{newline.join(declares)}
+
+-- Get the last processed time of every target
+{newline.join(watermarks)}
+SET last_processed_time = LEAST({since_all});
+
+-- Aggregate every target from a single scan of the events past the oldest watermark
+CREATE OR REPLACE TABLE `{temp_table_id}`
+PARTITION BY event_date
+CLUSTER BY page_url AS
+{_scan_sql(targets, "event_time > since_{i}", "event_time > last_processed_time")};
+
+-- Check if there are new events to process
+SET new_max_event_time = (
+  SELECT MAX(max_event_time)
+  FROM `{temp_table_id}`
+);
+
+-- Create the partitioned and clustered target tables if they don't exist
+{(newline * 2).join(creates)}
+
+IF new_max_event_time IS NOT NULL THEN
+  -- Merge the new data into each target table
+{(newline * 2).join(merges)}
+
+  -- Move every target's watermark to the new max event time
+  MERGE `{dataset_id}.metadata_table` M
+  USING (SELECT query_name FROM UNNEST([{query_names}]) AS query_name) S
+  ON M.query_name = S.query_name
+  WHEN MATCHED THEN
+    UPDATE SET last_event_time = GREATEST(M.last_event_time, new_max_event_time)
+  WHEN NOT MATCHED THEN
+    INSERT (query_name, last_event_time) VALUES (S.query_name, new_max_event_time);
+
+END IF;
+"""
+
+
+def _recompute_sql(targets: list[dict], dates: str, temp_table_id: str) -> str:
+    """
+    Statement recomputing the event_dates matching `dates` (e.g. "IN UNNEST(dirty_dates)") of every
+    target from the events up to the target's watermark `since_<i>` into `temp_table_id`, with one
+    scan of their partitions.
+    """
+    return f"""  -- Recompute every target for the dates, scanning only their partitions
+  CREATE OR REPLACE TABLE `{temp_table_id}`
+  PARTITION BY event_date
+  CLUSTER BY page_url AS
+{_scan_sql(targets, "event_time <= since_{i}", f"DATE(event_time) {dates}")};"""
+
+
+def _swap_sql(targets: list[dict], dates: str, temp_table_id: str) -> str:
+    """
+    Statements replacing the event_dates matching `dates` in every target with the rows recomputed by
+    _recompute_sql, inside a transaction the caller opens and commits.
+    """
+    swaps = []
+    for i, target in enumerate(targets):
+        keys, columns = _key_columns(target), list(target['columns'])
+        swaps.append(f"""  DELETE FROM `{target['table_id']}` WHERE event_date {dates};
+  INSERT INTO `{target['table_id']}` ({', '.join(keys + columns)})
+  SELECT {', '.join(keys + [f't{i}_{column}' for column in columns])}
+  FROM `{temp_table_id}`
+  WHERE {_scan_rows(i, targets)};""")
+    newline = "\n"
+    return (newline * 2).join(swaps)
+
+
+def build_late_events_query(targets: list[dict]) -> str:
+    """
+    One script that recomputes the base table partitions modified since its last run, which is
+    how events that arrive behind the watermarks are picked up. Each dirty event_date is rebuilt
+    from scratch in every target from the events up to the target's watermark and swapped in with
+    a DELETE + INSERT in one transaction; events after the watermark are still left to the
+    incremental scripts. Run it after them, in the same run.
+    """
+    declares, watermarks = _watermark_sql(targets)
+    creates = [statement for target in targets for statement in _create_sql(target)]
+    since_all = ", ".join(f"since_{i}" for i in range(len(targets)))
+    temp_table_id = f"{dataset_id}.temp_recomputed_partitions"
+    newline = "\n"
+    return f"""
+DECLARE checked_until TIMESTAMP;
+DECLARE new_checked_until TIMESTAMP;
+DECLARE dirty_dates ARRAY<DATE>;
+{newline.join(declares)}
+
+-- Get the last processed time of every target
+{newline.join(watermarks)}
+
+-- Get the last partition modification time already handled
+SET checked_until = (
+  SELECT MAX(last_event_time)
+  FROM `{dataset_id}.metadata_table`
+  WHERE query_name = 'late_events_query'
+);
+
+IF checked_until IS NULL THEN
+  -- First run: only partitions modified from now on are recomputed
+  SET checked_until = CURRENT_TIMESTAMP();
+  INSERT INTO `{dataset_id}.metadata_table` (query_name, last_event_time)
+  VALUES ('late_events_query', checked_until);
+END IF;
+
+-- Dates of the base table partitions modified since then. Dates after every watermark hold no
+-- aggregated events yet and are left to the incremental scripts.
+SET (dirty_dates, new_checked_until) = (
+  SELECT AS STRUCT
+    ARRAY_AGG(PARSE_DATE('%Y%m%d', partition_id)),
+    MAX(last_modified_time)
+  FROM `{dataset_id}.INFORMATION_SCHEMA.PARTITIONS`
+  WHERE table_name = '{base_table_name}'
+    AND partition_id NOT IN ('__NULL__', '__UNPARTITIONED__')
+    AND last_modified_time > checked_until
+    AND PARSE_DATE('%Y%m%d', partition_id) <= DATE(GREATEST({since_all}))
+);
+
+-- Create the partitioned and clustered target tables if they don't exist
+{(newline * 2).join(creates)}
+
+IF ARRAY_LENGTH(dirty_dates) > 0 THEN
+{_recompute_sql(targets, "IN UNNEST(dirty_dates)", temp_table_id)}
+
+  -- Swap the recomputed dates in atomically
+  BEGIN TRANSACTION;
+
+{_swap_sql(targets, "IN UNNEST(dirty_dates)", temp_table_id)}
+
+  UPDATE `{dataset_id}.metadata_table`
+  SET last_event_time = new_checked_until
+  WHERE query_name = 'late_events_query';
+
+  COMMIT TRANSACTION;
+
+END IF;
+"""
+
+
+def _backfill_temp_table_id(start_date: str, end_date: str) -> str:
+    return f"{dataset_id}.temp_backfill_{start_date.replace('-', '')}_{end_date.replace('-', '')}"
+
+
+def build_backfill_scan_query(targets: list[dict], start_date: str, end_date: str) -> str:
+    """
+    One script that recomputes the event_dates from `start_date` to `end_date` of `targets` into temp
+    tables, like the late events script does for dirty dates. Scans of disjoint ranges can run
+    concurrently; build_backfill_swap_query then writes each range.
+    """
+    declares, watermarks = _watermark_sql(targets)
+    newline = "\n"
+    return f"""
+{newline.join(declares)}
+
+-- Get the last processed time of every target; later events are left to the incremental scripts
+{newline.join(watermarks)}
+
+{_recompute_sql(targets, f"BETWEEN '{start_date}' AND '{end_date}'", _backfill_temp_table_id(start_date, end_date))}
+"""
+
+
+def build_backfill_swap_query(targets: list[dict], start_date: str, end_date: str) -> str:
+    """
+    One script that replaces the event_dates from `start_date` to `end_date` of `targets` with the
+    rows of build_backfill_scan_query, in one transaction. BigQuery aborts concurrent transactions
+    that mutate the same table, so run swaps one at a time.
+    """
+    temp_table_id = _backfill_temp_table_id(start_date, end_date)
+    return f"""
+BEGIN TRANSACTION;
+
+{_swap_sql(targets, f"BETWEEN '{start_date}' AND '{end_date}'", temp_table_id)}
+
+COMMIT TRANSACTION;
+
+DROP TABLE IF EXISTS `{temp_table_id}`;
+"""
+
+
+def build_create_tables_query(targets: list[dict]) -> str:
+    return "\n\n".join(statement for target in targets for statement in _create_sql(target))
+
+
+# Dimensions the cube can be keyed by, as expressions over the base table. Events without a value are
+# grouped as 'unknown', so a NULL dimension in the cube only means the row's grouping set leaves it out.
+DIMENSIONS = {
+    "platform": "platform",
+    "country": "country",
+    "city": "city",
+    "language": "language",
+    # Device class from the user agent; tablets first, as iPad and Android tablet user agents look like phones'
+    "device": """CASE
+      WHEN user_agent IS NULL THEN NULL
+      WHEN LOWER(user_agent) LIKE '%ipad%' OR LOWER(user_agent) LIKE '%tablet%' THEN 'tablet'
+      WHEN LOWER(user_agent) LIKE '%mobi%' OR LOWER(user_agent) LIKE '%iphone%' THEN 'mobile'
+      WHEN LOWER(user_agent) LIKE '%android%' THEN 'tablet'
+      ELSE 'desktop'
+    END""",
+}
+
+
+def build_cube_target(table_id: str, dimensions: list[str]) -> dict:
+    """
+    The dimension cube: the page metrics per page_url, event_date and value of every non-empty subset
+    (grouping set) of `dimensions`. Rows are labelled with their grouping set, the names of its
+    dimensions joined by commas in the order of `dimensions`, e.g. "platform,device".
+    """
+    unknown = [dimension for dimension in dimensions if dimension not in DIMENSIONS]
+    if unknown or not dimensions:
+        raise ValueError(f"Invalid cube dimensions {dimensions}, choose from: {', '.join(DIMENSIONS)}")
+    return {
+        "query_name": "dimension_metrics_query",
+        "table_id": table_id,
+        # Name to SQL expression, in the configured order
+        "dimensions": {dimension: DIMENSIONS[dimension] for dimension in dimensions},
+        "grouping_sets": [list(grouping_set) for size in range(1, len(dimensions) + 1)
+                          for grouping_set in combinations(dimensions, size)],
+        "columns": PAGE_METRICS_COLUMNS,
+        "merges": SESSIONS_MERGES,
+    }
+
+
+def _create_cube_sql(cube: dict) -> list[str]:
+    schema = "".join(f",\n  {column} {column_type}" for column, (column_type, _) in cube['columns'].items())
+    dimensions = "".join(f",\n  {dimension} STRING" for dimension in cube['dimensions'])
+    statements = [f"""CREATE TABLE IF NOT EXISTS `{cube['table_id']}` (
+  page_url STRING,
+  event_date DATE,
+  grouping_set STRING{dimensions}{schema}
+)
+PARTITION BY event_date
+CLUSTER BY page_url, grouping_set;"""]
+    # Dimensions added to the configuration after the table was created; their rows need a backfill
+    for dimension in cube['dimensions']:
+        statements.append(f"ALTER TABLE `{cube['table_id']}` ADD COLUMN IF NOT EXISTS {dimension} STRING;")
+    return statements
+
+
+def build_cube_query(cube: dict) -> str:
+    """
+    Script that merges the events past the cube's watermark into it, like the per-query scripts.
+    """
+    temp_table_id = f"{dataset_id}.temp_aggregated_dimension_metrics"
+    newline = "\n"
+    return f"""
+DECLARE last_processed_time TIMESTAMP;
+DECLARE new_max_event_time TIMESTAMP;
+
+-- Get the last processed time from the metadata table
+SET last_processed_time = (
+  SELECT COALESCE(MAX(last_event_time), TIMESTAMP('1970-01-01'))
+  FROM `{dataset_id}.metadata_table`
+  WHERE query_name = '{cube['query_name']}'
+);
+
+-- Aggregate every grouping set of the new events
+CREATE OR REPLACE TABLE `{temp_table_id}`
+PARTITION BY event_date
+CLUSTER BY page_url, grouping_set AS
+{_scan_sql([cube], "TRUE", "event_time > last_processed_time")};
+
+-- Check if there are new events to process
+SET new_max_event_time = (
+  SELECT MAX(max_event_time)
+  FROM `{temp_table_id}`
+);
+
+-- Create the partitioned and clustered cube table if it doesn't exist
+{(newline * 2).join(_create_cube_sql(cube))}
+
+IF new_max_event_time IS NOT NULL THEN
+{_merge_sql(0, [cube], temp_table_id)}
+
+  -- Update the last processed time in the metadata table, adding the row on the first run
+  MERGE `{dataset_id}.metadata_table` M
+  USING (SELECT '{cube['query_name']}' AS query_name) S
+  ON M.query_name = S.query_name
+  WHEN MATCHED THEN
+    UPDATE SET last_event_time = new_max_event_time
+  WHEN NOT MATCHED THEN
+    INSERT (query_name, last_event_time) VALUES (S.query_name, new_max_event_time);
+
+END IF;
+"""
+
+
+CUBE_TARGET = build_cube_target(dimension_metrics_table_id, cube_dimensions)
+
+
+# Columns of the rollups of page_daily_metrics, aggregated from the daily rows of each period. A period
+# with a day written before sessions were sketched gets no sketch and sums the daily session counts,
+# like the metrics endpoints do over such days.
+ROLLUP_COLUMNS = {
+    "number_of_sessions": ("INT64", "IF(COUNTIF(sessions_sketch IS NULL) = 0, HLL_COUNT.EXTRACT(HLL_COUNT.MERGE_PARTIAL(sessions_sketch)), SUM(number_of_sessions))"),
+    "add_to_cart_events": ("INT64", "SUM(add_to_cart_events)"),
+    "checkout_completed": ("INT64", "SUM(checkout_completed)"),
+    "total_revenue": ("FLOAT64", "SUM(total_revenue)"),
+    "total_scroll_sum": ("FLOAT64", "SUM(total_scroll_sum)"),
+    "total_scroll_events": ("INT64", "SUM(total_scroll_events)"),
+    "sessions_sketch": ("BYTES", "IF(COUNTIF(sessions_sketch IS NULL) = 0, HLL_COUNT.MERGE_PARTIAL(sessions_sketch), NULL)"),
+}
+
+# One row per (page_url, period_start), period_start being the first day of the ISO week or month
+ROLLUP_TARGETS = [
+    {"granularity": "week", "table_id": page_weekly_metrics_table_id, "period": "ISOWEEK", "length": "INTERVAL 1 WEEK", "columns": ROLLUP_COLUMNS},
+    {"granularity": "month", "table_id": page_monthly_metrics_table_id, "period": "MONTH", "length": "INTERVAL 1 MONTH", "columns": ROLLUP_COLUMNS},
+]
+
+
+def _create_rollup_sql(rollup: dict) -> str:
+    schema = "".join(f",\n  {column} {column_type}" for column, (column_type, _) in rollup['columns'].items())
+    return f"""CREATE TABLE IF NOT EXISTS `{rollup['table_id']}` (
+  page_url STRING,
+  period_start DATE{schema}
+)
+PARTITION BY period_start
+CLUSTER BY page_url;"""
+
+
+def build_rollups_query(rollups: list[dict]) -> str:
+    """
+    One script that rebuilds the periods of `rollups` containing a page_daily_metrics partition
+    modified since its last run, from the daily rows of those periods, and swaps them in with a
+    DELETE + INSERT in one transaction. Its first run rolls up every partition. Run it after the
+    scripts that write page_daily_metrics, in the same run.
+    """
+    creates = [_create_rollup_sql(rollup) for rollup in rollups]
+    rebuilds = []
+    for rollup in rollups:
+        period = rollup['period']
+        columns = list(rollup['columns'])
+        aggregates = ",\n".join(f"    {expression} AS {column}" for column, (_, expression) in rollup['columns'].items())
+        rebuilds.append(f"""  -- Every day of the {rollup['granularity']}s containing a modified date
+  SET period_starts = ARRAY(SELECT DISTINCT DATE_TRUNC(dirty_date, {period}) FROM UNNEST(dirty_dates) AS dirty_date);
+  SET period_dates = ARRAY(
+    SELECT day
+    FROM UNNEST(period_starts) AS period_start,
+      UNNEST(GENERATE_DATE_ARRAY(period_start, DATE_SUB(DATE_ADD(period_start, {rollup['length']}), INTERVAL 1 DAY))) AS day
+  );
+
+  DELETE FROM `{rollup['table_id']}` WHERE period_start IN UNNEST(period_starts);
+  INSERT INTO `{rollup['table_id']}` (page_url, period_start, {', '.join(columns)})
+  SELECT
+    page_url,
+    DATE_TRUNC(event_date, {period}) AS period_start,
+{aggregates}
+  FROM
+    `{page_daily_metrics_table_id}`
+  WHERE
+    event_date IN UNNEST(period_dates)
+  GROUP BY
+    page_url,
+    period_start;""")
+
+    newline = "\n"
+    return f"""
+DECLARE checked_until TIMESTAMP;
+DECLARE new_checked_until TIMESTAMP;
+DECLARE dirty_dates ARRAY<DATE>;
+DECLARE period_starts ARRAY<DATE>;
+DECLARE period_dates ARRAY<DATE>;
+
+-- Get the last daily partition modification time already rolled up
+SET checked_until = (
+  SELECT COALESCE(MAX(last_event_time), TIMESTAMP('1970-01-01'))
+  FROM `{dataset_id}.metadata_table`
+  WHERE query_name = 'rollups_query'
+);
+
+-- Dates of the page_daily_metrics partitions modified since then
+SET (dirty_dates, new_checked_until) = (
+  SELECT AS STRUCT
+    ARRAY_AGG(PARSE_DATE('%Y%m%d', partition_id)),
+    MAX(last_modified_time)
+  FROM `{dataset_id}.INFORMATION_SCHEMA.PARTITIONS`
+  WHERE table_name = '{page_daily_metrics_table_name}'
+    AND partition_id NOT IN ('__NULL__', '__UNPARTITIONED__')
+    AND last_modified_time > checked_until
+);
+
+-- Create the partitioned and clustered rollup tables if they don't exist
+{(newline * 2).join(creates)}
+
+IF ARRAY_LENGTH(dirty_dates) > 0 THEN
+  -- Swap the recomputed periods in atomically
+  BEGIN TRANSACTION;
+
+{(newline * 2).join(rebuilds)}
+
+  MERGE `{dataset_id}.metadata_table` M
+  USING (SELECT 'rollups_query' AS query_name) S
+  ON M.query_name = S.query_name
+  WHEN MATCHED THEN
+    UPDATE SET last_event_time = new_checked_until
+  WHEN NOT MATCHED THEN
+    INSERT (query_name, last_event_time) VALUES (S.query_name, new_checked_until);
+
+  COMMIT TRANSACTION;
+
+END IF;
+"""
+
+
+consolidated_query = build_consolidated_query(CONSOLIDATED_TARGETS + ([CUBE_TARGET] if maintain_cube else []))
+dimension_metrics_query = build_cube_query(CUBE_TARGET)
+late_events_query = build_late_events_query(CONSOLIDATED_TARGETS + ([CUBE_TARGET] if maintain_cube else []))
+rollups_query = build_rollups_query(ROLLUP_TARGETS)
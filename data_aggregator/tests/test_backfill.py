@@ -0,0 +1,103 @@
+import asyncio
+import threading
+import pytest
+from datetime import date, datetime, timezone
+import backfill
+from backfill import Checkpoint, run_chunk, split_range, with_retries
+from coordinator import RunCoordinator
+
+
+def test_split_range_into_chunks():
+    assert split_range(date(2024, 1, 1), date(2024, 1, 10), 4) == [
+        (date(2024, 1, 1), date(2024, 1, 4)),
+        (date(2024, 1, 5), date(2024, 1, 8)),
+        (date(2024, 1, 9), date(2024, 1, 10)),
+    ]
+    assert split_range(date(2024, 2, 27), date(2024, 3, 4), 7) == [(date(2024, 2, 27), date(2024, 3, 4))]
+    assert split_range(date(2024, 1, 1), date(2024, 1, 1), 7) == [(date(2024, 1, 1), date(2024, 1, 1))]
+    assert split_range(date(2024, 1, 2), date(2024, 1, 1), 7) == []
+
+
+def test_checkpoint_resumes_the_same_backfill(tmp_path):
+    path = str(tmp_path / "checkpoint.json")
+    job = {"start": "2024-01-01", "end": "2024-01-31", "metrics": ["sessions"], "chunk_days": 7}
+    Checkpoint(path, job).mark_done(date(2024, 1, 8))
+
+    checkpoint = Checkpoint(path, job)
+    assert checkpoint.done(date(2024, 1, 8))
+    assert not checkpoint.done(date(2024, 1, 1))
+    assert not Checkpoint(path, job, restart=True).done(date(2024, 1, 8))
+    with pytest.raises(SystemExit):
+        Checkpoint(path, {**job, "chunk_days": 14})
+
+
+def test_with_retries_retries_then_raises(monkeypatch):
+    monkeypatch.setattr(backfill.time, 'sleep', lambda seconds: None)
+    chunk = (date(2024, 1, 1), date(2024, 1, 7))
+    attempts = []
+
+    def flaky(targets, start, end):
+        attempts.append((start, end))
+        if len(attempts) < 3:
+            raise RuntimeError("backendError")
+        return 100
+
+    assert with_retries(flaky, [], chunk, retries=2) == 100
+    assert attempts == [chunk] * 3
+
+    def failing(targets, start, end):
+        attempts.append((start, end))
+        raise RuntimeError("invalidQuery")
+
+    attempts.clear()
+    with pytest.raises(RuntimeError, match="invalidQuery"):
+        with_retries(failing, [], chunk, retries=1)
+    assert attempts == [chunk] * 2
+
+
+def test_swaps_run_one_at_a_time(monkeypatch):
+    running, overlaps = 0, []
+    lock = threading.Lock()
+
+    def swap(targets, start, end):
+        nonlocal running
+        with lock:
+            running += 1
+            overlaps.append(running)
+        threading.Event().wait(0.01)
+        with lock:
+            running -= 1
+        return 1
+
+    monkeypatch.setattr(backfill, 'scan_range', lambda targets, start, end: 10)
+    monkeypatch.setattr(backfill, 'swap_range', swap)
+    chunks = split_range(date(2024, 1, 1), date(2024, 1, 28), 7)
+    threads = [threading.Thread(target=run_chunk, args=([], chunk, 0)) for chunk in chunks]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(overlaps) == len(chunks)
+    assert max(overlaps) == 1
+
+
+def test_paused_aggregator_skips_runs():
+    async def run():
+        runs = []
+
+        async def aggregate():
+            runs.append(1)
+            return []
+
+        now = datetime.now(timezone.utc)
+        coordinator = RunCoordinator(aggregate, lambda: (None, now, 0))
+        await coordinator.pause(60)
+        await coordinator.tick()
+        assert runs == [] and coordinator.skipped_paused == 1
+        assert coordinator.status()["paused_s"] > 0
+
+        coordinator.resume()
+        await coordinator.tick()
+        assert runs == [1]
+
+    asyncio.run(run())
@@ -0,0 +1,147 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from coordinator import RunCoordinator
+
+WATERMARK = datetime(2024, 3, 1, 12, 0, tzinfo=timezone.utc)
+
+
+class Backlog:
+    """
+    measure_backlog stand-in: the aggregation watermark, the latest event time and late partitions.
+    """
+
+    def __init__(self):
+        self.watermark = WATERMARK
+        self.latest_event_time = WATERMARK
+        self.late_partitions = 0
+
+    def __call__(self):
+        return self.watermark, self.latest_event_time, self.late_partitions
+
+
+def make_coordinator(backlog: Backlog, runs: list, **kwargs) -> RunCoordinator:
+    async def run():
+        runs.append(backlog.latest_event_time)
+        return [{"name": "sessions_query", "rows_merged": 3}]
+
+    return RunCoordinator(run, backlog, **kwargs)
+
+
+def test_a_tick_during_a_run_is_skipped():
+    async def run():
+        started, release = asyncio.Event(), asyncio.Event()
+        runs = []
+
+        async def slow_run():
+            runs.append(1)
+            started.set()
+            await release.wait()
+            return []
+
+        backlog = Backlog()
+        backlog.latest_event_time = WATERMARK + timedelta(minutes=1)
+        coordinator = RunCoordinator(slow_run, backlog)
+        first = asyncio.create_task(coordinator.tick())
+        await started.wait()
+        assert coordinator.status()["running"]
+
+        await coordinator.tick()
+        assert coordinator.skipped_overlapping == 1
+        release.set()
+        await first
+        assert runs == [1]
+        assert coordinator.runs == 1
+
+    asyncio.run(run())
+
+
+def test_idle_ticks_back_off_up_to_the_max_interval():
+    async def run():
+        runs = []
+        coordinator = make_coordinator(Backlog(), runs, min_interval=60, max_interval=200)
+        intervals = []
+        for _ in range(4):
+            await coordinator.tick()
+            intervals.append(coordinator.interval)
+        assert intervals == [120, 200, 200, 200]
+        assert runs == [] and coordinator.idle_ticks == 4
+
+    asyncio.run(run())
+
+
+def test_new_events_bring_the_interval_back_to_the_min():
+    async def run():
+        backlog, runs = Backlog(), []
+        coordinator = make_coordinator(backlog, runs, min_interval=60, max_interval=900)
+        await coordinator.tick()
+        await coordinator.tick()
+        assert coordinator.interval == 240
+
+        backlog.latest_event_time = WATERMARK + timedelta(minutes=5)
+        await coordinator.tick()
+        assert runs == [backlog.latest_event_time]
+        assert coordinator.interval == 60
+        # The watermark advances to the event time measured before the run
+        assert coordinator.watermark == backlog.latest_event_time
+        assert coordinator.backlog_seconds() == 0
+        assert coordinator.status()["queries"]["sessions_query"]["total_rows_merged"] == 3
+
+    asyncio.run(run())
+
+
+def test_late_partitions_trigger_a_run():
+    async def run():
+        backlog, runs = Backlog(), []
+        backlog.late_partitions = 2
+        coordinator = make_coordinator(backlog, runs, min_interval=60, max_interval=900)
+        await coordinator.tick()
+        assert len(runs) == 1
+        assert coordinator.late_partitions == 0
+
+    asyncio.run(run())
+
+
+def test_first_run_without_a_watermark():
+    async def run():
+        backlog, runs = Backlog(), []
+        backlog.watermark = None
+        coordinator = make_coordinator(backlog, runs)
+        assert coordinator.backlog_seconds() is None
+        await coordinator.tick()
+        assert len(runs) == 1
+        assert coordinator.watermark == backlog.latest_event_time
+
+    asyncio.run(run())
+
+
+def test_runs_anyway_when_the_backlog_cannot_be_measured():
+    async def run():
+        runs = []
+
+        def failing_backlog():
+            raise RuntimeError("metadata table unavailable")
+
+        coordinator = make_coordinator(Backlog(), runs)
+        coordinator.measure_backlog = failing_backlog
+        await coordinator.tick()
+        assert len(runs) == 1
+
+    asyncio.run(run())
+
+
+def test_failed_runs_are_counted_and_release_the_lock():
+    async def run():
+        async def failing_run():
+            raise RuntimeError("script failed")
+
+        backlog = Backlog()
+        backlog.latest_event_time = WATERMARK + timedelta(minutes=1)
+        coordinator = RunCoordinator(failing_run, backlog, min_interval=60)
+        await coordinator.tick()
+        await coordinator.tick()
+        assert coordinator.failures == 2
+        assert coordinator.runs == 0
+        assert coordinator.watermark == WATERMARK
+        assert not coordinator.status()["running"]
+
+    asyncio.run(run())
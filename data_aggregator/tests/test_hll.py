@@ -0,0 +1,51 @@
+import pytest
+from common import hll
+from common.hll import HyperLogLog
+
+
+def sessions(start: int, end: int) -> list[str]:
+    return [f"sess-{i}" for i in range(start, end)]
+
+
+def test_merge_partial_equals_the_sketch_of_the_union():
+    days = [sessions(0, 1000), sessions(500, 1500), sessions(1400, 3000)]
+    merged = hll.merge_partial(hll.init(day) for day in days)
+    assert merged == hll.init(sessions(0, 3000))
+
+
+def test_sessions_spanning_days_are_counted_once():
+    days = [sessions(0, 6000), sessions(4000, 10_000)]
+    assert sum(hll.extract(hll.init(day)) for day in days) == pytest.approx(12_000, rel=0.02)
+    assert hll.merge(hll.init(day) for day in days) == pytest.approx(10_000, rel=0.02)
+
+
+def test_merge_partial_of_many_sketches():
+    # More sketches than merged per pass
+    sketches = [hll.init(sessions(i * 10, i * 10 + 20)) for i in range(hll.MERGE_BATCH * 2 + 3)]
+    assert hll.merge_partial(sketches) == hll.init(sessions(0, (hll.MERGE_BATCH * 2 + 3) * 10 + 10))
+
+
+def test_small_counts_are_exact():
+    assert hll.extract(hll.init(["s1", "s2", "s2", "s3", None])) == 3
+
+
+def test_nulls_are_ignored():
+    assert hll.merge_partial([None, None]) is None
+    assert hll.merge([]) == 0
+    sketch = hll.init(sessions(0, 10))
+    assert hll.merge_partial([None, sketch, None]) == sketch
+
+
+def test_in_place_merge_matches_merge_partial():
+    a, b = HyperLogLog().update(sessions(0, 100)), HyperLogLog().update(sessions(50, 200))
+    assert a.merge(b).to_bytes() == hll.merge_partial([hll.init(sessions(0, 100)), hll.init(sessions(50, 200))])
+    assert HyperLogLog.from_bytes(a.to_bytes()).count() == a.count()
+
+
+def test_sketches_of_different_precision_do_not_merge():
+    with pytest.raises(ValueError):
+        hll.merge_partial([hll.init(["s1"], precision=12), hll.init(["s1"], precision=14)])
+    with pytest.raises(ValueError):
+        HyperLogLog(12).merge(HyperLogLog(14))
+    with pytest.raises(ValueError):
+        HyperLogLog(3)
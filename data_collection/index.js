@@ -28,31 +28,95 @@ async function getSessionId(browser) {
   return sessionId;
 }
 
+// Events are queued and sent to the batch endpoint to cut down on requests per page view
+const BATCH_URL = `${BACKEND_URL}/batch`;
+const MAX_BATCH_SIZE = 20;
+const FLUSH_INTERVAL_MS = 2000;
+
+let eventQueue = [];
+let flushTimer = null;
+let pixelBrowser = null;
+
 /**
- * Send an event payload to the backend server.
- * @param {object} payload - The event payload to send.
+ * Send a batch of events to the backend server.
+ * Bodies are sent as text/plain so the request does not need a CORS preflight.
+ * @param {object[]} events - The event payloads to send.
+ * @param {boolean} useBeacon - Whether to send with sendBeacon (used when the page is being hidden).
  */
-async function sendEvent(payload) {
+async function sendBatch(events, useBeacon = false) {
+  const body = events.map((event) => JSON.stringify(event)).join("\n");
+
   try {
-    const response = await fetch(BACKEND_URL, {
+    if (useBeacon && pixelBrowser && pixelBrowser.sendBeacon) {
+      const queued = await pixelBrowser.sendBeacon(BATCH_URL, body);
+      if (queued) {
+        return;
+      }
+    }
+
+    const response = await fetch(BATCH_URL, {
       method: "POST",
       headers: {
-        "Content-Type": "application/json",
+        "Content-Type": "text/plain",
       },
-      body: JSON.stringify(payload),
+      body,
       keepalive: true,
     });
 
     if (!response.ok) {
-      throw new Error("Failed to send event to server.");
+      throw new Error("Failed to send events to server.");
     }
 
-    console.log("Event sent successfully:", payload);
+    console.log(`${events.length} events sent successfully`);
   } catch (error) {
-    console.error("Error sending event:", error);
+    console.error("Error sending events:", error);
+  }
+}
+
+/**
+ * Flush all queued events.
+ * @param {boolean} useBeacon - Whether to send with sendBeacon.
+ */
+async function flushEvents(useBeacon = false) {
+  if (flushTimer) {
+    clearTimeout(flushTimer);
+    flushTimer = null;
+  }
+  if (eventQueue.length === 0) {
+    return;
+  }
+
+  const events = eventQueue;
+  eventQueue = [];
+  await sendBatch(events, useBeacon);
+}
+
+/**
+ * Queue an event payload, flushing when the batch is full or the flush interval elapses.
+ * @param {object} payload - The event payload to send.
+ */
+async function sendEvent(payload) {
+  eventQueue.push(payload);
+
+  if (eventQueue.length >= MAX_BATCH_SIZE || payload.event_name === "checkout_completed") {
+    await flushEvents();
+  } else if (!flushTimer) {
+    flushTimer = setTimeout(() => flushEvents(), FLUSH_INTERVAL_MS);
   }
 }
 
+// Flush whatever is left when the page is hidden or unloaded
+if (typeof document !== "undefined") {
+  document.addEventListener("visibilitychange", () => {
+    if (document.visibilityState === "hidden") {
+      flushEvents(true);
+    }
+  });
+}
+if (typeof self !== "undefined" && self.addEventListener) {
+  self.addEventListener("pagehide", () => flushEvents(true));
+}
+
 /**
  * Transform and send an event to the backend server.
  * @param {object} event - The event object to transform and send.
@@ -78,6 +142,8 @@ async function handleEvent(event, sessionId, platform, additionalData = {}) {
 }
 
 register(async ({ analytics, browser }) => {
+  pixelBrowser = browser;
+
   analytics.subscribe("page_scroll", async (event) => {
     const sessionId = await getSessionId(browser);
     const platform = isMobile(event.context.navigator.userAgent)
@@ -0,0 +1,63 @@
+"""
+Generate synthetic events in bounded-memory chunks and write them to a file or BigQuery.
+
+Usage: python generate.py --events 1000000 --output events.ndjson [--seed 7]
+       python generate.py --events 1000000 --output events.parquet
+       python generate.py --events 10000000 --bigquery [--chunk-events 500000]
+
+NDJSON output is appended to, so it can feed the aggregator's local backend (`backend.base_files`).
+Parquet needs pyarrow. --bigquery loads into the table in config.json with one load job per chunk.
+"""
+import argparse
+import logging
+import time
+from datetime import datetime
+from generator import EventGenerator, GeneratorConfig, load_bigquery, write_ndjson, write_parquet
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def main():
+    defaults = GeneratorConfig()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, required=True)
+    parser.add_argument("--chunk-events", type=int, default=200000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="an .ndjson or .parquet file")
+    parser.add_argument("--bigquery", action="store_true", help="load into the base table instead of a file")
+    parser.add_argument("--pages", type=int, default=defaults.pages)
+    parser.add_argument("--zipf-s", type=float, default=defaults.zipf_s)
+    parser.add_argument("--users", type=int, default=defaults.users)
+    parser.add_argument("--mean-page-views", type=float, default=defaults.mean_page_views)
+    parser.add_argument("--scroll-rate", type=float, default=defaults.scroll_rate)
+    parser.add_argument("--add-to-cart-rate", type=float, default=defaults.add_to_cart_rate)
+    parser.add_argument("--checkout-rate", type=float, default=defaults.checkout_rate)
+    parser.add_argument("--days", type=int, default=defaults.days)
+    parser.add_argument("--end", type=datetime.fromisoformat, help="latest session start, now by default")
+    args = parser.parse_args()
+    if bool(args.output) == args.bigquery:
+        parser.error("pass exactly one of --output or --bigquery")
+    if args.days < 1 or args.pages < 1 or args.users < 1:
+        parser.error("--days, --pages and --users must be at least 1")
+
+    config = GeneratorConfig(pages=args.pages, zipf_s=args.zipf_s, users=args.users, mean_page_views=args.mean_page_views,
+                             scroll_rate=args.scroll_rate, add_to_cart_rate=args.add_to_cart_rate,
+                             checkout_rate=args.checkout_rate, days=args.days, end=args.end)
+    chunks = EventGenerator(config, seed=args.seed).chunks(args.events, args.chunk_events)
+
+    started = time.perf_counter()
+    if args.bigquery:
+        # Imported here so file output works without credentials
+        from utils import client, dataset_id, table_id
+        written = load_bigquery(chunks, client, f"{client.project}.{dataset_id}.{table_id}")
+    elif args.output.endswith(".parquet"):
+        written = write_parquet(chunks, args.output)
+    else:
+        written = write_ndjson(chunks, args.output)
+    elapsed = time.perf_counter() - started
+    logger.info(f"Generated {written} events in {elapsed:.1f}s ({written / elapsed:.0f} events/s)")
+
+
+if __name__ == "__main__":
+    main()
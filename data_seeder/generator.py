@@ -0,0 +1,252 @@
+import io
+import json
+import logging
+import math
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Iterator
+import numpy as np
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Columns of the base table written by the generator, in schema order
+COLUMNS = [
+    "platform", "event_time", "event_name", "event_id", "user_id", "session_id", "page_url", "order_id",
+    "order_value", "city", "country", "user_agent", "language", "currency", "user_email", "percent_scroll",
+    "product_id", "product_price", "page_title",
+]
+
+USER_AGENTS = {
+    "web": np.array([
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36",
+        "Mozilla/5.0 (Macintosh; Intel Mac OS X 14_4) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.4 Safari/605.1.15",
+        "Mozilla/5.0 (X11; Linux x86_64; rv:125.0) Gecko/20100101 Firefox/125.0",
+    ], dtype=object),
+    "mobile": np.array([
+        "Mozilla/5.0 (iPhone; CPU iPhone OS 17_4 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148",
+        "Mozilla/5.0 (Linux; Android 14; Pixel 8) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Mobile Safari/537.36",
+    ], dtype=object),
+}
+LOCATIONS = np.array([
+    ("San Francisco", "USA"), ("New York", "USA"), ("London", "UK"), ("Berlin", "Germany"),
+    ("Bangalore", "India"), ("Toronto", "Canada"), ("Sydney", "Australia"),
+], dtype=object)
+
+
+@dataclass
+class GeneratorConfig:
+    pages: int = 1000
+    # Exponent of the Zipf distribution of page popularity; larger concentrates traffic on fewer pages
+    zipf_s: float = 1.1
+    users: int = 100000
+    mean_page_views: float = 4.0
+    mobile_share: float = 0.6
+    # Funnel: a page view is scrolled, a scrolled page adds to cart, an add to cart checks out
+    scroll_rate: float = 0.6
+    add_to_cart_rate: float = 0.15
+    checkout_rate: float = 0.3
+    # Sessions are spread over the `days` before `end` (now by default), peaking at `peak_hour` UTC
+    days: int = 45
+    end: datetime | None = None
+    peak_hour: float = 20.0
+    diurnal_amplitude: float = 0.6
+
+
+class EventGenerator:
+    """
+    Synthetic storefront events generated with NumPy in columnar chunks.
+
+    Sessions pick their pages from a Zipf distribution and start at a time drawn from a daily cycle.
+    Every page view may continue down the funnel: page_viewed, then page_scroll, then
+    product_added_to_cart, then checkout_completed, each step a few seconds to minutes after the
+    previous one. A chunk is a dict of column name to array, with None for missing values. Output
+    only depends on the seed and the config.
+    """
+
+    def __init__(self, config: GeneratorConfig | None = None, seed: int = 0):
+        self.config = config or GeneratorConfig()
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+        self.sessions_generated = 0
+
+        ranks = np.arange(1, self.config.pages + 1, dtype=np.float64)
+        self.page_cdf = np.cumsum(ranks ** -self.config.zipf_s)
+        self.page_cdf /= self.page_cdf[-1]
+        self.page_urls = np.array([f"https://example-{page}.com" for page in range(self.config.pages)], dtype=object)
+
+        hours = np.arange(24)
+        hour_weights = 1 + self.config.diurnal_amplitude * np.cos(2 * np.pi * (hours - self.config.peak_hour) / 24)
+        self.hour_cdf = np.cumsum(hour_weights) / hour_weights.sum()
+
+        end = self.config.end or datetime.now(timezone.utc)
+        end = end.astimezone(timezone.utc).replace(tzinfo=None) if end.tzinfo else end
+        self.first_day = np.datetime64((end - timedelta(days=self.config.days)).date(), 'us')
+
+    def events_per_session(self) -> float:
+        config = self.config
+        funnel = 1 + config.scroll_rate * (1 + config.add_to_cart_rate * (1 + config.checkout_rate))
+        return config.mean_page_views * funnel
+
+    def _ids(self, prefix: str, size: int) -> np.ndarray:
+        return np.char.add(prefix, np.char.mod('%016x', self.rng.integers(0, 2 ** 63, size=size))).astype(object)
+
+    def generate(self, sessions: int) -> dict[str, np.ndarray]:
+        config = self.config
+        rng = self.rng
+
+        # Sessions
+        session_ids = np.char.add(f"sess-{self.seed}-", (np.arange(sessions) + self.sessions_generated).astype(str)).astype(object)
+        self.sessions_generated += sessions
+        user_ids = np.char.add("usr-", rng.integers(0, config.users, size=sessions).astype(str)).astype(object)
+        mobile = rng.random(sessions) < config.mobile_share
+        days = rng.integers(0, config.days, size=sessions)
+        hours = np.searchsorted(self.hour_cdf, rng.random(sessions))
+        offsets_us = ((days * 24 + hours) * 3600 + rng.random(sessions) * 3600) * 1e6
+        session_starts = self.first_day + offsets_us.astype('timedelta64[us]')
+
+        # Page views: a geometric number per session, seconds to minutes apart
+        views_per_session = rng.geometric(1 / config.mean_page_views, size=sessions)
+        session_of_view = np.repeat(np.arange(sessions), views_per_session)
+        views = len(session_of_view)
+        gaps_us = rng.exponential(60e6, size=views)
+        # Restart the running gap sum at every session
+        cumulative = np.cumsum(gaps_us)
+        first_view = np.concatenate(([0], np.cumsum(views_per_session)[:-1]))
+        cumulative -= np.repeat(cumulative[first_view] - gaps_us[first_view], views_per_session)
+        view_times = session_starts[session_of_view] + cumulative.astype('timedelta64[us]')
+        view_pages = np.searchsorted(self.page_cdf, rng.random(views))
+
+        # Funnel steps
+        scrolled = rng.random(views) < config.scroll_rate
+        carted = scrolled & (rng.random(views) < config.add_to_cart_rate)
+        checked_out = carted & (rng.random(views) < config.checkout_rate)
+        scroll_times = view_times + rng.uniform(5e6, 30e6, size=views).astype('timedelta64[us]')
+        cart_times = scroll_times + rng.uniform(10e6, 60e6, size=views).astype('timedelta64[us]')
+        checkout_times = cart_times + rng.uniform(60e6, 300e6, size=views).astype('timedelta64[us]')
+
+        steps = [
+            ("page_viewed", np.ones(views, dtype=bool), view_times),
+            ("page_scroll", scrolled, scroll_times),
+            ("product_added_to_cart", carted, cart_times),
+            ("checkout_completed", checked_out, checkout_times),
+        ]
+        view_index = np.concatenate([np.flatnonzero(mask) for _, mask, _ in steps])
+        event_names = np.concatenate([np.full(mask.sum(), name, dtype=object) for name, mask, _ in steps])
+        event_times = np.concatenate([times[mask] for _, mask, times in steps])
+        # Events of a session together and in time order, so a truncated chunk keeps whole funnels
+        order = np.lexsort((event_times, session_of_view[view_index]))
+        view_index, event_names, event_times = view_index[order], event_names[order], event_times[order]
+        size = len(view_index)
+        session_index = session_of_view[view_index]
+
+        chunk = {column: np.full(size, None, dtype=object) for column in COLUMNS}
+        chunk["platform"] = np.where(mobile[session_index], "mobile", "web").astype(object)
+        chunk["event_time"] = np.char.add(np.datetime_as_string(event_times, unit='us'), 'Z').astype(object)
+        chunk["event_name"] = event_names
+        chunk["event_id"] = self._ids("evt-", size)
+        chunk["user_id"] = user_ids[session_index]
+        chunk["session_id"] = session_ids[session_index]
+        chunk["page_url"] = self.page_urls[view_pages[view_index]]
+        chunk["language"] = np.full(size, "en-US", dtype=object)
+        for platform, agents in USER_AGENTS.items():
+            rows = chunk["platform"] == platform
+            chunk["user_agent"][rows] = agents[rng.integers(0, len(agents), size=rows.sum())]
+
+        scroll = event_names == "page_scroll"
+        chunk["percent_scroll"][scroll] = rng.integers(10, 101, size=scroll.sum()).astype(object)
+        chunk["page_title"][scroll] = "Example Page"
+
+        cart = event_names == "product_added_to_cart"
+        chunk["product_id"][cart] = self._ids("prod-", cart.sum())
+        chunk["product_price"][cart] = np.round(rng.uniform(1, 100, size=cart.sum()), 2).astype(object)
+        chunk["currency"][cart] = "USD"
+
+        checkout = event_names == "checkout_completed"
+        checkouts = checkout.sum()
+        locations = LOCATIONS[rng.integers(0, len(LOCATIONS), size=checkouts)]
+        chunk["order_id"][checkout] = self._ids("ord-", checkouts)
+        chunk["order_value"][checkout] = np.round(rng.lognormal(math.log(60), 0.6, size=checkouts), 2).astype(object)
+        chunk["city"][checkout] = locations[:, 0]
+        chunk["country"][checkout] = locations[:, 1]
+        chunk["currency"][checkout] = "USD"
+        chunk["user_email"][checkout] = np.char.add(chunk["user_id"][checkout].astype(str), "@example.com").astype(object)
+        return chunk
+
+    def chunks(self, events: int, chunk_events: int = 200000) -> Iterator[dict[str, np.ndarray]]:
+        """
+        Chunks of about `chunk_events` events (a session never spans two), `events` in total.
+        """
+        sessions_per_chunk = max(1, round(chunk_events / self.events_per_session()))
+        remaining = events
+        while remaining > 0:
+            chunk = self.generate(sessions_per_chunk)
+            size = len(chunk["event_id"])
+            if size > remaining:
+                chunk = {column: values[:remaining] for column, values in chunk.items()}
+                size = remaining
+            remaining -= size
+            yield chunk
+
+
+def chunk_rows(chunk: dict[str, np.ndarray]) -> list[dict]:
+    """
+    Row dicts of a chunk, without the missing values.
+    """
+    columns = list(chunk)
+    return [{column: value for column, value in zip(columns, values) if value is not None}
+            for values in zip(*(chunk[column].tolist() for column in columns))]
+
+
+def to_ndjson(chunk: dict[str, np.ndarray]) -> bytes:
+    return "".join(json.dumps(row) + "\n" for row in chunk_rows(chunk)).encode()
+
+
+def write_ndjson(chunks: Iterator[dict[str, np.ndarray]], path: str) -> int:
+    written = 0
+    with open(path, 'ab') as f:
+        for chunk in chunks:
+            f.write(to_ndjson(chunk))
+            written += len(chunk["event_id"])
+            logger.info(f"Wrote {written} events to {path}")
+    return written
+
+
+def write_parquet(chunks: Iterator[dict[str, np.ndarray]], path: str) -> int:
+    # pyarrow is only needed for Parquet output
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        (column, pa.timestamp('us', tz='UTC') if column == "event_time"
+         else pa.float64() if column in ("order_value", "percent_scroll", "product_price") else pa.string())
+        for column in COLUMNS
+    ])
+    written = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        for chunk in chunks:
+            columns = {column: chunk[column].tolist() for column in COLUMNS}
+            columns["event_time"] = [datetime.fromisoformat(value.replace('Z', '+00:00')) for value in columns["event_time"]]
+            writer.write_table(pa.table(columns, schema=schema))
+            written += len(chunk["event_id"])
+            logger.info(f"Wrote {written} events to {path}")
+    return written
+
+
+def load_bigquery(chunks: Iterator[dict[str, np.ndarray]], client, table_id: str) -> int:
+    """
+    Append the chunks to a BigQuery table with one load job each. Load jobs are free, unlike
+    streaming inserts, but count against the daily per-table quota, so keep chunks large.
+    """
+    from google.cloud import bigquery
+
+    job_config = bigquery.LoadJobConfig(
+        source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+        write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+    )
+    written = 0
+    for chunk in chunks:
+        client.load_table_from_file(io.BytesIO(to_ndjson(chunk)), table_id, job_config=job_config).result()
+        written += len(chunk["event_id"])
+        logger.info(f"Loaded {written} events into {table_id}")
+    return written
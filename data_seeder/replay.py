@@ -0,0 +1,313 @@
+"""
+Send recorded or generated events to the ingestion service over HTTP, open loop.
+
+Events are sent on a fixed schedule, whether or not earlier requests have returned, so a slow
+server shows up as latency and errors instead of as a lower request rate. Latency is measured
+from each request's scheduled time, including any time it waited for a connection. Throughput,
+errors and latency percentiles are printed every --report-interval seconds, and the totals at the end.
+
+Sources:
+  --input events.ndjson   recorded payloads, e.g. from generate.py or a spool local sink
+  --generate N            N events from generator.py
+With --templates, each payload is built from the Shopify pixel event of its type in
+shopify_events/ (the way data_collection/index.js transforms them), and only the event's identity,
+time, page, session and scroll depth come from the source.
+
+Schedule: --rate R events/s (--poisson for exponential gaps), or --speed X to replay at X times the
+pace of the source's event times. Payload event times are moved to the send time unless
+--keep-event-time is passed.
+
+Usage: python replay.py --url http://localhost:8000 --generate 100000 --rate 2000 [--batch 20]
+       python replay.py --input events.ndjson --speed 10 --templates ../shopify_events
+"""
+import argparse
+import asyncio
+import glob
+import json
+import logging
+import os
+import random
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Iterator
+import httpx
+from generator import EventGenerator, chunk_rows
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+# httpx logs every request at INFO
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+# Fields taken from the source event when building payloads from the Shopify templates
+SOURCE_FIELDS = ["event_time", "event_name", "event_id", "user_id", "session_id", "page_url", "platform", "percent_scroll"]
+
+
+def pixel_payload(event: dict) -> dict:
+    """
+    The payload data_collection/index.js sends for a Shopify pixel event.
+    """
+    context = event["context"]
+    payload = {
+        "platform": "mobile" if any(device in context["navigator"]["userAgent"] for device in ("Mobile", "Android", "iPhone", "iPad")) else "web",
+        "event_time": event["timestamp"],
+        "event_name": event["name"],
+        "event_id": event["id"],
+        "user_id": event["clientId"],
+        "page_url": context["document"]["location"]["host"],
+        "user_agent": context["navigator"]["userAgent"],
+        "language": context["navigator"]["language"],
+    }
+    if event["name"] == "product_added_to_cart":
+        merchandise = event["data"]["cartLine"]["merchandise"]
+        payload.update(product_id=merchandise["product"]["id"], product_price=merchandise["price"]["amount"],
+                       currency=merchandise["price"]["currencyCode"])
+    elif event["name"] == "checkout_completed":
+        checkout = event["data"]["checkout"]
+        payload.update(order_id=checkout["order"]["id"], order_value=checkout["totalPrice"]["amount"],
+                       city=checkout["shippingAddress"]["city"], country=checkout["shippingAddress"]["country"],
+                       currency=checkout["totalPrice"]["currencyCode"], user_email=checkout["email"])
+    return payload
+
+
+def load_templates(directory: str) -> dict[str, dict]:
+    """
+    Pixel payloads by event name. Scroll events have no sample, so they use the page view's.
+    """
+    templates = {}
+    for path in sorted(glob.glob(os.path.join(directory, "*.json"))):
+        with open(path, 'r') as f:
+            event = json.load(f)
+        templates[event["name"]] = pixel_payload(event)
+    if "page_viewed" in templates:
+        templates.setdefault("page_scroll", {**templates["page_viewed"], "event_name": "page_scroll"})
+    return templates
+
+
+def apply_template(event: dict, templates: dict[str, dict]) -> dict:
+    template = templates.get(event["event_name"])
+    if template is None:
+        return event
+    payload = {**template, **{field: event[field] for field in SOURCE_FIELDS if field in event}}
+    if event["event_name"] == "page_scroll":
+        payload.setdefault("page_title", "Example Page")
+    return payload
+
+
+def read_events(path: str) -> Iterator[dict]:
+    with open(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def event_timestamp(event: dict) -> float:
+    return datetime.fromisoformat(event["event_time"].replace('Z', '+00:00')).timestamp()
+
+
+class ReplayStats:
+    """
+    Counters for the whole run plus latencies of the current report interval.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.events = 0
+        self.requests = 0
+        self.errors = 0
+        self.dropped = 0
+        self.statuses: Counter = Counter()
+        self.latencies: list[float] = []
+        self.window_latencies: list[float] = []
+        self.window_events = 0
+        self.window_errors = 0
+        self.window_started = self.started
+        self.lag = 0.0
+
+    def record(self, events: int, status: int | str, latency: float) -> None:
+        self.requests += 1
+        self.events += events
+        self.window_events += events
+        self.statuses[status] += 1
+        if not (isinstance(status, int) and status < 400):
+            self.errors += 1
+            self.window_errors += 1
+        self.latencies.append(latency)
+        self.window_latencies.append(latency)
+
+    def drop(self, events: int) -> None:
+        self.dropped += events
+
+    def report(self, in_flight: int) -> dict:
+        now = time.perf_counter()
+        elapsed = now - self.window_started
+        report = {
+            "events_per_s": self.window_events / elapsed if elapsed else 0.0,
+            "error_rate": self.window_errors / len(self.window_latencies) if self.window_latencies else 0.0,
+            **percentiles(self.window_latencies),
+            "in_flight": in_flight,
+            "schedule_lag_s": self.lag,
+        }
+        self.window_latencies, self.window_events, self.window_errors, self.window_started = [], 0, 0, now
+        return report
+
+    def summary(self) -> dict:
+        elapsed = time.perf_counter() - self.started
+        return {
+            "duration_s": elapsed,
+            "events": self.events,
+            "requests": self.requests,
+            "events_per_s": self.events / elapsed if elapsed else 0.0,
+            "error_rate": self.errors / self.requests if self.requests else 0.0,
+            "dropped_events": self.dropped,
+            "statuses": {str(status): count for status, count in self.statuses.items()},
+            **percentiles(self.latencies),
+        }
+
+
+def percentiles(latencies: list[float]) -> dict:
+    values = sorted(latencies)
+
+    def at(q: float) -> float:
+        return values[min(int(q * len(values)), len(values) - 1)] * 1000 if values else 0.0
+    return {"p50_ms": at(0.5), "p90_ms": at(0.9), "p99_ms": at(0.99), "max_ms": values[-1] * 1000 if values else 0.0}
+
+
+async def replay(events: Iterator[dict], args) -> dict:
+    """
+    Send `events` on the schedule given by `args` and return the summary.
+    """
+    rng = random.Random(args.seed)
+    stats = ReplayStats()
+    in_flight: set[asyncio.Task] = set()
+    # Bounds memory when the server falls behind; events over the limit are dropped and counted
+    slots = asyncio.Semaphore(args.max_in_flight)
+    # Requests wait for a connection here rather than inside httpx's pool, which slows down with many waiters
+    connections = asyncio.Semaphore(args.connections)
+    headers = {"Origin": args.origin}
+    if args.batch > 1:
+        url, headers["Content-Type"] = f"{args.url}/ingest-gcp/batch", "text/plain"
+    else:
+        url, headers["Content-Type"] = f"{args.url}/ingest-gcp", "application/json"
+    limits = httpx.Limits(max_connections=args.connections, max_keepalive_connections=args.connections)
+
+    async with httpx.AsyncClient(limits=limits, timeout=args.timeout) as http:
+        async def send(batch: list[dict], scheduled: float):
+            try:
+                if not args.keep_event_time:
+                    event_time = datetime.now(timezone.utc).isoformat()
+                    for event in batch:
+                        event["event_time"] = event_time
+                body = "\n".join(json.dumps(event) for event in batch) if args.batch > 1 else json.dumps(batch[0])
+                async with connections:
+                    if args.preflight:
+                        # What a browser sends before a cross-origin JSON POST
+                        await http.options(url, headers={"Origin": args.origin, "Access-Control-Request-Method": "POST",
+                                                         "Access-Control-Request-Headers": "content-type"})
+                    response = await http.post(url, content=body, headers=headers)
+                status = response.status_code
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            finally:
+                slots.release()
+            stats.record(len(batch), status, time.perf_counter() - scheduled)
+
+        async def reporter():
+            while True:
+                await asyncio.sleep(args.report_interval)
+                report = stats.report(len(in_flight))
+                logger.info(f"{report['events_per_s']:.0f} events/s, {report['error_rate'] * 100:.2f}% errors, "
+                            f"p50 {report['p50_ms']:.1f} ms, p99 {report['p99_ms']:.1f} ms, "
+                            f"{report['in_flight']} in flight, {report['schedule_lag_s'] * 1000:.0f} ms behind schedule")
+
+        reporting = asyncio.create_task(reporter())
+        started = time.perf_counter()
+        first_event_time = None
+        next_send = 0.0
+        batch: list[dict] = []
+        for event in events:
+            if args.templates_by_name:
+                event = apply_template(event, args.templates_by_name)
+            batch.append(event)
+            if len(batch) < args.batch:
+                continue
+
+            if args.speed:
+                # Recorded pace: the first event's time maps to the start of the replay
+                timestamp = event_timestamp(batch[0])
+                first_event_time = timestamp if first_event_time is None else first_event_time
+                next_send = max(timestamp - first_event_time, 0.0) / args.speed
+            scheduled = started + next_send
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            stats.lag = max(-delay, 0.0)
+
+            if slots.locked():
+                stats.drop(len(batch))
+            else:
+                await slots.acquire()
+                task = asyncio.create_task(send(batch, scheduled))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+            batch = []
+            if not args.speed:
+                gap = args.batch / args.rate
+                next_send += rng.expovariate(1 / gap) if args.poisson else gap
+        if batch:
+            await slots.acquire()
+            in_flight.add(asyncio.create_task(send(batch, time.perf_counter())))
+        if in_flight:
+            await asyncio.wait(in_flight)
+        reporting.cancel()
+    return stats.summary()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8000", help="base URL of the ingestion service")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--input", help="NDJSON file of event payloads")
+    source.add_argument("--generate", type=int, help="number of events to generate")
+    schedule = parser.add_mutually_exclusive_group(required=True)
+    schedule.add_argument("--rate", type=float, help="target events/s")
+    schedule.add_argument("--speed", type=float, help="multiple of the recorded pace")
+    parser.add_argument("--poisson", action="store_true", help="exponential gaps at --rate instead of even ones")
+    parser.add_argument("--batch", type=int, default=1, help="events per request; above 1 uses /ingest-gcp/batch")
+    parser.add_argument("--templates", help="directory of Shopify pixel events, e.g. ../shopify_events")
+    parser.add_argument("--keep-event-time", action="store_true")
+    parser.add_argument("--origin", default="https://shopify-domain.myshopify.com")
+    parser.add_argument("--preflight", action="store_true", help="send a CORS preflight before every request")
+    parser.add_argument("--connections", type=int, default=100)
+    parser.add_argument("--max-in-flight", type=int, default=1000)
+    parser.add_argument("--timeout", type=float, default=10)
+    parser.add_argument("--report-interval", type=float, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the summary to this JSON file")
+    args = parser.parse_args()
+    if args.rate is not None and args.rate <= 0 or args.speed is not None and args.speed <= 0 or args.batch < 1:
+        parser.error("--rate, --speed and --batch must be positive")
+
+    if args.speed and args.generate:
+        # Generated events are ordered by session, not by time
+        parser.error("--speed needs recorded events (--input); use --rate with --generate")
+
+    args.templates_by_name = load_templates(args.templates) if args.templates else {}
+    if args.input:
+        events = read_events(args.input)
+    else:
+        generator = EventGenerator(seed=args.seed)
+        events = (row for chunk in generator.chunks(args.generate, min(args.generate, 100000)) for row in chunk_rows(chunk))
+
+    summary = asyncio.run(replay(events, args))
+    logger.info(f"Sent {summary['events']} events in {summary['requests']} requests over {summary['duration_s']:.1f}s: "
+                f"{summary['events_per_s']:.0f} events/s, {summary['error_rate'] * 100:.2f}% errors, "
+                f"p50 {summary['p50_ms']:.1f} ms, p90 {summary['p90_ms']:.1f} ms, p99 {summary['p99_ms']:.1f} ms, "
+                f"{summary['dropped_events']} dropped, statuses {summary['statuses']}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
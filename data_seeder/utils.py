@@ -2,9 +2,8 @@ import logging
 from google.cloud import bigquery
 from google.oauth2 import service_account
 import random
-import string
-from datetime import datetime, timedelta
 import json
+from generator import EventGenerator, chunk_rows
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -27,36 +26,6 @@ client = bigquery.Client(credentials=bqcreds, project=bqcreds.project_id)
 dataset_id = config['dataset_id']
 table_id = config['table_id']
 
-# Helper function to create random event data
-def create_event(event_type):
-    user_agent = ''.join(random.choices(string.ascii_letters + string.digits, k=15))
-    is_mobile_device = random.choice([True, False])
-    platform = 'mobile' if is_mobile_device else 'web'
-    random_int = random.randint(0,45)
-    random_event_time = datetime.now() - timedelta(days=random_int)
-    base_event = {
-        'platform': platform,
-        'event_time': random_event_time.isoformat(),
-        'event_name': event_type,
-        'event_id': ''.join(random.choices(string.ascii_letters + string.digits, k=10)),
-        'user_id': ''.join(random.choices(string.ascii_letters + string.digits, k=10)),
-        'session_id': f'sess-{"".join(random.choices(string.ascii_letters + string.digits, k=10))}',
-        'page_url': f'https://example-{random_int}.com',
-        'user_agent': user_agent,
-        'language': 'en-US',
-    }
-
-    if event_type == 'page_viewed':
-        return base_event
-    elif event_type == 'page_scroll':
-        return {**base_event, 'page_title': 'Example Page', 'percent_scroll': random.randint(0, 100)}
-    elif event_type == 'product_added_to_cart':
-        return {**base_event, 'product_id': ''.join(random.choices(string.ascii_letters + string.digits, k=10)), 'product_price': random.uniform(1, 100), 'currency': 'USD'}
-    elif event_type == 'checkout_completed':
-        return {**base_event, 'order_id': ''.join(random.choices(string.ascii_letters + string.digits, k=10)),'order_value': random.uniform(20, 200), 'city': 'San Francisco', 'country': 'USA', 'currency': 'USD', 'user_email': f'user-{random_int}@example.com'}
-    else:
-        return base_event
-
 # Function to insert data into BigQuery
 def insert_data(event_data):
     table = client.dataset(dataset_id).table(table_id)
@@ -68,6 +37,7 @@ def insert_data(event_data):
 
 # Function to generate and insert events
 def generate_and_insert_events():
-    event_types = ['page_viewed', 'page_scroll', 'product_added_to_cart', 'checkout_completed']
-    event_data = [create_event(random.choice(event_types)) for _ in range(NUMBER_OF_EVENTS_TO_GENERATE)]
+    # Sessions with page view -> scroll -> cart -> checkout funnels over the last 45 days, new ones every run
+    generator = EventGenerator(seed=random.randrange(2 ** 32))
+    event_data = [row for chunk in generator.chunks(NUMBER_OF_EVENTS_TO_GENERATE) for row in chunk_rows(chunk)]
     insert_data(event_data)
\ No newline at end of file
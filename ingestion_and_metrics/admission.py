@@ -0,0 +1,101 @@
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Callable
+from fastapi import HTTPException
+
+# Share of the pending-event budget each event type may use before it is shed. Cheap,
+# high-volume events go first so checkouts keep being accepted the longest.
+DEFAULT_PRIORITIES = {
+    "page_scroll": 0.5,
+    "page_viewed": 0.75,
+    "product_added_to_cart": 0.9,
+    "checkout_completed": 1.0,
+}
+DEFAULT_PRIORITY = 0.75
+
+
+class AdmissionController:
+    """
+    Admission control for the ingestion endpoints.
+
+    `depth` returns the number of events queued for writing. Requests are rejected with a 503
+    before their body is read when `max_in_flight` requests are already being handled or the
+    queue holds `max_pending` events. Once the event name is known, an event is only admitted
+    while the queue stays under `max_pending * share` for its priority share; lower priority
+    events beyond that are shed with a 429. Both carry a Retry-After header.
+    """
+
+    def __init__(self, depth: Callable[[], int], max_pending: int = 8000, max_in_flight: int = 1000,
+                 retry_after: int = 5, priorities: dict[str, float] | None = None,
+                 default_priority: float = DEFAULT_PRIORITY):
+        self.depth = depth
+        self.max_pending = max_pending
+        self.max_in_flight = max_in_flight
+        self.retry_after = retry_after
+        self.priorities = DEFAULT_PRIORITIES if priorities is None else priorities
+        self.default_priority = default_priority
+        self.in_flight = 0
+
+        self.accepted = 0
+        self.rejected_over_capacity = 0
+        self.shed: Counter[str] = Counter()
+        self.last_accept_latency = 0.0
+        self.max_accept_latency = 0.0
+        self.total_accept_latency = 0.0
+        self.accept_samples = 0
+
+    def _reject(self, status_code: int, detail: str) -> HTTPException:
+        return HTTPException(status_code=status_code, detail=detail, headers={"Retry-After": str(self.retry_after)})
+
+    @contextmanager
+    def request(self):
+        """
+        Track a request for the duration of its handling, rejecting it up front when over capacity.
+        """
+        if self.in_flight >= self.max_in_flight or self.depth() >= self.max_pending:
+            self.rejected_over_capacity += 1
+            raise self._reject(503, "Ingestion is over capacity, retry later")
+
+        started = time.perf_counter()
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+        latency = time.perf_counter() - started
+        self.accept_samples += 1
+        self.last_accept_latency = latency
+        self.max_accept_latency = max(self.max_accept_latency, latency)
+        self.total_accept_latency += latency
+
+    def admit(self, event_name: str | None, count: int = 1, pending: int = 0) -> bool:
+        """
+        Return whether `count` events named `event_name` fit in the budget for their priority, on top
+        of `pending` events already admitted but not queued yet (e.g. earlier events of a batch).
+        """
+        share = self.priorities.get(event_name, self.default_priority)
+        if self.depth() + pending + count <= self.max_pending * share:
+            self.accepted += count
+            return True
+        self.shed[event_name or "unknown"] += count
+        return False
+
+    def admit_or_raise(self, event_name: str | None) -> None:
+        if not self.admit(event_name):
+            raise self._reject(429, f"Shedding {event_name} events, retry later")
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.depth(),
+            "max_pending": self.max_pending,
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "accepted": self.accepted,
+            "rejected_over_capacity": self.rejected_over_capacity,
+            "shed": dict(self.shed),
+            "shed_total": sum(self.shed.values()),
+            "last_accept_latency_ms": self.last_accept_latency * 1000,
+            "max_accept_latency_ms": self.max_accept_latency * 1000,
+            "avg_accept_latency_ms": self.total_accept_latency / self.accept_samples * 1000 if self.accept_samples else 0,
+        }
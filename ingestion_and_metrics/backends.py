@@ -0,0 +1,189 @@
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import date, datetime
+from google.cloud import bigquery
+from google.oauth2 import service_account
+from common.local_backend import EPOCH, BASE_TABLE_SCHEMA, BASE_COLUMNS, translate, to_timestamp, from_timestamp, connect
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+PAGE_DAILY_METRICS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS "{table}" (
+    page_url TEXT, event_date TEXT, number_of_sessions INTEGER, add_to_cart_events INTEGER,
+    checkout_completed INTEGER, total_revenue REAL, total_scroll_sum REAL, total_scroll_events INTEGER,
+    sessions_sketch BLOB, PRIMARY KEY (page_url, event_date)
+);
+"""
+
+# The dimension cube of the aggregator (queries.build_cube_target), with one TEXT column per dimension
+PAGE_DIMENSION_METRICS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS "{table}" (
+    page_url TEXT, event_date TEXT, grouping_set TEXT{dimensions}, number_of_sessions INTEGER, add_to_cart_events INTEGER,
+    checkout_completed INTEGER, total_revenue REAL, total_scroll_sum REAL, total_scroll_events INTEGER,
+    sessions_sketch BLOB
+);
+"""
+
+# Weekly and monthly rollups of the daily page metrics, keyed by the first day of the period
+PAGE_ROLLUP_METRICS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS "{table}" (
+    page_url TEXT, period_start TEXT, number_of_sessions INTEGER, add_to_cart_events INTEGER,
+    checkout_completed INTEGER, total_revenue REAL, total_scroll_sum REAL, total_scroll_events INTEGER,
+    sessions_sketch BLOB, PRIMARY KEY (page_url, period_start)
+);
+"""
+
+# Stored timestamps, returned as datetimes like BigQuery returns TIMESTAMP values
+TIMESTAMP_TEXT = re.compile(r"\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}\.\d{6}")
+
+
+def result_rows(cursor: sqlite3.Cursor) -> list[dict]:
+    return [{key: from_timestamp(value) if isinstance(value, str) and TIMESTAMP_TEXT.fullmatch(value) else value
+             for key, value in zip(row.keys(), row)} for row in cursor.fetchall()]
+
+
+def query_parameters(job_config) -> dict:
+    parameters = {}
+    for parameter in getattr(job_config, 'query_parameters', None) or []:
+        if isinstance(parameter, bigquery.ArrayQueryParameter):
+            parameters[parameter.name] = json.dumps(list(parameter.values))
+        elif parameter.type_ == "TIMESTAMP":
+            parameters[parameter.name] = to_timestamp(parameter.value)
+        elif isinstance(parameter.value, date):
+            parameters[parameter.name] = parameter.value.isoformat()
+        else:
+            parameters[parameter.name] = parameter.value
+    return parameters
+
+
+class LocalRows(list):
+    """
+    Query result with the parts of google.cloud.bigquery's RowIterator the services use.
+    """
+
+    def __init__(self, rows: list, page_size: int | None = None):
+        super().__init__(rows)
+        self.page_size = page_size or len(rows) or 1
+        self.total_rows = len(rows)
+
+    @property
+    def pages(self):
+        for start in range(0, len(self), self.page_size):
+            yield self[start:start + self.page_size]
+
+
+class LocalJob:
+    def __init__(self, rows: list, statement_type: str, affected_rows: int, duration: float):
+        self.job_id = f"local-{uuid.uuid4()}"
+        self.project = "local"
+        self.location = "local"
+        self.rows = rows
+        self.statement_type = statement_type
+        self.num_dml_affected_rows = affected_rows
+        self.total_bytes_processed = 0
+        self.total_bytes_billed = 0
+        self.slot_millis = round(duration * 1000)
+
+    def result(self, timeout: float | None = None, page_size: int | None = None) -> LocalRows:
+        return LocalRows(self.rows, page_size)
+
+
+class LocalTable:
+    def __init__(self, table_id: str, modified: datetime):
+        self.table_id = table_id
+        self.table_name = table_id.split('.')[-1]
+        self.modified = modified
+
+
+class LocalClient:
+    """
+    Stand-in for google.cloud.bigquery.Client over a local SQLite database, for development,
+    offline tests and benchmarks. Queries are translated from BigQuery SQL (see `translate`) and
+    run synchronously; tables are addressed by the last part of their id.
+    """
+
+    def __init__(self, database: str, base_table_id: str, page_daily_metrics_table_id: str, rollup_table_ids: list[str] = (),
+                 dimension_metrics_table_id: str | None = None, dimensions: list[str] = ()):
+        self.database = os.path.abspath(database)
+        self.project = "local"
+        self._local = threading.local()
+        self._connection().executescript(
+            BASE_TABLE_SCHEMA.format(table=base_table_id.split('.')[-1])
+            + PAGE_DAILY_METRICS_SCHEMA.format(table=page_daily_metrics_table_id.split('.')[-1])
+            + "".join(PAGE_ROLLUP_METRICS_SCHEMA.format(table=table_id.split('.')[-1]) for table_id in rollup_table_ids)
+            + (PAGE_DIMENSION_METRICS_SCHEMA.format(table=dimension_metrics_table_id.split('.')[-1],
+                                                    dimensions="".join(f", {dimension} TEXT" for dimension in dimensions))
+               if dimension_metrics_table_id else ""))
+
+    def _connection(self) -> sqlite3.Connection:
+        # One connection per thread; the query engine runs queries on a thread pool
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = connect(self.database)
+        return connection
+
+    def query(self, query: str, job_config=None, **kwargs) -> LocalJob:
+        started = time.perf_counter()
+        connection = self._connection()
+        if getattr(job_config, 'dry_run', False):
+            # Only check that the query compiles; bytes processed are always reported as 0
+            connection.execute(f"EXPLAIN {translate(query)}", query_parameters(job_config))
+            return LocalJob([], "SELECT", 0, 0.0)
+        cursor = connection.execute(translate(query), query_parameters(job_config))
+        rows = result_rows(cursor)
+        connection.commit()
+        statement_type = query.lstrip().split(None, 1)[0].upper() if query.strip() else ""
+        return LocalJob(rows, statement_type, max(cursor.rowcount, 0), time.perf_counter() - started)
+
+    def cancel_job(self, job_id: str, **kwargs) -> None:
+        # Local queries run to completion synchronously
+        pass
+
+    def get_table(self, table_id) -> LocalTable:
+        if isinstance(table_id, LocalTable):
+            return table_id
+        name = table_id.split('.')[-1]
+        row = self._connection().execute("SELECT modified FROM _table_versions WHERE table_name = ?", (name,)).fetchone()
+        return LocalTable(table_id, from_timestamp(row['modified']) if row else EPOCH)
+
+    def list_rows(self, table, **kwargs) -> LocalRows:
+        name = self.get_table(table).table_name
+        return LocalRows(result_rows(self._connection().execute(f'SELECT * FROM "{name}"')))
+
+    def insert_rows_json(self, table, json_rows: list[dict], row_ids: list[str] | None = None, **kwargs) -> list[dict]:
+        name = self.get_table(table).table_name
+        rows = [
+            tuple(to_timestamp(row.get(column)) if column == 'event_time' else row.get(column) for column in BASE_COLUMNS)
+            for row in json_rows
+        ]
+        connection = self._connection()
+        with connection:
+            connection.executemany(
+                f'INSERT INTO "{name}" ({", ".join(BASE_COLUMNS)}) VALUES ({", ".join("?" for _ in BASE_COLUMNS)})', rows)
+        return []
+
+
+def create_client(backend: str, creds: str, scopes: list[str], database: str,
+                  base_table_id: str, page_daily_metrics_table_id: str, rollup_table_ids: list[str] = (),
+                  dimension_metrics_table_id: str | None = None, dimensions: list[str] = ()):
+    """
+    BigQuery client for the `bigquery` backend, or a LocalClient over `database` for `local`.
+    """
+    if backend == "local":
+        logger.info(f"Using the local backend at {database}")
+        return LocalClient(database, base_table_id, page_daily_metrics_table_id, rollup_table_ids,
+                           dimension_metrics_table_id, dimensions)
+    if backend != "bigquery":
+        raise ValueError(f"Unknown backend: {backend}")
+    bqcreds = service_account.Credentials.from_service_account_file(
+        creds,
+        scopes=scopes
+    )
+    return bigquery.Client(credentials=bqcreds, project=bqcreds.project_id)
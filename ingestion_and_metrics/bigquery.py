@@ -1,112 +1,99 @@
 import asyncio
+import logging
+import uuid
 from datetime import datetime
 from google.cloud import bigquery
-from google.oauth2 import service_account
-from classes import EventPayload, MetricsRequest, MetricsResponse
+from typing import AsyncIterator
+from classes import DimensionMetrics, MetricsBatchRequest, MetricsBreakdownRequest, MetricsBreakdownResponse, MetricsRequest, MetricsResponse, MetricsTimeseriesRequest, MetricsTimeseriesResponse
 from fastapi import HTTPException
-from utils import get_add_to_cart_events, get_checkout_completed_events, get_number_of_sessions, get_total_revenue, get_scroll_events
-from config import creds, scopes, base_table_id, add_to_cart_table_id, checkout_completed_table_id, sessions_table_id, scroll_table_id, revenue_table_id
+from config import creds, scopes, backend, local_database, base_table_id, metadata_table_id, page_daily_metrics_table_id, page_weekly_metrics_table_id, page_monthly_metrics_table_id
+from config import rollup_granularities, max_bytes_billed, over_budget, dimension_metrics_table_id, cube_dimensions, timeseries_decimals
+from backends import create_client
+from engine import QueryBudgetExceeded, QueryEngine
+from utils import PAGE_URL_FILTER, SESSIONS_AGGREGATE, metrics_source, page_url_job_config, get_add_to_cart_events, get_checkout_completed_events, get_number_of_sessions, get_total_revenue, get_scroll_events
 
-bqcreds = service_account.Credentials.from_service_account_file(
-    creds,
-    scopes=scopes
-)
-client = bigquery.Client(credentials=bqcreds, project=bqcreds.project_id)
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
+client = create_client(backend, creds, scopes, local_database, base_table_id, page_daily_metrics_table_id,
+                       [page_weekly_metrics_table_id, page_monthly_metrics_table_id], dimension_metrics_table_id, cube_dimensions)
 
-def write_event_bigquery(event_payload: EventPayload):
-    try:
-        transformed_payload = event_payload.model_dump()
-        event_timestamp: datetime = transformed_payload['event_time']
-        transformed_payload['event_time'] = event_timestamp.isoformat()
+# The cheapest source of a range: whole months and weeks from the rollups, daily rows only at its edges
+CHEAPEST_GRANULARITIES = ["month", "week"]
 
-        rows_to_insert = [transformed_payload]
 
-        table = client.get_table(base_table_id)
-        errors = client.insert_rows_json(table, rows_to_insert)
+def can_fall_back(granularities: list[str]) -> bool:
+    """
+    Whether an over-budget query read with `granularities` should be retried on the rollups.
+    """
+    return over_budget == "fallback" and not set(CHEAPEST_GRANULARITIES) <= set(granularities)
 
-        if errors:
-            raise RuntimeError(f"Encountered errors while inserting rows: {errors}")
 
-    except Exception as e:
-        print(e)
-        raise HTTPException(status_code=500, detail=str(e))
+_base_table = None
 
 
+def get_base_table() -> bigquery.Table:
+    """
+    Fetch the base table once and reuse the handle for every insert.
+    """
+    global _base_table
+    if _base_table is None:
+        _base_table = client.get_table(base_table_id)
+    return _base_table
 
-def get_bigquery_metrics(request: MetricsRequest) -> MetricsResponse:
-    page_url = request.page_url
-    start_date = request.start_date
-    end_date = request.end_date
 
-    try:
-        # Validate dates
-        start_date = datetime.strptime(start_date, "%Y-%m-%d")
-        end_date = datetime.strptime(end_date, "%Y-%m-%d")
-    except ValueError:
-        raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD.")
+def insert_event_rows(rows_to_insert: list[dict]) -> list[dict]:
+    """
+    Stream a batch of rows into the base table, returning the per-row insert errors.
+    The event id is used as the insertId so BigQuery drops redelivered rows on a best-effort basis.
+    """
+    row_ids = [row.get('event_id') or str(uuid.uuid4()) for row in rows_to_insert]
+    return client.insert_rows_json(get_base_table(), rows_to_insert, row_ids=row_ids)
 
-    # Query to get the required data from BigQuery
-    query = f"""
-    SELECT
-        a.page_url,
-        SUM(c.add_to_cart_events) AS add_to_cart_events,
-        SUM(b.checkout_completed) AS checkout_completed_events,
-        SUM(a.number_of_sessions) AS number_of_sessions,
-        SUM(d.total_revenue) AS total_revenue,
-        SUM(e.total_scroll_sum) AS total_scroll_sum, 
-        SUM(e.total_events) AS total_scroll_events
-    FROM
-        `{sessions_table_id}` a
-    LEFT JOIN
-        `{checkout_completed_table_id}` b
-    ON
-        a.page_url = b.page_url AND a.event_date = b.event_date
-    LEFT JOIN
-        `{add_to_cart_table_id}` c
-    ON
-        a.page_url = c.page_url AND a.event_date = c.event_date
-    LEFT JOIN
-        `{revenue_table_id}` d
-    ON
-        a.page_url = d.page_url AND a.event_date = d.event_date
-    LEFT JOIN
-        `{scroll_table_id}` e
-    ON
-        a.page_url = e.page_url AND a.event_date = e.event_date
-    WHERE
-        a.page_url = '{page_url}'
-        AND a.event_date BETWEEN '{start_date.strftime('%Y-%m-%d')}' AND '{end_date.strftime('%Y-%m-%d')}'
-    GROUP BY
-        a.page_url
+
+
+def get_aggregates_version() -> datetime | None:
     """
+    Version of the data behind the metrics: the latest modification time of the metadata table
+    (updated whenever the aggregator advances its watermark) and the daily page metrics table. Reading
+    table metadata is free, unlike querying `last_event_time`.
+    """
+    tables = [metadata_table_id, page_daily_metrics_table_id]
+    return max(client.get_table(table_id).modified for table_id in tables)
 
-    query_job = client.query(query)
-    results = list(query_job.result())
 
-    if not results:
-        raise HTTPException(status_code=404, detail="No data found for the given page URL and date range.")
+def parse_date_range(start_date: str, end_date: str) -> tuple[str, str]:
+    try:
+        # Validate dates
+        start = datetime.strptime(start_date, "%Y-%m-%d")
+        end = datetime.strptime(end_date, "%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD.")
+    return start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')
 
-    result = results[0]
 
-    # Compute the metrics
-    add_to_cart_events = result['add_to_cart_events']
-    checkout_completed_events = result['checkout_completed_events']
-    number_of_sessions = result['number_of_sessions']
-    total_revenue = result['total_revenue']
-    total_scroll_sum = result['total_scroll_sum']
-    total_scroll_events = result['total_scroll_events']
+def metrics_ratios(add_to_cart_events, checkout_completed_events, number_of_sessions,
+                   total_revenue, total_scroll_sum, total_scroll_events) -> dict:
+    """
+    Compute the ratios served by the metrics endpoints from summed counters. Missing counters
+    (no rows in an aggregate table for the range) count as zero.
+    """
+    add_to_cart_events = add_to_cart_events or 0
+    checkout_completed_events = checkout_completed_events or 0
+    number_of_sessions = number_of_sessions or 0
+    total_revenue = total_revenue or 0
+    total_scroll_sum = total_scroll_sum or 0
+    total_scroll_events = total_scroll_events or 0
 
     cart_percentage = (add_to_cart_events / number_of_sessions) * 100 if number_of_sessions else 0
-    conversion_rate = (checkout_completed_events / number_of_sessions) * 100 if add_to_cart_events else 0
+    conversion_rate = (checkout_completed_events / number_of_sessions) * 100 if number_of_sessions else 0
     average_order_value = total_revenue / checkout_completed_events if checkout_completed_events else 0
     revenue_per_session = total_revenue / number_of_sessions if number_of_sessions else 0
     average_scroll_percentage = total_scroll_sum / total_scroll_events if total_scroll_events else 0
 
-    return MetricsResponse(
-        page_url=page_url,
+    return dict(
         cart_percentage=cart_percentage,
-        conversion_rate=conversion_rate, 
+        conversion_rate=conversion_rate,
         average_order_value=average_order_value,
         revenue_per_session=revenue_per_session,
         total_sessions=number_of_sessions,
@@ -114,45 +101,288 @@ def get_bigquery_metrics(request: MetricsRequest) -> MetricsResponse:
     )
 
 
-async def get_bigquery_metrics_parallel(request: MetricsRequest) -> MetricsResponse:
+def build_metrics_response(page_url: str, **counters) -> MetricsResponse:
+    return MetricsResponse(page_url=page_url, **metrics_ratios(**counters))
+
+
+def get_aggregation_watermark() -> datetime | None:
+    """
+    Latest event time merged into page_daily_metrics, from a (free) read of the metadata table.
+    """
+    for row in client.list_rows(metadata_table_id):
+        if row['query_name'] == 'page_daily_metrics_query':
+            return row['last_event_time']
+    return None
+
+
+async def get_bigquery_counters(request: MetricsRequest, engine: QueryEngine,
+                                granularities: list[str] = rollup_granularities) -> dict:
+    """
+    Summed counters of the page over the request's range, with the number of aggregate rows they
+    come from (`aggregate_rows`) and the page_daily_metrics watermark they were read at (`watermark`).
+    """
     page_url = request.page_url
-    start_date = request.start_date
-    end_date = request.end_date
+    start_date, end_date = parse_date_range(request.start_date, request.end_date)
+
+    # Every counter of a day, week or month lives in one row of a partitioned, clustered table, so
+    # this is a few pruned scans reading a bounded number of rows whatever the range
+    query = f"""
+    SELECT
+        COUNT(*) AS aggregate_rows,
+        SUM(add_to_cart_events) AS add_to_cart_events,
+        SUM(checkout_completed) AS checkout_completed_events,
+        {SESSIONS_AGGREGATE} AS number_of_sessions,
+        SUM(total_revenue) AS total_revenue,
+        SUM(total_scroll_sum) AS total_scroll_sum,
+        SUM(total_scroll_events) AS total_scroll_events,
+        (SELECT MAX(last_event_time) FROM `{metadata_table_id}` WHERE query_name = 'page_daily_metrics_query') AS watermark
+    FROM
+        {metrics_source(PAGE_URL_FILTER, start_date, end_date, granularities)}
+    """
 
     try:
-        # Validate dates
-        start_date = datetime.strptime(start_date, "%Y-%m-%d")
-        end_date = datetime.strptime(end_date, "%Y-%m-%d")
-    except ValueError:
-        raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD.")
+        results = await engine.run(query, name="metrics", job_config=page_url_job_config(page_url),
+                                   max_bytes_billed=max_bytes_billed.get("get_metrics"))
+    except QueryBudgetExceeded:
+        if not can_fall_back(granularities):
+            raise
+        logger.warning(f"Metrics of {page_url} from {start_date} to {end_date} are over budget, reading the rollups")
+        return await get_bigquery_counters(request, engine, CHEAPEST_GRANULARITIES)
+    return {key: results[0][key] for key in (
+        'aggregate_rows', 'add_to_cart_events', 'checkout_completed_events', 'number_of_sessions',
+        'total_revenue', 'total_scroll_sum', 'total_scroll_events', 'watermark')}
 
-    start_date_str = start_date.strftime('%Y-%m-%d')
-    end_date_str = end_date.strftime('%Y-%m-%d')
 
-    # Run queries concurrently
-    add_to_cart_events, checkout_completed_events, number_of_sessions, total_revenue, scroll_events = await asyncio.gather(
-        get_add_to_cart_events(page_url, start_date_str, end_date_str, client),
-        get_checkout_completed_events(page_url, start_date_str, end_date_str, client),
-        get_number_of_sessions(page_url, start_date_str, end_date_str, client),
-        get_total_revenue(page_url, start_date_str, end_date_str, client),
-        get_scroll_events(page_url, start_date_str, end_date_str, client)
+async def get_bigquery_metrics(request: MetricsRequest, engine: QueryEngine) -> MetricsResponse:
+    counters = await get_bigquery_counters(request, engine)
+
+    if not counters['aggregate_rows']:
+        raise HTTPException(status_code=404, detail="No data found for the given page URL and date range.")
+
+    return build_metrics_response(
+        request.page_url,
+        add_to_cart_events=counters['add_to_cart_events'],
+        checkout_completed_events=counters['checkout_completed_events'],
+        number_of_sessions=counters['number_of_sessions'],
+        total_revenue=counters['total_revenue'],
+        total_scroll_sum=counters['total_scroll_sum'],
+        total_scroll_events=counters['total_scroll_events'],
     )
+
+
+async def get_bigquery_metrics_parallel(request: MetricsRequest, engine: QueryEngine) -> MetricsResponse:
+    page_url = request.page_url
+    start_date, end_date = parse_date_range(request.start_date, request.end_date)
+
+    # Run queries concurrently
+    budget = max_bytes_billed.get("get_metrics_parallel")
+    try:
+        add_to_cart_events, checkout_completed_events, number_of_sessions, total_revenue, scroll_events = await asyncio.gather(
+            get_add_to_cart_events(page_url, start_date, end_date, engine, budget),
+            get_checkout_completed_events(page_url, start_date, end_date, engine, budget),
+            get_number_of_sessions(page_url, start_date, end_date, engine, budget),
+            get_total_revenue(page_url, start_date, end_date, engine, budget),
+            get_scroll_events(page_url, start_date, end_date, engine, budget)
+        )
+    except QueryBudgetExceeded:
+        if over_budget != "fallback":
+            raise
+        # The five queries each scan the same rows; the /get_metrics query reads them once
+        logger.warning(f"Parallel metrics of {page_url} from {start_date} to {end_date} are over budget, "
+                       f"running a single query")
+        return await get_bigquery_metrics(request, engine)
     total_scroll_sum = scroll_events[0]
     total_scroll_events = scroll_events[1]
 
-    # Compute the metrics
-    cart_percentage = (add_to_cart_events / number_of_sessions) * 100 if number_of_sessions else 0
-    conversion_rate = (checkout_completed_events / number_of_sessions) * 100 if number_of_sessions else 0
-    average_order_value = total_revenue / checkout_completed_events if checkout_completed_events else 0
-    revenue_per_session = total_revenue / number_of_sessions if number_of_sessions else 0
-    average_scroll_percentage = total_scroll_sum / total_scroll_events if total_scroll_events else 0
+    return build_metrics_response(
+        page_url,
+        add_to_cart_events=add_to_cart_events,
+        checkout_completed_events=checkout_completed_events,
+        number_of_sessions=number_of_sessions,
+        total_revenue=total_revenue,
+        total_scroll_sum=total_scroll_sum,
+        total_scroll_events=total_scroll_events,
+    )
 
-    return MetricsResponse(
-        page_url=page_url,
-        cart_percentage=cart_percentage,
-        conversion_rate=conversion_rate,
-        average_order_value=average_order_value,
-        revenue_per_session=revenue_per_session,
-        total_sessions=number_of_sessions,
-        average_scroll_percentage=average_scroll_percentage
-    )
\ No newline at end of file
+
+async def iter_bigquery_metrics_batch(request: MetricsBatchRequest, engine: QueryEngine,
+                                      granularities: list[str] = rollup_granularities) -> AsyncIterator[MetricsResponse]:
+    """
+    Metrics for many pages from a single partition-pruned query over the daily, weekly and monthly
+    page metrics tables, grouped by page_url. Rows are yielded as result pages arrive.
+    """
+    start_date, end_date = parse_date_range(request.start_date, request.end_date)
+
+    query_parameters = []
+    if request.page_urls is not None:
+        page_filter = "page_url IN UNNEST(@page_urls)"
+        query_parameters.append(bigquery.ArrayQueryParameter("page_urls", "STRING", request.page_urls))
+    elif request.page_url_prefix is not None:
+        page_filter = "STARTS_WITH(page_url, @page_url_prefix)"
+        query_parameters.append(bigquery.ScalarQueryParameter("page_url_prefix", "STRING", request.page_url_prefix))
+    else:
+        page_filter = "TRUE"
+
+    query = f"""
+    SELECT
+        page_url,
+        SUM(add_to_cart_events) AS add_to_cart_events,
+        SUM(checkout_completed) AS checkout_completed_events,
+        {SESSIONS_AGGREGATE} AS number_of_sessions,
+        SUM(total_revenue) AS total_revenue,
+        SUM(total_scroll_sum) AS total_scroll_sum,
+        SUM(total_scroll_events) AS total_scroll_events
+    FROM {metrics_source(page_filter, start_date, end_date, granularities)}
+    GROUP BY page_url
+    ORDER BY page_url
+    """
+
+    job_config = bigquery.QueryJobConfig(query_parameters=query_parameters)
+    rows = engine.iterate(query, name="metrics_batch", job_config=job_config,
+                          max_bytes_billed=max_bytes_billed.get("get_metrics_batch"))
+    try:
+        # The budget is checked before the first row, so nothing has been yielded if it is exceeded
+        row = await anext(rows, None)
+    except QueryBudgetExceeded:
+        if not can_fall_back(granularities):
+            raise
+        logger.warning(f"Batch metrics from {start_date} to {end_date} are over budget, reading the rollups")
+        async for metrics in iter_bigquery_metrics_batch(request, engine, CHEAPEST_GRANULARITIES):
+            yield metrics
+        return
+
+    try:
+        while row is not None:
+            yield build_metrics_response(
+                row['page_url'],
+                add_to_cart_events=row['add_to_cart_events'],
+                checkout_completed_events=row['checkout_completed_events'],
+                number_of_sessions=row['number_of_sessions'],
+                total_revenue=row['total_revenue'],
+                total_scroll_sum=row['total_scroll_sum'],
+                total_scroll_events=row['total_scroll_events'],
+            )
+            row = await anext(rows, None)
+    finally:
+        await rows.aclose()
+
+
+def breakdown_grouping_set(dimensions: list[str]) -> str:
+    """
+    Label of the cube rows grouped by exactly `dimensions`: their names in the configured order.
+    """
+    unknown = [dimension for dimension in dimensions if dimension not in cube_dimensions]
+    if not dimensions or unknown or len(set(dimensions)) != len(dimensions):
+        raise HTTPException(status_code=400, detail=f"Invalid dimensions {dimensions}. "
+                                                    f"Pick one or more of: {', '.join(cube_dimensions)}.")
+    return ",".join(dimension for dimension in cube_dimensions if dimension in dimensions)
+
+
+async def get_bigquery_breakdown(request: MetricsBreakdownRequest, engine: QueryEngine) -> MetricsBreakdownResponse:
+    """
+    Metrics of a page (or every page) per value of the requested dimensions, from the aggregator's
+    dimension cube. The cube holds one row per page, day and dimension value for each grouping set,
+    so the query reads the same number of rows whatever the event volume.
+    """
+    grouping_set = breakdown_grouping_set(request.dimensions)
+    dimensions = grouping_set.split(",")
+    start_date, end_date = parse_date_range(request.start_date, request.end_date)
+
+    query_parameters = [bigquery.ScalarQueryParameter("grouping_set", "STRING", grouping_set)]
+    page_filter = "TRUE"
+    if request.page_url is not None:
+        page_filter = PAGE_URL_FILTER
+        query_parameters.append(bigquery.ScalarQueryParameter("page_url", "STRING", request.page_url))
+
+    query = f"""
+    SELECT
+        {', '.join(dimensions)},
+        SUM(add_to_cart_events) AS add_to_cart_events,
+        SUM(checkout_completed) AS checkout_completed_events,
+        {SESSIONS_AGGREGATE} AS number_of_sessions,
+        SUM(total_revenue) AS total_revenue,
+        SUM(total_scroll_sum) AS total_scroll_sum,
+        SUM(total_scroll_events) AS total_scroll_events
+    FROM
+        `{dimension_metrics_table_id}`
+    WHERE
+        event_date BETWEEN '{start_date}' AND '{end_date}'
+        AND grouping_set = @grouping_set
+        AND {page_filter}
+    GROUP BY {', '.join(dimensions)}
+    ORDER BY number_of_sessions DESC
+    """
+
+    job_config = bigquery.QueryJobConfig(query_parameters=query_parameters)
+    rows = await engine.run(query, name="metrics_breakdown", job_config=job_config,
+                            max_bytes_billed=max_bytes_billed.get("get_metrics_breakdown"))
+    return MetricsBreakdownResponse(
+        page_url=request.page_url,
+        start_date=start_date,
+        end_date=end_date,
+        dimensions=dimensions,
+        rows=[DimensionMetrics(
+            dimensions={dimension: row[dimension] for dimension in dimensions},
+            **metrics_ratios(
+                add_to_cart_events=row['add_to_cart_events'],
+                checkout_completed_events=row['checkout_completed_events'],
+                number_of_sessions=row['number_of_sessions'],
+                total_revenue=row['total_revenue'],
+                total_scroll_sum=row['total_scroll_sum'],
+                total_scroll_events=row['total_scroll_events'],
+            )) for row in rows],
+    )
+
+
+async def iter_bigquery_timeseries(request: MetricsTimeseriesRequest, engine: QueryEngine,
+                                   chunk_periods: int | None = None) -> AsyncIterator[MetricsTimeseriesResponse]:
+    """
+    Metrics of a page per day or week of the request's range, from one query grouped by period over
+    the daily page metrics (and the weekly rollup for whole weeks), as columnar chunks of up to
+    `chunk_periods` periods; a single chunk when None. At least one, possibly empty, chunk is yielded.
+    """
+    start_date, end_date = parse_date_range(request.start_date, request.end_date)
+
+    query = f"""
+    SELECT
+        period_start,
+        SUM(add_to_cart_events) AS add_to_cart_events,
+        SUM(checkout_completed) AS checkout_completed_events,
+        {SESSIONS_AGGREGATE} AS number_of_sessions,
+        SUM(total_revenue) AS total_revenue,
+        SUM(total_scroll_sum) AS total_scroll_sum,
+        SUM(total_scroll_events) AS total_scroll_events
+    FROM {metrics_source(PAGE_URL_FILTER, start_date, end_date, period=request.granularity)}
+    GROUP BY period_start
+    ORDER BY period_start
+    """
+
+    def new_chunk() -> dict[str, list]:
+        return {field: [] for field in MetricsTimeseriesResponse.model_fields if field not in ('page_url', 'granularity')}
+
+    job_config = page_url_job_config(request.page_url)
+    rows = engine.iterate(query, name="metrics_timeseries", job_config=job_config,
+                          max_bytes_billed=max_bytes_billed.get("get_metrics_timeseries"))
+    chunk = new_chunk()
+    yielded = False
+    try:
+        async for row in rows:
+            chunk['period_start'].append(str(row['period_start']))
+            ratios = metrics_ratios(
+                add_to_cart_events=row['add_to_cart_events'],
+                checkout_completed_events=row['checkout_completed_events'],
+                number_of_sessions=row['number_of_sessions'],
+                total_revenue=row['total_revenue'],
+                total_scroll_sum=row['total_scroll_sum'],
+                total_scroll_events=row['total_scroll_events'],
+            )
+            for name, value in ratios.items():
+                chunk[name].append(value if name == 'total_sessions' else round(value, timeseries_decimals))
+            if chunk_periods and len(chunk['period_start']) >= chunk_periods:
+                yield MetricsTimeseriesResponse(page_url=request.page_url, granularity=request.granularity, **chunk)
+                chunk = new_chunk()
+                yielded = True
+    finally:
+        await rows.aclose()
+    if chunk['period_start'] or not yielded:
+        yield MetricsTimeseriesResponse(page_url=request.page_url, granularity=request.granularity, **chunk)
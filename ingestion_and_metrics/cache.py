@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from contextlib import suppress
+from typing import Any, Awaitable, Callable, Hashable
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class MetricsCache:
+    """
+    In-process LRU/TTL cache for metrics responses.
+
+    Entries are tagged with the aggregates version (see `get_aggregates_version`) they were
+    computed at; a background task polls the version and every entry from an older version is
+    treated as stale. Concurrent misses for the same key share a single in-flight load. With
+    `stale_while_revalidate` set, stale entries are served immediately while a refresh runs in
+    the background.
+    """
+
+    def __init__(self, load_version: Callable[[], Any], max_entries: int = 10000, ttl: float = 300,
+                 stale_while_revalidate: bool = False, poll_interval: float = 30):
+        self.load_version = load_version
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stale_while_revalidate = stale_while_revalidate
+        self.poll_interval = poll_interval
+        self.version: Any = None
+
+        self._entries: OrderedDict[Hashable, tuple[Any, float, Any]] = OrderedDict()
+        self._inflight: dict[Hashable, asyncio.Task] = {}
+        self._waiters: dict[Hashable, int] = {}
+        self._task: asyncio.Task | None = None
+
+        self.hits = 0
+        self.misses = 0
+        self.stale_served = 0
+        self.coalesced = 0
+        self.loads = 0
+        self.load_errors = 0
+        self.invalidations = 0
+
+    async def start(self) -> None:
+        await self.refresh_version()
+        if self._task is None:
+            self._task = asyncio.create_task(self._poll())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    async def _poll(self) -> None:
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            await self.refresh_version()
+
+    async def refresh_version(self) -> None:
+        try:
+            version = await asyncio.to_thread(self.load_version)
+        except Exception as e:
+            logger.error(f"Failed to load the aggregates version: {e}")
+            return
+        if version != self.version:
+            if self.version is not None:
+                self.invalidations += 1
+                logger.info(f"Aggregates version moved to {version}, invalidating cached metrics")
+                if not self.stale_while_revalidate:
+                    self._entries.clear()
+            self.version = version
+
+    def _is_fresh(self, stored_at: float, version: Any) -> bool:
+        return version == self.version and time.monotonic() - stored_at < self.ttl
+
+    async def get(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, stored_at, version = entry
+            if self._is_fresh(stored_at, version):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            if self.stale_while_revalidate:
+                self._entries.move_to_end(key)
+                self.stale_served += 1
+                self._load(key, loader)
+                return value
+
+        if key in self._inflight:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+        task = self._load(key, loader)
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            # The load is shared: only cancel it once every caller waiting on it has gone away
+            if self._waiters[key] == 1 and not task.done():
+                task.cancel()
+            raise
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+
+    def _load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> asyncio.Task:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._run_loader(key, loader))
+            # Background refreshes have no awaiter; retrieve their exception so it is not reported as lost
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self._inflight[key] = task
+        return task
+
+    async def _run_loader(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        version = self.version
+        self.loads += 1
+        try:
+            value = await loader()
+        except Exception:
+            self.load_errors += 1
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+        self._entries[key] = (value, time.monotonic(), version)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return value
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses + self.stale_served + self.coalesced
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale_served": self.stale_served,
+            "coalesced": self.coalesced,
+            "hit_ratio": (self.hits + self.stale_served) / requests if requests else 0,
+            "saved_queries": self.hits + self.coalesced,
+            "loads": self.loads,
+            "load_errors": self.load_errors,
+            "invalidations": self.invalidations,
+            "version": str(self.version) if self.version is not None else None,
+        }
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import Optional
+from typing import Literal, Optional
 from datetime import datetime
 
 
@@ -26,6 +26,28 @@ class MetricsRequest(BaseModel):
     start_date: str
     end_date: str
 
+class MetricsBatchRequest(BaseModel):
+    page_urls: Optional[list[str]] = Field(None, example=["https://www.example.com/checkout"])
+    page_url_prefix: Optional[str] = Field(None, example="https://www.example.com/")
+    all_pages: bool = False
+    start_date: str
+    end_date: str
+    stream: bool = False
+
+class MetricsBreakdownRequest(BaseModel):
+    # Every page when not set
+    page_url: Optional[str] = Field(None, example="https://www.example.com/checkout")
+    start_date: str
+    end_date: str
+    dimensions: list[str] = Field(..., example=["platform", "device"])
+
+class MetricsTimeseriesRequest(BaseModel):
+    page_url: str
+    start_date: str
+    end_date: str
+    granularity: Literal["day", "week"] = "day"
+    stream: bool = False
+
 class MetricsResponse(BaseModel):
     page_url: str
     cart_percentage: float
@@ -33,4 +55,32 @@ class MetricsResponse(BaseModel):
     average_order_value: float
     revenue_per_session: float
     total_sessions: int
-    average_scroll_percentage: float
\ No newline at end of file
+    average_scroll_percentage: float
+
+class DimensionMetrics(BaseModel):
+    dimensions: dict[str, str] = Field(..., example={"platform": "web", "device": "mobile"})
+    cart_percentage: float
+    conversion_rate: float
+    average_order_value: float
+    revenue_per_session: float
+    total_sessions: int
+    average_scroll_percentage: float
+
+class MetricsBreakdownResponse(BaseModel):
+    page_url: Optional[str]
+    start_date: str
+    end_date: str
+    dimensions: list[str]
+    rows: list[DimensionMetrics]
+
+class MetricsTimeseriesResponse(BaseModel):
+    # Parallel arrays with one value per period that has data, in period order
+    page_url: str
+    granularity: str
+    period_start: list[str]
+    cart_percentage: list[float]
+    conversion_rate: list[float]
+    average_order_value: list[float]
+    revenue_per_session: list[float]
+    total_sessions: list[int]
+    average_scroll_percentage: list[float]
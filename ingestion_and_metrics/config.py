@@ -1,4 +1,10 @@
 import json
+import os
+import sys
+
+# The modules shared by both services (common/) live at the repository root. Appended, so a copy
+# of common/ deployed next to the service takes precedence.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 
 
 def load_config(section: str):
@@ -15,6 +21,106 @@ sessions_table_id = ".".join([dataset_id, config['sessions_table']])
 checkout_completed_table_id = ".".join([dataset_id, config['checkout_completed_table']])
 revenue_table_id = ".".join([dataset_id, config['revenue_table']])
 scroll_table_id = ".".join([dataset_id, config['scroll_values_table']])
+page_daily_metrics_table_id = ".".join([dataset_id, config.get('page_daily_metrics_table', 'page_daily_metrics')])
+page_weekly_metrics_table_id = ".".join([dataset_id, config.get('page_weekly_metrics_table', 'page_weekly_metrics')])
+page_monthly_metrics_table_id = ".".join([dataset_id, config.get('page_monthly_metrics_table', 'page_monthly_metrics')])
+dimension_metrics_table_id = ".".join([dataset_id, config.get('dimension_metrics_table', 'page_dimension_metrics')])
 base_table_id = ".".join([dataset_id, config['base_table']])
+metadata_table_id = ".".join([dataset_id, 'metadata_table'])
 creds=config['credentials_file']
-scopes=config['scopes']
\ No newline at end of file
+scopes=config['scopes']
+
+backend_config = load_config(section='backend')
+# "bigquery", or "local" to serve metrics from a SQLite database shared with the aggregator
+backend = backend_config.get('type', 'bigquery')
+local_database = backend_config.get('database', '../local/analytics.db')
+
+ingestion_config = load_config(section='ingestion')
+
+batch_size = ingestion_config.get('batch_size', 500)
+flush_interval = ingestion_config.get('flush_interval_ms', 200) / 1000
+queue_size = ingestion_config.get('queue_size', 10000)
+max_batch_events = ingestion_config.get('max_batch_events', 1000)
+max_batch_bytes = ingestion_config.get('max_batch_bytes', 5 * 1024 * 1024)
+
+spool_config = load_config(section='spool')
+
+spool_enabled = spool_config.get('enabled', False)
+spool_directory = spool_config.get('directory', 'spool')
+spool_segment_bytes = spool_config.get('segment_mb', 64) * 1024 * 1024
+ship_batch_size = spool_config.get('ship_batch_size', 5000)
+ship_interval = spool_config.get('ship_interval_ms', 1000) / 1000
+ship_max_backoff = spool_config.get('max_backoff_s', 60)
+spool_sink = spool_config.get('sink', 'bigquery')
+local_sink_path = spool_config.get('local_sink_path', 'spool/local_sink.ndjson')
+
+dedup_config = load_config(section='dedup')
+
+dedup_enabled = dedup_config.get('enabled', True)
+dedup_window = dedup_config.get('window_s', 600)
+dedup_bloom_capacity = dedup_config.get('bloom_capacity', 1_000_000)
+dedup_bloom_error_rate = dedup_config.get('bloom_error_rate', 0.001)
+dedup_lru_size = dedup_config.get('lru_size', 100_000)
+dedup_drop_probable = dedup_config.get('drop_probable_duplicates', False)
+
+admission_config = load_config(section='admission')
+
+admission_enabled = admission_config.get('enabled', True)
+max_pending_events = admission_config.get('max_pending_events', 8000)
+max_in_flight_requests = admission_config.get('max_in_flight_requests', 1000)
+retry_after = admission_config.get('retry_after_s', 5)
+event_priorities = admission_config.get('priorities')
+
+metrics_cache_config = load_config(section='metrics_cache')
+
+metrics_cache_enabled = metrics_cache_config.get('enabled', True)
+metrics_cache_max_entries = metrics_cache_config.get('max_entries', 10000)
+metrics_cache_ttl = metrics_cache_config.get('ttl_s', 300)
+metrics_cache_swr = metrics_cache_config.get('stale_while_revalidate', False)
+metrics_cache_poll_interval = metrics_cache_config.get('watermark_poll_s', 30)
+
+rollups_config = load_config(section='rollups')
+
+# Rollups of page_daily_metrics the metrics queries may read ("month", "week"); empty reads only daily rows
+rollup_granularities = rollups_config.get('granularities', ['month', 'week'])
+
+cube_config = load_config(section='cube')
+
+# Dimensions of the aggregator's cube, in the same order; /get_metrics/breakdown groups by any subset of them
+cube_dimensions = cube_config.get('dimensions', ['platform', 'device'])
+
+timeseries_config = load_config(section='timeseries')
+
+# Periods per NDJSON line of a streamed /get_metrics/timeseries response
+timeseries_chunk_periods = timeseries_config.get('chunk_periods', 90)
+# Decimal places the time series ratios are rounded to, to keep payloads small
+timeseries_decimals = timeseries_config.get('decimals', 4)
+
+realtime_config = load_config(section='realtime')
+
+realtime_enabled = realtime_config.get('enabled', False)
+realtime_bucket = realtime_config.get('bucket_ms', 1000) / 1000
+realtime_poll_interval = realtime_config.get('watermark_poll_s', 5)
+realtime_retention = realtime_config.get('retention_s', 120)
+realtime_max_events = realtime_config.get('max_events', 500000)
+
+query_budget_config = load_config(section='query_budget')
+
+# Estimate every budgeted metrics query with a (free) dry run and reject it before it runs if over budget
+query_dry_run = query_budget_config.get('dry_run', False)
+# maximum_bytes_billed of each query an endpoint runs; endpoints left out (or null) are not capped
+max_bytes_billed = {endpoint: mb * 1024 * 1024 for endpoint, mb in query_budget_config.get('max_mb_billed', {}).items() if mb}
+# "fallback" retries an over-budget request on a cheaper source where there is one, "reject" fails it with a 400
+over_budget = query_budget_config.get('over_budget', 'fallback')
+
+query_engine_config = load_config(section='query_engine')
+
+query_max_concurrency = query_engine_config.get('max_concurrency', 16)
+query_timeout = query_engine_config.get('timeout_s', 30)
+disconnect_poll_interval = query_engine_config.get('disconnect_poll_ms', 500) / 1000
+instrumentation_config = load_config(section='instrumentation')
+
+# Fraction of /get_metrics requests traced; sampled requests slower than slow_request_ms are logged and kept for /traces
+trace_sample_rate = instrumentation_config.get('trace_sample_rate', 0.0)
+trace_slow_threshold = instrumentation_config.get('slow_request_ms', 500) / 1000
+trace_max_traces = instrumentation_config.get('max_traces', 100)
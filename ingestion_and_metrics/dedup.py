@@ -0,0 +1,124 @@
+import hashlib
+import math
+import time
+from collections import OrderedDict
+
+
+class BloomFilter:
+    """
+    Fixed-size Bloom filter sized for `capacity` keys at the given false positive rate.
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, key: str) -> list[int]:
+        # Double hashing over a single 128-bit digest; filters of the same size share positions
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key: str, positions: list[int] | None = None) -> None:
+        bits = self.bits
+        for position in positions or self.positions(key):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def contains(self, key: str, positions: list[int] | None = None) -> bool:
+        bits = self.bits
+        for position in positions or self.positions(key):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def __contains__(self, key: str) -> bool:
+        return self.contains(key)
+
+
+class DedupIndex:
+    """
+    Time-windowed index of recently seen event ids.
+
+    An exact LRU holds the most recent `lru_size` ids and is authoritative: an id found there
+    within the window is a duplicate. Two rotating Bloom filters remember ids for the rest of the
+    window in bounded memory; an id that only the Bloom filters have seen is a *probable*
+    duplicate and is only dropped when `drop_probable` is set, since a false positive would
+    lose a real event. Anything that slips through is still caught by BigQuery's insertId dedup.
+    """
+
+    def __init__(self, window_seconds: float = 600, bloom_capacity: int = 1_000_000,
+                 bloom_error_rate: float = 0.001, lru_size: int = 100_000, drop_probable: bool = False):
+        self.window_seconds = window_seconds
+        self.bloom_capacity = bloom_capacity
+        self.bloom_error_rate = bloom_error_rate
+        self.lru_size = lru_size
+        self.drop_probable = drop_probable
+
+        self._recent: OrderedDict[str, float] = OrderedDict()
+        self._current = BloomFilter(bloom_capacity, bloom_error_rate)
+        self._previous = BloomFilter(bloom_capacity, bloom_error_rate)
+        self._rotated_at = time.monotonic()
+
+        self.hits = 0
+        self.probable_hits = 0
+        self.misses = 0
+        self.rotations = 0
+
+    def _rotate(self, now: float) -> None:
+        # Each generation covers half the window, so ids are remembered for between
+        # window/2 and window seconds
+        if now - self._rotated_at >= self.window_seconds / 2 or self._current.count >= self.bloom_capacity:
+            self._previous = self._current
+            self._current = BloomFilter(self.bloom_capacity, self.bloom_error_rate)
+            self._rotated_at = now
+            self.rotations += 1
+
+    def is_duplicate(self, event_id: str | None) -> bool:
+        """
+        Record `event_id` and return whether it should be dropped as a duplicate.
+        """
+        if not event_id:
+            return False
+
+        now = time.monotonic()
+        self._rotate(now)
+
+        seen_at = self._recent.get(event_id)
+        if seen_at is not None and now - seen_at < self.window_seconds:
+            self._recent.move_to_end(event_id)
+            self.hits += 1
+            return True
+
+        positions = self._current.positions(event_id)
+        probable = self._current.contains(event_id, positions) or self._previous.contains(event_id, positions)
+        self._recent[event_id] = now
+        self._recent.move_to_end(event_id)
+        if len(self._recent) > self.lru_size:
+            self._recent.popitem(last=False)
+        self._current.add(event_id, positions)
+
+        if probable:
+            self.probable_hits += 1
+            return self.drop_probable
+        self.misses += 1
+        return False
+
+    def memory_bytes(self) -> int:
+        # Rough estimate: the Bloom bit arrays plus ~100 bytes per LRU entry
+        return len(self._current.bits) + len(self._previous.bits) + len(self._recent) * 100
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.probable_hits + self.misses
+        return {
+            "hits": self.hits,
+            "probable_hits": self.probable_hits,
+            "misses": self.misses,
+            "hit_ratio": (self.hits + self.probable_hits) / lookups if lookups else 0,
+            "lru_entries": len(self._recent),
+            "bloom_rotations": self.rotations,
+            "memory_bytes": self.memory_bytes(),
+        }
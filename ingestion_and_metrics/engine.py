@@ -0,0 +1,303 @@
+import asyncio
+import concurrent.futures
+import logging
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from functools import partial
+from typing import Any, AsyncIterator, Awaitable
+from fastapi import HTTPException, Request
+from google.cloud import bigquery
+from common.instrumentation import registry
+from tracing import add_span
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+QUERY_QUEUE_SECONDS = registry.histogram("bigquery_query_queue_seconds", "Time metrics queries wait for a query slot", ("query",))
+QUERY_SECONDS = registry.histogram("bigquery_query_seconds", "Duration of metrics queries, from job submission to the last row", ("query",))
+QUERY_BYTES_PROCESSED = registry.counter("bigquery_bytes_processed_total", "Bytes processed by metrics queries", ("query",))
+QUERY_SLOT_MILLIS = registry.counter("bigquery_slot_millis_total", "Slot milliseconds used by metrics queries", ("query",))
+QUERY_RESULTS = registry.counter("bigquery_queries_total", "Metrics queries by outcome", ("query", "outcome"))
+QUERY_ESTIMATED_BYTES = registry.counter("bigquery_estimated_bytes_total", "Bytes metrics queries were estimated to process by dry runs", ("query",))
+
+
+class QueryBudgetExceeded(HTTPException):
+    """
+    A query whose dry run estimate, or whose job, went over its `maximum_bytes_billed`.
+    """
+
+    def __init__(self, name: str, max_bytes_billed: int, estimated_bytes: int | None = None):
+        scanned = f"would process {estimated_bytes / 1e6:.0f} MB" if estimated_bytes is not None else "was stopped by BigQuery"
+        super().__init__(status_code=400, detail=f"Query {name} {scanned}, over its budget of {max_bytes_billed / 1e6:.0f} MB. "
+                                                 f"Narrow the date range or the pages.")
+        self.name = name
+        self.max_bytes_billed = max_bytes_billed
+        self.estimated_bytes = estimated_bytes
+
+
+def is_bytes_billed_limit_error(e: Exception) -> bool:
+    return any(error.get('reason') == 'bytesBilledLimitExceeded' for error in getattr(e, 'errors', None) or [])
+
+
+class QueryStats:
+    def __init__(self):
+        self.count = 0
+        self.over_budget = 0
+        self.dry_runs = 0
+        self.estimated_bytes = 0
+        self.processed_bytes = 0
+        self.billed_bytes = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self.execution_total = 0.0
+        self.execution_max = 0.0
+
+    def record(self, queue_wait: float, execution: float) -> None:
+        self.count += 1
+        self.queue_wait_total += queue_wait
+        self.queue_wait_max = max(self.queue_wait_max, queue_wait)
+        self.execution_total += execution
+        self.execution_max = max(self.execution_max, execution)
+
+    def record_estimate(self, estimated: int) -> None:
+        self.dry_runs += 1
+        self.estimated_bytes += estimated
+
+    def record_bytes(self, processed: int, billed: int) -> None:
+        self.processed_bytes += processed
+        self.billed_bytes += billed
+
+    def as_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "over_budget": self.over_budget,
+            "dry_runs": self.dry_runs,
+            "estimated_bytes": self.estimated_bytes,
+            "processed_bytes": self.processed_bytes,
+            "billed_bytes": self.billed_bytes,
+            "avg_queue_wait_ms": self.queue_wait_total / self.count * 1000 if self.count else 0,
+            "max_queue_wait_ms": self.queue_wait_max * 1000,
+            "avg_execution_ms": self.execution_total / self.count * 1000 if self.count else 0,
+            "max_execution_ms": self.execution_max * 1000,
+        }
+
+
+class QueryEngine:
+    """
+    Runs BigQuery queries without blocking the event loop.
+
+    At most `max_concurrency` queries run at once, each on a dedicated worker thread; further
+    queries wait for a slot. A slot is held while a job runs and while a page of its rows is
+    fetched, not while the caller consumes them, so slow readers of a streamed response don't hold
+    up other queries. A query that does not finish within `timeout` seconds, or whose
+    caller is cancelled (e.g. the client disconnected), has its BigQuery job cancelled.
+    Time spent waiting for a slot and time spent executing are recorded separately per query name.
+
+    A query given a `max_bytes_billed` budget runs with `maximum_bytes_billed` set, so BigQuery fails
+    it instead of billing more. With `dry_run` set it is first estimated with a (free) dry run and
+    rejected before it runs if the estimate is over budget. Either way it raises QueryBudgetExceeded.
+    """
+
+    def __init__(self, client: bigquery.Client, max_concurrency: int = 16, timeout: float = 30.0, page_size: int = 10000,
+                 dry_run: bool = False):
+        self.client = client
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.page_size = page_size
+        self.dry_run = dry_run
+        self._executor: ThreadPoolExecutor | None = None
+        self._semaphore: asyncio.Semaphore | None = None
+
+        self.queued = 0
+        self.running = 0
+        self.timeouts = 0
+        self.cancelled = 0
+        self.failures = 0
+        self.over_budget = 0
+        self.query_stats: dict[str, QueryStats] = defaultdict(QueryStats)
+
+    async def start(self) -> None:
+        # Extra threads so a timed-out query still waiting on its cancellation does not hold up a free slot
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency * 2, thread_name_prefix="bigquery-query")
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    async def stop(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _cancel_job(self, job: bigquery.QueryJob) -> None:
+        def cancel():
+            try:
+                self.client.cancel_job(job.job_id, project=job.project, location=job.location)
+            except Exception as e:
+                logger.warning(f"Failed to cancel BigQuery job {job.job_id}: {e}")
+        try:
+            # Run outside the query pool, which may be saturated
+            asyncio.get_running_loop().run_in_executor(None, cancel)
+        except RuntimeError:
+            cancel()
+
+    def estimate(self, query: str, job_config: bigquery.QueryJobConfig | None = None) -> int:
+        """
+        Bytes `query` would process, from a dry run. Blocking.
+        """
+        config = bigquery.QueryJobConfig.from_api_repr(job_config.to_api_repr()) if job_config else bigquery.QueryJobConfig()
+        config.dry_run = True
+        config.use_query_cache = False
+        return self.client.query(query, job_config=config).total_bytes_processed or 0
+
+    async def _acquire(self) -> float:
+        """
+        Wait for a query slot; returns the time spent waiting.
+        """
+        queued_at = time.perf_counter()
+        self.queued += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.queued -= 1
+        self.running += 1
+        return time.perf_counter() - queued_at
+
+    def _release(self) -> None:
+        self.running -= 1
+        self._semaphore.release()
+
+    async def iterate(self, query: str, *, name: str = "query", job_config: bigquery.QueryJobConfig | None = None,
+                      timeout: float | None = None, max_bytes_billed: int | None = None) -> AsyncIterator[Any]:
+        """
+        Run `query` and yield its rows page by page.
+        """
+        if self._executor is None:
+            raise RuntimeError("QueryEngine has not been started")
+        timeout = timeout or self.timeout
+        loop = asyncio.get_running_loop()
+
+        queued_at = time.perf_counter()
+        queue_wait = await self._acquire()
+        holding_slot = True
+        started = time.perf_counter()
+        add_span(f"query {name} queue", queued_at, started)
+
+        job = None
+        completed = False
+        outcome = "failed"
+        estimated = None
+        try:
+            if max_bytes_billed:
+                if self.dry_run:
+                    estimated = await asyncio.wait_for(
+                        loop.run_in_executor(self._executor, self.estimate, query, job_config), timeout)
+                    QUERY_ESTIMATED_BYTES.labels(name).inc(estimated)
+                    self.query_stats[name].record_estimate(estimated)
+                    add_span(f"query {name} dry run", started, time.perf_counter())
+                    if estimated > max_bytes_billed:
+                        raise QueryBudgetExceeded(name, max_bytes_billed, estimated)
+                job_config = bigquery.QueryJobConfig.from_api_repr(job_config.to_api_repr()) if job_config else bigquery.QueryJobConfig()
+                job_config.maximum_bytes_billed = max_bytes_billed
+            job = await loop.run_in_executor(self._executor, partial(self.client.query, query, job_config=job_config))
+            try:
+                rows = await asyncio.wait_for(
+                    loop.run_in_executor(self._executor, partial(job.result, timeout=timeout, page_size=self.page_size)), timeout)
+            except Exception as e:
+                if max_bytes_billed and is_bytes_billed_limit_error(e):
+                    raise QueryBudgetExceeded(name, max_bytes_billed)
+                raise
+            add_span(f"query {name}", started, time.perf_counter())
+            processed, billed = job.total_bytes_processed or 0, job.total_bytes_billed or 0
+            QUERY_BYTES_PROCESSED.labels(name).inc(processed)
+            QUERY_SLOT_MILLIS.labels(name).inc(job.slot_millis or 0)
+            self.query_stats[name].record_bytes(processed, billed)
+            if estimated is not None:
+                logger.info(f"Query {name}: estimated {estimated / 1e6:.1f} MB, processed {processed / 1e6:.1f} MB, "
+                            f"billed {billed / 1e6:.1f} MB")
+            pages = iter(rows.pages)
+            while True:
+                if not holding_slot:
+                    queue_wait += await self._acquire()
+                    holding_slot = True
+                page = await asyncio.wait_for(loop.run_in_executor(self._executor, next, pages, None), timeout)
+                # The caller may take its time over the rows: give the slot back until the next page
+                self._release()
+                holding_slot = False
+                if page is None:
+                    break
+                for row in page:
+                    yield row
+            completed = True
+            outcome = "completed"
+        except QueryBudgetExceeded as e:
+            self.over_budget += 1
+            self.query_stats[name].over_budget += 1
+            outcome = "over_budget"
+            logger.warning(e.detail)
+            raise
+        except (asyncio.TimeoutError, concurrent.futures.TimeoutError):
+            self.timeouts += 1
+            outcome = "timeout"
+            logger.error(f"Query {name} timed out after {timeout}s")
+            raise HTTPException(status_code=504, detail=f"Query {name} timed out.")
+        except (asyncio.CancelledError, GeneratorExit):
+            self.cancelled += 1
+            outcome = "cancelled"
+            raise
+        except Exception:
+            self.failures += 1
+            outcome = "failed"
+            raise
+        finally:
+            if job is not None and not completed:
+                self._cancel_job(job)
+            if holding_slot:
+                self._release()
+            execution = time.perf_counter() - started
+            self.query_stats[name].record(queue_wait, execution)
+            QUERY_QUEUE_SECONDS.labels(name).observe(queue_wait)
+            QUERY_SECONDS.labels(name).observe(execution)
+            QUERY_RESULTS.labels(name, outcome).inc()
+            logger.debug(f"Query {name}: waited {queue_wait * 1000:.1f} ms, ran {execution * 1000:.1f} ms")
+
+    async def run(self, query: str, **kwargs) -> list[Any]:
+        """
+        Run `query` and return all of its rows.
+        """
+        return [row async for row in self.iterate(query, **kwargs)]
+
+    def stats(self) -> dict:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "running": self.running,
+            "queued": self.queued,
+            "timeouts": self.timeouts,
+            "cancelled": self.cancelled,
+            "failures": self.failures,
+            "over_budget": self.over_budget,
+            "dry_run": self.dry_run,
+            "queries": {name: stats.as_dict() for name, stats in self.query_stats.items()},
+        }
+
+
+async def cancel_on_disconnect(request: Request, awaitable: Awaitable, poll_interval: float = 0.5) -> Any:
+    """
+    Await `awaitable`, cancelling it (and with it any running query) if the client goes away.
+    """
+    task = asyncio.ensure_future(awaitable)
+
+    async def watch():
+        while not task.done():
+            if await request.is_disconnected():
+                logger.info(f"Client disconnected from {request.url.path}, cancelling")
+                task.cancel()
+                return
+            await asyncio.sleep(poll_interval)
+
+    watcher = asyncio.create_task(watch())
+    try:
+        return await task
+    finally:
+        watcher.cancel()
+        with suppress(asyncio.CancelledError):
+            await watcher
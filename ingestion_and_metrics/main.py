@@ -1,13 +1,34 @@
 from __future__ import annotations
-import json
 import logging
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timezone
 from typing import Any
 import uvicorn
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse
 from pydantic import ValidationError
-from classes import EventPayload, MetricsRequest, MetricsResponse
-from bigquery import get_bigquery_metrics, get_bigquery_metrics_parallel, write_event_bigquery
+from classes import MetricsBatchRequest, MetricsBreakdownRequest, MetricsBreakdownResponse, MetricsRequest, MetricsResponse, MetricsTimeseriesRequest, MetricsTimeseriesResponse
+from bigquery import client, build_metrics_response, get_aggregates_version, get_aggregation_watermark, get_bigquery_breakdown, get_bigquery_counters, get_bigquery_metrics, get_bigquery_metrics_parallel, insert_event_rows, iter_bigquery_metrics_batch, iter_bigquery_timeseries, parse_date_range
+from config import batch_size, flush_interval, queue_size, max_batch_events, max_batch_bytes
+from config import spool_enabled, spool_directory, spool_segment_bytes, ship_batch_size, ship_interval, ship_max_backoff, spool_sink, local_sink_path
+from config import dedup_enabled, dedup_window, dedup_bloom_capacity, dedup_bloom_error_rate, dedup_lru_size, dedup_drop_probable
+from config import admission_enabled, max_pending_events, max_in_flight_requests, retry_after, event_priorities
+from config import metrics_cache_enabled, metrics_cache_max_entries, metrics_cache_ttl, metrics_cache_swr, metrics_cache_poll_interval
+from config import realtime_enabled, realtime_bucket, realtime_poll_interval, realtime_retention, realtime_max_events
+from config import query_max_concurrency, query_timeout, disconnect_poll_interval, query_dry_run
+from config import trace_sample_rate, trace_slow_threshold, trace_max_traces
+from config import timeseries_chunk_periods
+from admission import AdmissionController
+from cache import MetricsCache
+from dedup import DedupIndex
+from engine import QueryEngine, cancel_on_disconnect
+from common.instrumentation import CONTENT_TYPE, registry
+from tracing import Tracer, span
+from realtime import RealtimeCounters
+from spool import LocalSink, Spool, SpoolShipper
+from parsing import BatchDecodeError, decode_body, event_to_row, is_json_error, parse_event, parse_event_batch
+from writer import BatchWriter
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -18,8 +39,101 @@ import os
 # This is a list of shopify stores
 SHOPIFY_ORIGIN: list[str] = os.getenv("SHOPIFY_ORIGIN", ["https://shopify-domain.myshopify.com"])
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Metrics queries run on a bounded pool owned by the app so they never block the event loop
+    app.state.query_engine = QueryEngine(client, max_concurrency=query_max_concurrency, timeout=query_timeout,
+                                         dry_run=query_dry_run)
+    await app.state.query_engine.start()
+    await writer.start()
+    if shipper:
+        await shipper.start()
+    if metrics_cache:
+        await metrics_cache.start()
+    if realtime:
+        await realtime.start()
+
+    yield
+
+    await writer.stop()
+    if shipper:
+        await shipper.stop()
+        spool.close()
+    if metrics_cache:
+        await metrics_cache.stop()
+    if realtime:
+        await realtime.stop()
+    await app.state.query_engine.stop()
+
 # Create FastAPI app instance
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+
+# Events are buffered and written in batches by a background task. With the spool enabled the
+# batches go to a local write-ahead log first and a shipper drains it to BigQuery
+spool = None
+shipper = None
+if spool_enabled:
+    spool = Spool(spool_directory, segment_bytes=spool_segment_bytes)
+    sink = LocalSink(local_sink_path) if spool_sink == "local" else insert_event_rows
+    shipper = SpoolShipper(spool, sink, batch_size=ship_batch_size, poll_interval=ship_interval, max_backoff=ship_max_backoff)
+
+# Redelivered events (keepalive retries, pixel sandbox re-sends) are dropped before they reach the writer
+dedup = None
+if dedup_enabled:
+    dedup = DedupIndex(window_seconds=dedup_window, bloom_capacity=dedup_bloom_capacity, bloom_error_rate=dedup_bloom_error_rate,
+                       lru_size=dedup_lru_size, drop_probable=dedup_drop_probable)
+
+writer = BatchWriter(spool.append if spool else insert_event_rows, batch_size=batch_size, flush_interval=flush_interval, queue_size=queue_size)
+
+# Shed load before the write queue fills up; low-value events are shed first
+if admission_enabled:
+    admission = AdmissionController(writer.qsize, max_pending=max_pending_events, max_in_flight=max_in_flight_requests,
+                                    retry_after=retry_after, priorities=event_priorities)
+else:
+    # Only refuse events once the write queue itself is full
+    admission = AdmissionController(writer.qsize, max_pending=queue_size, max_in_flight=float("inf"),
+                                    retry_after=retry_after, priorities={}, default_priority=1.0)
+
+# Metrics only change when the aggregator runs, so responses are cached until the aggregates move
+metrics_cache = None
+if metrics_cache_enabled:
+    metrics_cache = MetricsCache(get_aggregates_version, max_entries=metrics_cache_max_entries, ttl=metrics_cache_ttl,
+                                 stale_while_revalidate=metrics_cache_swr, poll_interval=metrics_cache_poll_interval)
+
+# Counters of the events after the aggregation watermark, added to /get_metrics for sub-second freshness
+realtime = None
+if realtime_enabled:
+    realtime = RealtimeCounters(get_aggregation_watermark, bucket_s=realtime_bucket, poll_interval=realtime_poll_interval,
+                                retention_s=realtime_retention, max_events=realtime_max_events)
+
+# Request-path metrics; component state (queues, cache counters) is read when /metrics is scraped
+PARSE_SECONDS = registry.histogram("ingest_parse_seconds", "Time to decode and validate an ingest request body", ("endpoint",))
+INGESTED_EVENTS = registry.counter("ingest_events_total", "Events received by the ingest endpoints by outcome", ("endpoint", "outcome"))
+registry.callback("writer_queue_depth", "Rows waiting to be flushed by the writer", writer.qsize)
+registry.callback("admission_in_flight_requests", "Ingest requests being handled", lambda: admission.in_flight)
+registry.callback("admission_shed_events_total", "Events shed by admission control", lambda: dict(admission.shed),
+                  kind="counter", labelnames=("event_name",))
+registry.callback("query_engine_running", "Metrics queries running", lambda: app.state.query_engine.running)
+registry.callback("query_engine_queued", "Metrics queries waiting for a slot", lambda: app.state.query_engine.queued)
+if spool:
+    registry.callback("spool_depth_bytes", "Spooled bytes not shipped yet", spool.depth_bytes)
+if dedup:
+    registry.callback("dedup_lookups_total", "Event id lookups by result",
+                      lambda: {"hit": dedup.hits, "probable_hit": dedup.probable_hits, "miss": dedup.misses},
+                      kind="counter", labelnames=("result",))
+if metrics_cache:
+    registry.callback("metrics_cache_requests_total", "Metrics cache lookups by result",
+                      lambda: {"hit": metrics_cache.hits, "miss": metrics_cache.misses,
+                               "stale": metrics_cache.stale_served, "coalesced": metrics_cache.coalesced},
+                      kind="counter", labelnames=("result",))
+    registry.callback("metrics_cache_entries", "Cached metrics responses", lambda: metrics_cache.stats()["entries"])
+if realtime:
+    registry.callback("realtime_retained_events", "Events held by the realtime counters", lambda: realtime.stats()["retained_events"])
+    registry.callback("aggregation_watermark_lag_seconds", "Age of the aggregation watermark last read by the realtime counters",
+                      lambda: (datetime.now(timezone.utc) - realtime.watermark).total_seconds() if realtime.watermark else None)
+
+# Samples /get_metrics requests and logs the breakdown of the slow ones
+tracer = Tracer(sample_rate=trace_sample_rate, slow_threshold=trace_slow_threshold, max_traces=trace_max_traces)
 
 # Configure CORS
 app.add_middleware(
@@ -37,44 +151,236 @@ async def root() -> dict:
     """
     return {"message": "Rain check from the server!"}
 
+@app.get("/stats")
+async def stats() -> dict:
+    """
+    Ingestion pipeline statistics.
+    """
+    stats = {"writer": writer.stats(), "admission": admission.stats()}
+    if spool:
+        stats["spool"] = {**spool.stats(), **shipper.stats()}
+    if dedup:
+        stats["dedup"] = dedup.stats()
+    if metrics_cache:
+        stats["metrics_cache"] = metrics_cache.stats()
+    if realtime:
+        stats["realtime"] = realtime.stats()
+    stats["query_engine"] = app.state.query_engine.stats()
+    stats["tracing"] = tracer.stats()
+    return stats
+
+@app.get("/metrics")
+async def metrics() -> Response:
+    """
+    Metrics in the Prometheus text format.
+    """
+    return Response(registry.render(), media_type=CONTENT_TYPE)
+
+@app.get("/traces")
+async def traces() -> list[dict]:
+    """
+    The latest sampled /get_metrics requests slower than the tracing threshold.
+    """
+    return list(tracer.traces)
+
 @app.options("/ingest-gcp")
+@app.options("/ingest-gcp/batch")
 async def handle_options(request: Request) -> dict:
     """
     Handle OPTIONS request for CORS preflight.
     """
     return {"status": "ok"}
 
-@app.post("/ingest-gcp")
+@app.post("/ingest-gcp", status_code=202)
 async def ingest_event_gcp(request: Request) -> None:
     """
-    Endpoint to ingest events to GCP.
-    """
-    try:
-        body = await request.json()
-        event_payload = EventPayload(**body)
-        write_event_bigquery(event_payload)
-        logger.info("Event ingested to GCP successfully")
-    except ValidationError as e:
-        logger.error(f"Validation error: {e}")
-        raise HTTPException(status_code=400, detail="Invalid event payload")
-    except json.JSONDecodeError as e:
-        logger.error(f"JSON decode error: {e}")
-        raise HTTPException(status_code=400, detail="Invalid JSON payload")
-    except Exception as e:
-        logger.error(f"Error ingesting event to GCP: {e}")
-        raise HTTPException(status_code=500, detail="Internal server error")
-    
+    Endpoint to ingest events to GCP. Returns once the event is queued for writing.
+    """
+    with admission.request():
+        body = await request.body()
+        try:
+            with PARSE_SECONDS.labels("event").time():
+                event_payload = parse_event(body)
+        except ValidationError as e:
+            INGESTED_EVENTS.labels("event", "invalid").inc()
+            if is_json_error(e):
+                logger.error(f"JSON decode error: {e}")
+                raise HTTPException(status_code=400, detail="Invalid JSON payload")
+            logger.error(f"Validation error: {e}")
+            raise HTTPException(status_code=400, detail="Invalid event payload")
+
+        admission.admit_or_raise(event_payload.event_name)
+
+        try:
+            if dedup and dedup.is_duplicate(event_payload.event_id):
+                INGESTED_EVENTS.labels("event", "duplicate").inc()
+                logger.debug(f"Dropped duplicate event {event_payload.event_id}")
+                return
+            await writer.submit(event_to_row(event_payload))
+            if realtime:
+                realtime.add(event_payload)
+            INGESTED_EVENTS.labels("event", "accepted").inc()
+            logger.debug("Event accepted for ingestion")
+        except Exception as e:
+            logger.error(f"Error ingesting event to GCP: {e}")
+            raise HTTPException(status_code=500, detail="Internal server error")
+
+
+@app.post("/ingest-gcp/batch", status_code=202)
+async def ingest_events_batch_gcp(request: Request) -> dict:
+    """
+    Endpoint to ingest a batch of events, sent as a JSON array or NDJSON and optionally gzip-compressed.
+    Invalid items are reported by index and do not prevent the rest of the batch from being accepted.
+    Events shed by admission control are counted in the response; if every event is shed the
+    request fails with a 429 so the client can retry it.
+    """
+    with admission.request():
+        body = await request.body()
+        try:
+            with PARSE_SECONDS.labels("batch").time():
+                body = decode_body(body, request.headers.get("content-encoding"), max_batch_bytes)
+                events, errors = parse_event_batch(body, max_events=max_batch_events)
+        except BatchDecodeError as e:
+            logger.error(f"Batch decode error: {e}")
+            raise HTTPException(status_code=400, detail=str(e))
+
+        # Nothing is queued until the whole batch is admitted, so count the admitted events against the budget
+        admitted = []
+        for event_payload in events:
+            if admission.admit(event_payload.event_name, pending=len(admitted)):
+                admitted.append(event_payload)
+        shed = len(events) - len(admitted)
+        if events and not admitted:
+            raise HTTPException(status_code=429, detail="Shedding events, retry later",
+                                headers={"Retry-After": str(admission.retry_after)})
+
+        duplicates = 0
+        try:
+            for event_payload in admitted:
+                if dedup and dedup.is_duplicate(event_payload.event_id):
+                    duplicates += 1
+                    continue
+                await writer.submit(event_to_row(event_payload))
+                if realtime:
+                    realtime.add(event_payload)
+        except Exception as e:
+            logger.error(f"Error ingesting event batch to GCP: {e}")
+            raise HTTPException(status_code=500, detail="Internal server error")
+        INGESTED_EVENTS.labels("batch", "accepted").inc(len(admitted) - duplicates)
+        INGESTED_EVENTS.labels("batch", "duplicate").inc(duplicates)
+        INGESTED_EVENTS.labels("batch", "invalid").inc(len(errors))
+
+    if errors:
+        logger.error(f"Rejected {len(errors)} of {len(events) + len(errors)} events in batch")
+    return {"accepted": len(admitted) - duplicates, "duplicates": duplicates, "shed": shed,
+            "rejected": len(errors), "errors": errors}
+
+
+async def cached_metrics(request: MetricsRequest, loader, kind: str = "metrics", extra_key: tuple = ()) -> Any:
+    if metrics_cache is None:
+        return await loader()
+    key = (kind, request.page_url, request.start_date, request.end_date, *extra_key)
+    with span("metrics_cache"):
+        return await metrics_cache.get(key, loader)
+
+async def realtime_metrics(request: MetricsRequest, engine: QueryEngine) -> MetricsResponse:
+    """
+    Warehouse counters, cached until the aggregates move, plus the in-memory counters of the events
+    after the watermark they were read at.
+    """
+    start_date, end_date = parse_date_range(request.start_date, request.end_date)
+    counters = await cached_metrics(request, lambda: get_bigquery_counters(request, engine), kind="counters")
+    with span("realtime_merge"):
+        merged = realtime.merge(counters, request.page_url, date.fromisoformat(start_date), date.fromisoformat(end_date))
+    if merged is None:
+        raise HTTPException(status_code=404, detail="No data found for the given page URL and date range.")
+    return build_metrics_response(request.page_url, **merged)
 
 @app.post("/get_metrics")
-async def get_metrics(request: MetricsRequest) -> MetricsResponse:
-    metrics = get_bigquery_metrics(request)
+async def get_metrics(request: MetricsRequest, http_request: Request) -> MetricsResponse:
+    engine = http_request.app.state.query_engine
+    with tracer.trace("get_metrics", page_url=request.page_url, start_date=request.start_date, end_date=request.end_date):
+        if realtime:
+            loader = realtime_metrics(request, engine)
+        else:
+            loader = cached_metrics(request, lambda: get_bigquery_metrics(request, engine))
+        metrics = await cancel_on_disconnect(http_request, loader, disconnect_poll_interval)
     return metrics
 
 @app.post("/get_metrics_parallel")
-async def get_metrics_parallel(request: MetricsRequest) -> MetricsResponse:
-    metrics = await get_bigquery_metrics_parallel(request)
+async def get_metrics_parallel(request: MetricsRequest, http_request: Request) -> MetricsResponse:
+    engine = http_request.app.state.query_engine
+    metrics = await cancel_on_disconnect(
+        http_request, cached_metrics(request, lambda: get_bigquery_metrics_parallel(request, engine)), disconnect_poll_interval)
     return metrics
 
 
+@app.post("/get_metrics/breakdown")
+async def get_metrics_breakdown(request: MetricsBreakdownRequest, http_request: Request) -> MetricsBreakdownResponse:
+    """
+    Metrics of a page, or of every page without `page_url`, per value of one or more cube dimensions
+    (e.g. platform and device), read from the dimension cube kept by the aggregator.
+    """
+    engine = http_request.app.state.query_engine
+    loader = cached_metrics(request, lambda: get_bigquery_breakdown(request, engine), kind="breakdown",
+                            extra_key=tuple(sorted(request.dimensions)))
+    return await cancel_on_disconnect(http_request, loader, disconnect_poll_interval)
+
+
+@app.post("/get_metrics/timeseries", response_model=None)
+async def get_metrics_timeseries(request: MetricsTimeseriesRequest, http_request: Request) -> MetricsTimeseriesResponse | StreamingResponse:
+    """
+    Metrics of a page per day or week of a range from one grouped query, as parallel arrays. With
+    `stream` set they are sent as NDJSON, `timeseries.chunk_periods` periods per line.
+    """
+    parse_date_range(request.start_date, request.end_date)
+    engine = http_request.app.state.query_engine
+    if request.stream:
+        results = iter_bigquery_timeseries(request, engine, timeseries_chunk_periods)
+        # Wait for the first chunk so a rejected query (e.g. over budget) still gets its status code
+        first = await cancel_on_disconnect(http_request, anext(results), disconnect_poll_interval)
+
+        async def lines():
+            yield first.model_dump_json() + "\n"
+            async for chunk in results:
+                yield chunk.model_dump_json() + "\n"
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+    async def load():
+        return await anext(iter_bigquery_timeseries(request, engine))
+    loader = cached_metrics(request, load, kind="timeseries", extra_key=(request.granularity,))
+    return await cancel_on_disconnect(http_request, loader, disconnect_poll_interval)
+
+
+@app.post("/get_metrics/batch", response_model=None)
+async def get_metrics_batch(request: MetricsBatchRequest, http_request: Request) -> list[MetricsResponse] | StreamingResponse:
+    """
+    Metrics for a list of pages, every page with a URL prefix, or all pages, from one grouped query.
+    With `stream` set the results are sent as NDJSON while they are read from BigQuery.
+    """
+    selectors = [request.page_urls is not None, request.page_url_prefix is not None, request.all_pages]
+    if sum(selectors) != 1:
+        raise HTTPException(status_code=400, detail="Set exactly one of page_urls, page_url_prefix or all_pages.")
+    # Validate up front: once streaming has started the status code can no longer change
+    parse_date_range(request.start_date, request.end_date)
+
+    engine = http_request.app.state.query_engine
+    if request.stream:
+        results = iter_bigquery_metrics_batch(request, engine)
+        # Wait for the first row so a rejected query (e.g. over budget) still gets its status code
+        first = await cancel_on_disconnect(http_request, anext(results, None), disconnect_poll_interval)
+
+        async def lines():
+            if first is None:
+                return
+            yield first.model_dump_json() + "\n"
+            async for metrics in results:
+                yield metrics.model_dump_json() + "\n"
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+    async def collect():
+        return [metrics async for metrics in iter_bigquery_metrics_batch(request, engine)]
+    return await cancel_on_disconnect(http_request, collect(), disconnect_poll_interval)
+
 if __name__ == "__main__":
     uvicorn.run("main:app", host="0.0.0.0", port=8000)
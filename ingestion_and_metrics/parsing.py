@@ -0,0 +1,101 @@
+import gzip
+import io
+import json
+from pydantic import TypeAdapter, ValidationError
+from classes import EventPayload
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+event_list_adapter = TypeAdapter(list[EventPayload])
+
+
+class BatchDecodeError(ValueError):
+    pass
+
+
+def decode_body(body: bytes, content_encoding: str | None = None, max_bytes: int | None = None) -> bytes:
+    """
+    Return the raw request body, gunzipping it when it is gzip-compressed. Raises BatchDecodeError
+    when the body, decompressed or not, exceeds `max_bytes`.
+    """
+    if (content_encoding or '').lower() != 'gzip' and not body.startswith(GZIP_MAGIC):
+        if max_bytes and len(body) > max_bytes:
+            raise BatchDecodeError(f"Body exceeds {max_bytes} bytes")
+        return body
+    try:
+        with gzip.GzipFile(fileobj=io.BytesIO(body)) as f:
+            data = f.read(max_bytes + 1 if max_bytes else -1)
+    except (OSError, EOFError) as e:
+        raise BatchDecodeError(f"Invalid gzip body: {e}")
+    if max_bytes and len(data) > max_bytes:
+        raise BatchDecodeError(f"Decompressed body exceeds {max_bytes} bytes")
+    return data
+
+
+def parse_event(body: bytes) -> EventPayload:
+    """
+    Decode and validate a raw JSON body in a single pass, without building an intermediate dict.
+    """
+    return EventPayload.model_validate_json(body)
+
+
+def is_json_error(e: ValidationError) -> bool:
+    return any(err['type'] == 'json_invalid' for err in e.errors())
+
+
+def event_to_row(event_payload: EventPayload) -> dict:
+    """
+    Build the insert-ready row: timestamps are serialized by pydantic-core and unset fields
+    are left out, which BigQuery treats as NULL.
+    """
+    return event_payload.model_dump(mode='json', exclude_none=True)
+
+
+def _format_validation_error(e: ValidationError) -> list[str]:
+    return [f"{'.'.join(str(part) for part in err['loc']) or 'event'}: {err['msg']}" for err in e.errors()]
+
+
+def parse_event_batch(body: bytes, max_events: int | None = None) -> tuple[list[EventPayload], list[dict]]:
+    """
+    Parse a JSON array or NDJSON body into events in a single pass.
+
+    Returns the valid events and a list of `{"index", "errors"}` entries for the items
+    that could not be decoded or validated. Raises BatchDecodeError if the body as a whole
+    is unusable.
+    """
+    body = body.strip()
+    if not body:
+        return [], []
+
+    if body.startswith(b'['):
+        # Fast path: the whole array validates in one pass inside pydantic-core
+        try:
+            events = event_list_adapter.validate_json(body)
+        except ValidationError:
+            pass
+        else:
+            if max_events and len(events) > max_events:
+                raise BatchDecodeError(f"Batch contains {len(events)} events, the limit is {max_events}")
+            return events, []
+
+        try:
+            items = json.loads(body)
+        except json.JSONDecodeError as e:
+            raise BatchDecodeError(f"Invalid JSON array: {e}")
+    else:
+        items = [line for line in body.splitlines() if line.strip()]
+
+    if max_events and len(items) > max_events:
+        raise BatchDecodeError(f"Batch contains {len(items)} events, the limit is {max_events}")
+
+    events: list[EventPayload] = []
+    errors: list[dict] = []
+    for index, item in enumerate(items):
+        try:
+            if isinstance(item, bytes):
+                events.append(EventPayload.model_validate_json(item))
+            else:
+                events.append(EventPayload.model_validate(item))
+        except ValidationError as e:
+            errors.append({"index": index, "errors": _format_validation_error(e)})
+    return events, errors
@@ -0,0 +1,225 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import suppress
+from datetime import date, datetime, timezone
+from typing import Any, Callable
+from classes import EventPayload
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SCROLL_EVENTS = ("page_scroll", "page_viewed")
+
+
+class _PageCounters:
+    """
+    Counters of one page in one bucket, named like the daily page metrics columns. The events'
+    times and values are kept too, to count the part of a bucket after a watermark inside it.
+    """
+    __slots__ = ("add_to_cart_events", "checkout_completed", "total_revenue", "total_scroll_sum", "total_scroll_events",
+                 "sessions", "events")
+
+    def __init__(self):
+        self.add_to_cart_events = 0
+        self.checkout_completed = 0
+        self.total_revenue = 0.0
+        self.total_scroll_sum = 0.0
+        self.total_scroll_events = 0
+        self.sessions: set[str] = set()
+        self.events: list[tuple[float, str, float | None, str | None]] = []
+
+    def add(self, timestamp: float, event_name: str, value: float | None, session_id: str | None) -> None:
+        if event_name == "product_added_to_cart":
+            self.add_to_cart_events += 1
+        elif event_name == "checkout_completed":
+            self.checkout_completed += 1
+            self.total_revenue += value or 0
+        elif event_name in SCROLL_EVENTS:
+            self.total_scroll_events += 1
+            self.total_scroll_sum += value or 0
+        if session_id is not None:
+            self.sessions.add(session_id)
+
+    def update(self, other: "_PageCounters") -> None:
+        self.add_to_cart_events += other.add_to_cart_events
+        self.checkout_completed += other.checkout_completed
+        self.total_revenue += other.total_revenue
+        self.total_scroll_sum += other.total_scroll_sum
+        self.total_scroll_events += other.total_scroll_events
+        self.sessions |= other.sessions
+
+
+class RealtimeCounters:
+    """
+    In-memory counters of the events ingested by this process, per page_url and `bucket_s` seconds
+    of event time, computed like the daily page metrics.
+
+    The warehouse holds every event up to the aggregation watermark, so a metrics request adds the
+    buckets ending after the watermark its warehouse counters were read at (see `merge`). Sessions are
+    counted exactly over those buckets and added to the warehouse count, so a session active on both
+    sides of the watermark counts twice. A background task polls the watermark; buckets it has passed
+    are dropped once it has been there for `retention_s`, which leaves cached warehouse counters read
+    before it moved the buckets they still need. At most `max_events` events are kept, dropping the
+    oldest buckets first. Counters are per process, so they only complete the warehouse numbers when a
+    single instance ingests every event.
+    """
+
+    def __init__(self, load_watermark: Callable[[], datetime | None], bucket_s: float = 1.0, poll_interval: float = 5,
+                 retention_s: float = 120, max_events: int = 500000):
+        self.load_watermark = load_watermark
+        self.bucket_s = bucket_s
+        self.poll_interval = poll_interval
+        self.retention_s = retention_s
+        self.max_events = max_events
+        self.watermark: datetime | None = None
+
+        self._buckets: dict[int, dict[str, _PageCounters]] = {}
+        self._retained = 0
+        # (observed at, watermark) pairs younger than the retention, oldest first
+        self._history: deque[tuple[float, datetime]] = deque()
+        self._evicted_until = float("-inf")
+        self._task: asyncio.Task | None = None
+
+        self.events = 0
+        self.behind_watermark = 0
+        self.evicted_buckets = 0
+        self.dropped_buckets = 0
+        self.dropped_events = 0
+        self.stale_merges = 0
+
+    async def start(self) -> None:
+        await self.refresh_watermark()
+        if self._task is None:
+            self._task = asyncio.create_task(self._poll())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    async def _poll(self) -> None:
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            await self.refresh_watermark()
+
+    async def refresh_watermark(self) -> None:
+        try:
+            watermark = await asyncio.to_thread(self.load_watermark)
+        except Exception as e:
+            logger.error(f"Failed to load the aggregation watermark: {e}")
+            return
+        if watermark is None:
+            return
+        self.watermark = watermark
+        now = time.monotonic()
+        self._history.append((now, watermark))
+        # Evict up to the latest watermark observed at least `retention_s` ago
+        evict_until = None
+        while self._history and self._history[0][0] <= now - self.retention_s:
+            evict_until = self._history.popleft()[1]
+        if evict_until is not None:
+            self._evict(evict_until.timestamp())
+
+    def _bucket_end(self, bucket: int) -> float:
+        return (bucket + 1) * self.bucket_s
+
+    def _pop(self, bucket: int) -> None:
+        self._retained -= sum(len(counters.events) for counters in self._buckets.pop(bucket).values())
+        self._evicted_until = max(self._evicted_until, self._bucket_end(bucket))
+
+    def _evict(self, until: float) -> None:
+        for bucket in [bucket for bucket in self._buckets if self._bucket_end(bucket) <= until]:
+            self._pop(bucket)
+            self.evicted_buckets += 1
+        self._evicted_until = max(self._evicted_until, until)
+
+    def add(self, event: EventPayload) -> None:
+        if event.event_time is None or event.page_url is None:
+            return
+        event_time = event.event_time if event.event_time.tzinfo else event.event_time.replace(tzinfo=timezone.utc)
+        bucket = int(event_time.timestamp() // self.bucket_s)
+        if self._bucket_end(bucket) <= self._evicted_until:
+            # Already behind the warehouse's watermark; the late events script picks it up
+            self.behind_watermark += 1
+            return
+        if self._retained >= self.max_events and self._buckets:
+            oldest = min(self._buckets)
+            if oldest >= bucket:
+                self.dropped_events += 1
+                return
+            self._pop(oldest)
+            self.dropped_buckets += 1
+        pages = self._buckets.setdefault(bucket, {})
+        counters = pages.get(event.page_url)
+        if counters is None:
+            counters = pages[event.page_url] = _PageCounters()
+        value = event.order_value if event.event_name == "checkout_completed" else event.percent_scroll
+        timestamp = event_time.timestamp()
+        counters.add(timestamp, event.event_name, value, event.session_id)
+        counters.events.append((timestamp, event.event_name, value, event.session_id))
+        self._retained += 1
+        self.events += 1
+
+    def tail(self, page_url: str, start_date: date, end_date: date, watermark: datetime | None) -> dict | None:
+        """
+        Counters of the page's events after `watermark` (every event if None) with an event date from
+        `start_date` to `end_date`, or None if there are none.
+        """
+        after = watermark.timestamp() if watermark is not None else float("-inf")
+        if after < self._evicted_until:
+            self.stale_merges += 1
+        tail = _PageCounters()
+        found = False
+        for bucket, pages in self._buckets.items():
+            counters = pages.get(page_url)
+            if counters is None or self._bucket_end(bucket) <= after:
+                continue
+            if not start_date <= datetime.fromtimestamp(bucket * self.bucket_s, timezone.utc).date() <= end_date:
+                continue
+            if bucket * self.bucket_s > after:
+                tail.update(counters)
+                found = True
+                continue
+            # The watermark falls inside this bucket: only count its events after it
+            for event in counters.events:
+                if event[0] > after:
+                    tail.add(*event)
+                    found = True
+        if not found:
+            return None
+        return {
+            "add_to_cart_events": tail.add_to_cart_events,
+            "checkout_completed_events": tail.checkout_completed,
+            "number_of_sessions": len(tail.sessions),
+            "total_revenue": tail.total_revenue,
+            "total_scroll_sum": tail.total_scroll_sum,
+            "total_scroll_events": tail.total_scroll_events,
+        }
+
+    def merge(self, counters: dict[str, Any], page_url: str, start_date: date, end_date: date) -> dict | None:
+        """
+        Warehouse `counters` (see bigquery.get_bigquery_counters) plus the page's counters after
+        their watermark, as keyword arguments of build_metrics_response; None if neither has any.
+        """
+        tail = self.tail(page_url, start_date, end_date, counters['watermark'])
+        merged = {name: value for name, value in counters.items() if name not in ('watermark', 'aggregate_rows')}
+        if tail is None:
+            return merged if counters['aggregate_rows'] else None
+        return {name: (merged.get(name) or 0) + value for name, value in tail.items()}
+
+    def stats(self) -> dict:
+        return {
+            "events": self.events,
+            "buckets": len(self._buckets),
+            "retained_events": self._retained,
+            "watermark": self.watermark.isoformat() if self.watermark else None,
+            "behind_watermark": self.behind_watermark,
+            "evicted_buckets": self.evicted_buckets,
+            "dropped_buckets": self.dropped_buckets,
+            "dropped_events": self.dropped_events,
+            "stale_merges": self.stale_merges,
+        }
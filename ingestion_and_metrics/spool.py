@@ -0,0 +1,318 @@
+import asyncio
+import json
+import logging
+import mmap
+import os
+import threading
+import time
+from contextlib import suppress
+from typing import Callable
+from common.instrumentation import registry
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SHIP_SECONDS = registry.histogram("spool_ship_seconds", "Time to ship a spooled batch, retries included")
+
+SEGMENT_PREFIX = "segment-"
+SEGMENT_SUFFIX = ".ndjson"
+CHECKPOINT_FILE = "checkpoint.json"
+REJECTED_FILE = "rejected.ndjson"
+
+# insert_rows_json error reasons that are worth retrying; anything else (e.g. "invalid") never succeeds
+RETRYABLE_REASONS = {"stopped", "timeout", "backendError", "internalError", "rateLimitExceeded"}
+
+
+class Spool:
+    """
+    Append-only write-ahead log of accepted rows on local disk.
+
+    Rows are appended as NDJSON to numbered segment files, with one fsync per appended batch.
+    A new segment is started once the current one reaches `segment_bytes`. Readers memory-map
+    segments and resume from the position stored in the checkpoint file; segments that have been
+    fully read are deleted when a position past them is committed.
+    """
+
+    def __init__(self, directory: str, segment_bytes: int = 64 * 1024 * 1024):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        self.rows_appended = 0
+        self.bytes_appended = 0
+        self.fsyncs = 0
+
+        self.checkpoint = self._load_checkpoint()
+        segments = self.segments()
+        self._active_seq = segments[-1] if segments else self.checkpoint[0]
+        self._active = self._open_segment(self._active_seq)
+
+    def _segment_path(self, seq: int) -> str:
+        return os.path.join(self.directory, f"{SEGMENT_PREFIX}{seq:012d}{SEGMENT_SUFFIX}")
+
+    def segments(self) -> list[int]:
+        return sorted(
+            int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+            for name in os.listdir(self.directory)
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)
+        )
+
+    def _open_segment(self, seq: int):
+        path = self._segment_path(seq)
+        f = open(path, 'ab')
+        # Drop a partially written trailing line left behind by a crash so new rows start on a fresh line
+        size = f.tell()
+        if size:
+            with open(path, 'rb') as reader, mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                last_newline = m.rfind(b'\n')
+            if last_newline != size - 1:
+                logger.warning(f"Truncating partial row at the end of {path}")
+                f.truncate(last_newline + 1)
+                f.seek(0, os.SEEK_END)
+        return f
+
+    def _load_checkpoint(self) -> tuple[int, int]:
+        path = os.path.join(self.directory, CHECKPOINT_FILE)
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                checkpoint = json.load(f)
+            return checkpoint['segment'], checkpoint['offset']
+        segments = self.segments()
+        return (segments[0] if segments else 0), 0
+
+    def append(self, rows: list[dict]) -> list[dict]:
+        """
+        Durably append rows; returns an empty error list so it can be used as a writer sink.
+        """
+        data = b''.join(json.dumps(row, separators=(',', ':')).encode() + b'\n' for row in rows)
+        with self._lock:
+            self._active.write(data)
+            self._active.flush()
+            os.fsync(self._active.fileno())
+            self.fsyncs += 1
+            self.rows_appended += len(rows)
+            self.bytes_appended += len(data)
+
+            if self._active.tell() >= self.segment_bytes:
+                self._active.close()
+                self._active_seq += 1
+                self._active = self._open_segment(self._active_seq)
+        return []
+
+    def read_batch(self, max_rows: int, position: tuple[int, int] | None = None) -> tuple[list[dict], tuple[int, int]]:
+        """
+        Read up to `max_rows` complete rows starting at `position` (the checkpoint by default).
+        Returns the rows and the position just after the last row read.
+        """
+        seq, offset = position or self.checkpoint
+        rows: list[dict] = []
+
+        while len(rows) < max_rows:
+            with self._lock:
+                active_seq = self._active_seq
+            path = self._segment_path(seq)
+            if not os.path.exists(path):
+                if seq >= active_seq:
+                    break
+                seq, offset = seq + 1, 0
+                continue
+
+            offset = self._read_segment(path, offset, max_rows - len(rows), rows)
+            if len(rows) >= max_rows or seq >= active_seq:
+                break
+            # A sealed segment that has been read to the end: continue with the next one
+            if offset >= os.path.getsize(path):
+                seq, offset = seq + 1, 0
+            else:
+                break
+
+        return rows, (seq, offset)
+
+    @staticmethod
+    def _read_segment(path: str, offset: int, max_rows: int, rows: list[dict]) -> int:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size <= offset:
+                return offset
+            with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as m:
+                end = m.rfind(b'\n', offset, size)
+                read = 0
+                while read < max_rows and offset <= end:
+                    newline = m.find(b'\n', offset, end + 1)
+                    line = m[offset:newline]
+                    offset = newline + 1
+                    if not line.strip():
+                        continue
+                    try:
+                        rows.append(json.loads(line))
+                        read += 1
+                    except json.JSONDecodeError as e:
+                        logger.error(f"Skipping corrupt row in {path}: {e}")
+        return offset
+
+    def commit(self, position: tuple[int, int]) -> None:
+        """
+        Persist the read position and delete the segments that lie entirely before it.
+        """
+        path = os.path.join(self.directory, CHECKPOINT_FILE)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({"segment": position[0], "offset": position[1]}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        self.checkpoint = position
+
+        for seq in self.segments():
+            if seq >= position[0]:
+                break
+            with suppress(FileNotFoundError):
+                os.remove(self._segment_path(seq))
+
+    def reject(self, rows: list[dict]) -> None:
+        """
+        Keep rows that can never be inserted out of the way of the shipper for manual inspection.
+        """
+        with open(os.path.join(self.directory, REJECTED_FILE), 'ab') as f:
+            f.write(b''.join(json.dumps(row).encode() + b'\n' for row in rows))
+
+    def depth_bytes(self) -> int:
+        seq, offset = self.checkpoint
+        depth = 0
+        for segment in self.segments():
+            if segment < seq:
+                continue
+            with suppress(FileNotFoundError):
+                depth += os.path.getsize(self._segment_path(segment)) - (offset if segment == seq else 0)
+        return max(depth, 0)
+
+    def close(self) -> None:
+        with self._lock:
+            self._active.close()
+
+    def stats(self) -> dict:
+        return {
+            "depth_bytes": self.depth_bytes(),
+            "segments": len(self.segments()),
+            "checkpoint": {"segment": self.checkpoint[0], "offset": self.checkpoint[1]},
+            "rows_appended": self.rows_appended,
+            "bytes_appended": self.bytes_appended,
+            "fsyncs": self.fsyncs,
+        }
+
+
+class LocalSink:
+    """
+    Stand-in for BigQuery that appends shipped rows to a local NDJSON file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def __call__(self, rows: list[dict]) -> list[dict]:
+        with open(self.path, 'ab') as f:
+            f.write(b''.join(json.dumps(row).encode() + b'\n' for row in rows))
+        return []
+
+
+class SpoolShipper:
+    """
+    Drains the spool into a sink in large batches, retrying failed inserts with exponential backoff
+    and only advancing the checkpoint once a batch has been written. On restart it resumes from
+    the last checkpoint, so rows may be delivered more than once but are never dropped.
+    """
+
+    def __init__(self, spool: Spool, sink: Callable[[list[dict]], list[dict]], batch_size: int = 5000,
+                 poll_interval: float = 1.0, max_backoff: float = 60.0):
+        self.spool = spool
+        self.sink = sink
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_backoff = max_backoff
+        self._task: asyncio.Task | None = None
+
+        self.rows_shipped = 0
+        self.rows_rejected = 0
+        self.batches_shipped = 0
+        self.retries = 0
+        self.last_batch_latency = 0.0
+        self.drain_rate = 0.0
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            shipped = await self.ship_once()
+            if shipped < self.batch_size:
+                await asyncio.sleep(self.poll_interval)
+
+    async def ship_once(self) -> int:
+        """
+        Ship a single batch from the checkpoint; returns the number of rows read.
+        """
+        rows, position = await asyncio.to_thread(self.spool.read_batch, self.batch_size)
+        if not rows:
+            if position != self.spool.checkpoint:
+                await asyncio.to_thread(self.spool.commit, position)
+            return 0
+
+        started = time.perf_counter()
+        pending = rows
+        rejected_rows = 0
+        backoff = 1.0
+        while pending:
+            try:
+                errors = await asyncio.to_thread(self.sink, pending)
+            except Exception as e:
+                logger.error(f"Failed to ship {len(pending)} spooled rows, retrying in {backoff:.0f}s: {e}")
+                self.retries += 1
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+
+            retry, rejected = [], []
+            for error in errors or []:
+                row = pending[error['index']]
+                reasons = {e.get('reason') for e in error.get('errors', [])}
+                (retry if reasons <= RETRYABLE_REASONS else rejected).append(row)
+            if rejected:
+                logger.error(f"Rejected {len(rejected)} spooled rows: {errors}")
+                rejected_rows += len(rejected)
+                await asyncio.to_thread(self.spool.reject, rejected)
+            if retry:
+                self.retries += 1
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+            pending = retry
+
+        await asyncio.to_thread(self.spool.commit, position)
+        elapsed = time.perf_counter() - started
+        self.rows_shipped += len(rows) - rejected_rows
+        self.rows_rejected += rejected_rows
+        self.batches_shipped += 1
+        self.last_batch_latency = elapsed
+        SHIP_SECONDS.observe(elapsed)
+        self.drain_rate = len(rows) / elapsed if elapsed else 0.0
+        logger.info(f"Shipped {len(rows)} spooled rows in {elapsed * 1000:.1f} ms")
+        return len(rows)
+
+    def stats(self) -> dict:
+        return {
+            "rows_shipped": self.rows_shipped,
+            "rows_rejected": self.rows_rejected,
+            "batches_shipped": self.batches_shipped,
+            "retries": self.retries,
+            "last_batch_latency_ms": self.last_batch_latency * 1000,
+            "drain_rate_rows_per_s": self.drain_rate,
+        }
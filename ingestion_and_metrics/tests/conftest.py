@@ -0,0 +1,46 @@
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import pytest
+
+# The service's modules import each other flat and config.py reads config.json from the working
+# directory, so the tests run from a scratch directory holding the service's config on the local
+# backend (like benchmarks/end_to_end.py), with the service directory on the import path. The
+# repository root is appended like config.py does, for modules that import common/ on their own.
+SERVICE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+WORKDIR = tempfile.mkdtemp(prefix="ingestion-tests-")
+
+with open(os.path.join(SERVICE_DIR, 'config.json'), 'r') as f:
+    config = json.load(f)
+config['backend'] = {"type": "local", "database": os.path.join(WORKDIR, 'analytics.db')}
+with open(os.path.join(WORKDIR, 'config.json'), 'w') as f:
+    json.dump(config, f)
+
+os.chdir(WORKDIR)
+sys.path.insert(0, SERVICE_DIR)
+sys.path.append(os.path.dirname(SERVICE_DIR))
+
+
+@pytest.fixture
+def with_engine():
+    """
+    Run `fetch(engine)` with a started QueryEngine over `engine_client`, the local backend's client
+    by default.
+    """
+    from bigquery import client
+    from engine import QueryEngine
+
+    def run(fetch, engine_client=None, **kwargs):
+        async def run_fetch():
+            engine = QueryEngine(engine_client or client, **kwargs)
+            await engine.start()
+            try:
+                return await fetch(engine)
+            finally:
+                await engine.stop()
+
+        return asyncio.run(run_fetch())
+
+    return run
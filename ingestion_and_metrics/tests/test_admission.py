@@ -0,0 +1,52 @@
+import pytest
+from fastapi import HTTPException
+from admission import AdmissionController
+
+
+def test_events_are_shed_by_priority():
+    depth = 0
+    admission = AdmissionController(lambda: depth, max_pending=100,
+                                    priorities={"page_scroll": 0.5, "checkout_completed": 1.0})
+    depth = 50
+    assert not admission.admit("page_scroll")
+    assert admission.admit("checkout_completed")
+    # Unknown event types get the default share
+    assert admission.admit("page_viewed")
+    depth = 99
+    assert admission.admit("checkout_completed")
+    depth = 100
+    assert not admission.admit("checkout_completed")
+    assert admission.stats()["shed"] == {"page_scroll": 1, "checkout_completed": 1}
+
+
+def test_batch_events_count_against_the_budget():
+    admission = AdmissionController(lambda: 0, max_pending=10, priorities={"page_viewed": 1.0})
+    admitted = [event for event in range(15) if admission.admit("page_viewed", pending=event)]
+    assert len(admitted) == 10
+    assert admission.accepted == 10
+    assert admission.shed["page_viewed"] == 5
+
+
+def test_requests_over_capacity_are_rejected_with_retry_after():
+    depth = 0
+    admission = AdmissionController(lambda: depth, max_pending=10, max_in_flight=1, retry_after=7)
+    with admission.request():
+        with pytest.raises(HTTPException) as e:
+            with admission.request():
+                pass
+        assert e.value.status_code == 503
+        assert e.value.headers == {"Retry-After": "7"}
+
+    depth = 10
+    with pytest.raises(HTTPException):
+        with admission.request():
+            pass
+    assert admission.rejected_over_capacity == 2
+    assert admission.in_flight == 0
+
+
+def test_admit_or_raise_sheds_with_429():
+    admission = AdmissionController(lambda: 10, max_pending=10, priorities={"page_scroll": 0.5})
+    with pytest.raises(HTTPException) as e:
+        admission.admit_or_raise("page_scroll")
+    assert e.value.status_code == 429
@@ -0,0 +1,136 @@
+import asyncio
+import pytest
+from cache import MetricsCache
+
+
+def test_concurrent_misses_share_one_load():
+    async def run():
+        cache = MetricsCache(lambda: 1)
+        await cache.refresh_version()
+        release = asyncio.Event()
+        loads = 0
+
+        async def loader():
+            nonlocal loads
+            loads += 1
+            await release.wait()
+            return {"total_sessions": 3}
+
+        waiters = [asyncio.create_task(cache.get("key", loader)) for _ in range(10)]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*waiters)
+
+        assert loads == 1
+        assert results == [{"total_sessions": 3}] * 10
+        assert cache.misses == 1 and cache.coalesced == 9
+        assert await cache.get("key", loader) == {"total_sessions": 3}
+        assert cache.hits == 1 and loads == 1
+
+    asyncio.run(run())
+
+
+def test_a_cancelled_waiter_does_not_cancel_the_shared_load():
+    async def run():
+        cache = MetricsCache(lambda: 1)
+        release = asyncio.Event()
+
+        async def loader():
+            await release.wait()
+            return 42
+
+        first = asyncio.create_task(cache.get("key", loader))
+        second = asyncio.create_task(cache.get("key", loader))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        assert await second == 42
+        with pytest.raises(asyncio.CancelledError):
+            await first
+
+    asyncio.run(run())
+
+
+def test_failed_loads_are_not_cached():
+    async def run():
+        cache = MetricsCache(lambda: 1)
+        calls = 0
+
+        async def loader():
+            nonlocal calls
+            calls += 1
+            if calls == 1:
+                raise RuntimeError("query failed")
+            return 1
+
+        with pytest.raises(RuntimeError):
+            await cache.get("key", loader)
+        assert await cache.get("key", loader) == 1
+        assert cache.load_errors == 1
+
+    asyncio.run(run())
+
+
+def test_a_new_version_invalidates_entries():
+    async def run():
+        version = 1
+        cache = MetricsCache(lambda: version)
+        await cache.refresh_version()
+        loads = 0
+
+        async def loader():
+            nonlocal loads
+            loads += 1
+            return loads
+
+        assert await cache.get("key", loader) == 1
+        assert await cache.get("key", loader) == 1
+        version = 2
+        await cache.refresh_version()
+        assert await cache.get("key", loader) == 2
+        assert cache.invalidations == 1
+
+    asyncio.run(run())
+
+
+def test_stale_entries_are_served_while_they_refresh():
+    async def run():
+        version = 1
+        cache = MetricsCache(lambda: version, stale_while_revalidate=True)
+        await cache.refresh_version()
+        loads = 0
+
+        async def loader():
+            nonlocal loads
+            loads += 1
+            return loads
+
+        assert await cache.get("key", loader) == 1
+        version = 2
+        await cache.refresh_version()
+        assert await cache.get("key", loader) == 1
+        await asyncio.sleep(0)
+        assert await cache.get("key", loader) == 2
+        assert cache.stale_served == 1
+
+    asyncio.run(run())
+
+
+def test_least_recently_used_entries_are_evicted():
+    async def run():
+        cache = MetricsCache(lambda: 1, max_entries=2)
+
+        async def loader():
+            return "value"
+
+        for key in ("a", "b", "a", "c"):
+            await cache.get(key, loader)
+        assert cache.stats()["entries"] == 2
+        misses = cache.misses
+        await cache.get("a", loader)
+        assert cache.misses == misses
+        await cache.get("b", loader)
+        assert cache.misses == misses + 1
+
+    asyncio.run(run())
@@ -0,0 +1,89 @@
+import pytest
+import dedup
+from dedup import BloomFilter, DedupIndex
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> FakeClock:
+    clock = FakeClock()
+    monkeypatch.setattr(dedup.time, 'monotonic', clock)
+    return clock
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(capacity=10_000, error_rate=0.01)
+    keys = [f"evt-{i}" for i in range(10_000)]
+    for key in keys:
+        bloom.add(key)
+    assert all(key in bloom for key in keys)
+
+
+def test_bloom_filter_false_positive_rate():
+    bloom = BloomFilter(capacity=10_000, error_rate=0.01)
+    for i in range(10_000):
+        bloom.add(f"evt-{i}")
+    false_positives = sum(f"other-{i}" in bloom for i in range(10_000))
+    assert false_positives < 10_000 * 0.02
+
+
+def test_repeats_within_the_lru_are_duplicates(clock):
+    index = DedupIndex(window_seconds=600, bloom_capacity=1000, lru_size=100)
+    assert not index.is_duplicate("evt-0")
+    clock.now += 599
+    assert index.is_duplicate("evt-0")
+    assert index.hits == 1 and index.misses == 1
+
+
+def test_missing_event_ids_are_never_duplicates(clock):
+    index = DedupIndex()
+    assert not index.is_duplicate(None)
+    assert not index.is_duplicate("")
+    assert index.stats()["misses"] == 0
+
+
+def test_no_false_negatives_past_the_lru(clock):
+    # Ids evicted from the LRU are still caught by the Bloom filters for the rest of the window
+    index = DedupIndex(window_seconds=600, bloom_capacity=10_000, lru_size=10, drop_probable=True)
+    ids = [f"evt-{i}" for i in range(1000)]
+    for event_id in ids:
+        assert not index.is_duplicate(event_id)
+        clock.now += 0.1
+    assert all(index.is_duplicate(event_id) for event_id in ids)
+
+
+def test_no_false_negatives_across_a_rotation(clock):
+    index = DedupIndex(window_seconds=600, bloom_capacity=10_000, lru_size=10, drop_probable=True)
+    ids = [f"evt-{i}" for i in range(100)]
+    for event_id in ids:
+        index.is_duplicate(event_id)
+    clock.now += 300
+    index.is_duplicate("evt-new")
+    assert index.rotations == 1
+    assert all(index.is_duplicate(event_id) for event_id in ids)
+
+
+def test_probable_duplicates_are_kept_unless_configured(clock):
+    index = DedupIndex(window_seconds=600, bloom_capacity=1000, lru_size=1)
+    index.is_duplicate("evt-0")
+    index.is_duplicate("evt-1")
+    assert not index.is_duplicate("evt-0")
+    assert index.probable_hits == 1
+
+
+def test_ids_are_forgotten_after_the_window(clock):
+    index = DedupIndex(window_seconds=600, bloom_capacity=1000, lru_size=100, drop_probable=True)
+    index.is_duplicate("evt-0")
+    clock.now += 300
+    index.is_duplicate("evt-1")
+    clock.now += 300
+    index.is_duplicate("evt-2")
+    clock.now += 1
+    assert not index.is_duplicate("evt-0")
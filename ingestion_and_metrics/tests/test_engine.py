@@ -0,0 +1,222 @@
+import asyncio
+import threading
+import pytest
+from fastapi import HTTPException
+from engine import QueryEngine, cancel_on_disconnect
+
+
+class FakeRows:
+    def __init__(self, pages: list[list]):
+        self.pages = pages
+
+
+class FakeJob:
+    def __init__(self, client: "FakeClient", query: str):
+        self.client = client
+        self.query = query
+        self.job_id = f"job-{len(client.jobs)}"
+        self.project = "project"
+        self.location = "US"
+        self.total_bytes_processed = 100
+        self.total_bytes_billed = 100
+        self.slot_millis = 5
+
+    def result(self, timeout: float | None = None, page_size: int | None = None) -> FakeRows:
+        # A query named "slow" runs until the test releases it
+        if self.query == "slow":
+            self.client.started.set()
+            self.client.release.wait(5)
+        return FakeRows(self.client.pages.get(self.query, [[{"query": self.query}]]))
+
+
+class FakeClient:
+    """
+    The parts of google.cloud.bigquery.Client the engine uses; jobs finish at once unless named "slow".
+    """
+
+    def __init__(self, pages: dict[str, list[list]] | None = None):
+        self.pages = pages or {}
+        self.jobs: list[FakeJob] = []
+        self.cancelled: list[str] = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def query(self, query: str, job_config=None) -> FakeJob:
+        job = FakeJob(self, query)
+        self.jobs.append(job)
+        return job
+
+    def cancel_job(self, job_id: str, **kwargs) -> None:
+        self.cancelled.append(job_id)
+
+
+def run_with_engine(client: FakeClient, test, **kwargs):
+    async def run():
+        engine = QueryEngine(client, **kwargs)
+        await engine.start()
+        try:
+            return await test(engine)
+        finally:
+            client.release.set()
+            await engine.stop()
+
+    return asyncio.run(run())
+
+
+async def wait_for_job(client: FakeClient) -> None:
+    await asyncio.to_thread(client.started.wait, 5)
+
+
+def test_engine_must_be_started():
+    engine = QueryEngine(FakeClient())
+    with pytest.raises(RuntimeError, match="has not been started"):
+        asyncio.run(engine.run("SELECT 1"))
+
+
+def test_run_returns_every_page():
+    client = FakeClient({"pages": [[1, 2], [3], [4, 5]]})
+
+    async def test(engine):
+        assert await engine.run("pages", name="pages") == [1, 2, 3, 4, 5]
+        stats = engine.stats()
+        assert stats["queries"]["pages"]["count"] == 1
+        assert stats["queries"]["pages"]["processed_bytes"] == 100
+        assert (stats["running"], stats["queued"]) == (0, 0)
+
+    run_with_engine(client, test)
+
+
+def test_queries_wait_for_a_slot():
+    client = FakeClient()
+
+    async def test(engine):
+        slow = asyncio.create_task(engine.run("slow"))
+        await wait_for_job(client)
+        fast = asyncio.create_task(engine.run("fast"))
+        await asyncio.sleep(0.05)
+        assert (engine.running, engine.queued) == (1, 1)
+        assert not fast.done()
+
+        client.release.set()
+        assert await fast == [{"query": "fast"}]
+        assert await slow == [{"query": "slow"}]
+        assert (engine.running, engine.queued) == (0, 0)
+
+    run_with_engine(client, test, max_concurrency=1)
+
+
+def test_an_unread_stream_does_not_hold_a_slot():
+    client = FakeClient({"stream": [[1], [2], [3]]})
+
+    async def test(engine):
+        # The client of a streamed response has read one row and stalled
+        stream = engine.iterate("stream", name="stream")
+        assert await anext(stream) == 1
+        assert engine.running == 0
+        assert await asyncio.wait_for(engine.run("other"), 1) == [{"query": "other"}]
+
+        assert [row async for row in stream] == [2, 3]
+        assert engine.stats()["queries"]["stream"]["count"] == 1
+        assert client.cancelled == []
+
+    run_with_engine(client, test, max_concurrency=1)
+
+
+def test_an_abandoned_stream_cancels_its_job():
+    client = FakeClient({"stream": [[1], [2]]})
+
+    async def test(engine):
+        stream = engine.iterate("stream")
+        await anext(stream)
+        await stream.aclose()
+        await asyncio.sleep(0.05)
+        assert engine.cancelled == 1
+        assert client.cancelled == [client.jobs[0].job_id]
+        assert engine.running == 0
+
+    run_with_engine(client, test)
+
+
+def test_timed_out_queries_fail_with_504_and_are_cancelled():
+    client = FakeClient()
+
+    async def test(engine):
+        with pytest.raises(HTTPException) as e:
+            await engine.run("slow", name="slow")
+        assert e.value.status_code == 504
+        await asyncio.sleep(0.05)
+        assert engine.timeouts == 1
+        assert client.cancelled == [client.jobs[0].job_id]
+        assert engine.running == 0
+        # The slot is free again
+        assert await engine.run("fast") == [{"query": "fast"}]
+
+    run_with_engine(client, test, timeout=0.1, max_concurrency=1)
+
+
+def test_cancelled_queries_cancel_their_job():
+    client = FakeClient()
+
+    async def test(engine):
+        task = asyncio.create_task(engine.run("slow"))
+        await wait_for_job(client)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await asyncio.sleep(0.05)
+        assert engine.cancelled == 1
+        assert client.cancelled == [client.jobs[0].job_id]
+
+    run_with_engine(client, test)
+
+
+def test_failed_queries_are_counted():
+    class FailingClient(FakeClient):
+        def query(self, query: str, job_config=None):
+            raise ValueError("Syntax error")
+
+    async def test(engine):
+        with pytest.raises(ValueError):
+            await engine.run("SELECT")
+        assert engine.failures == 1
+        assert engine.running == 0
+
+    run_with_engine(FailingClient(), test)
+
+
+class FakeRequest:
+    def __init__(self, disconnect_after: int | None):
+        self.disconnect_after = disconnect_after
+        self.polls = 0
+        self.url = type("URL", (), {"path": "/get_metrics"})()
+
+    async def is_disconnected(self) -> bool:
+        self.polls += 1
+        return self.disconnect_after is not None and self.polls > self.disconnect_after
+
+
+def test_cancel_on_disconnect_returns_the_result():
+    async def run():
+        request = FakeRequest(disconnect_after=None)
+        assert await cancel_on_disconnect(request, asyncio.sleep(0.02, result=42), poll_interval=0.005) == 42
+        assert request.polls >= 1
+
+    asyncio.run(run())
+
+
+def test_cancel_on_disconnect_cancels_when_the_client_goes_away():
+    async def run():
+        cancelled = asyncio.Event()
+
+        async def query():
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        with pytest.raises(asyncio.CancelledError):
+            await cancel_on_disconnect(FakeRequest(disconnect_after=2), query(), poll_interval=0.005)
+        assert cancelled.is_set()
+
+    asyncio.run(run())
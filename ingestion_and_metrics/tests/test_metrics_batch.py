@@ -0,0 +1,92 @@
+import pytest
+from fastapi import HTTPException
+from common import hll
+from common.local_backend import connect
+from bigquery import get_bigquery_metrics, get_bigquery_metrics_parallel, iter_bigquery_metrics_batch, metrics_ratios, parse_date_range
+from classes import MetricsBatchRequest, MetricsRequest
+from config import local_database, page_daily_metrics_table_id
+
+# page_url, event_date, sessions, add_to_cart_events, checkout_completed, total_revenue, total_scroll_sum, total_scroll_events
+DAILY_ROWS = [
+    ("https://shop.example.com/a", "2024-03-05", ["s1", "s2"], 1, 1, 20.0, 150.0, 2),
+    ("https://shop.example.com/a", "2024-03-06", ["s2", "s3"], 2, 0, 0.0, 50.0, 1),
+    ("https://shop.example.com/b", "2024-03-06", ["s4"], 0, 1, 10.0, 0.0, 0),
+    ("https://other.example.com/c", "2024-03-07", ["s5"], 1, 0, 0.0, 0.0, 0),
+    # Outside the requested range
+    ("https://shop.example.com/a", "2024-03-09", ["s6"], 5, 5, 500.0, 0.0, 0),
+]
+DAILY_TABLE = page_daily_metrics_table_id.split('.')[-1]
+
+
+@pytest.fixture(scope="module", autouse=True)
+def daily_metrics():
+    connection = connect(local_database)
+    with connection:
+        connection.execute(f'DELETE FROM "{DAILY_TABLE}"')
+        connection.executemany(
+            f'INSERT INTO "{DAILY_TABLE}" VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [(page_url, event_date, len(sessions), add_to_cart, checkouts, revenue, scroll_sum, scroll_events, hll.init(sessions))
+             for page_url, event_date, sessions, add_to_cart, checkouts, revenue, scroll_sum, scroll_events in DAILY_ROWS])
+    connection.close()
+
+
+@pytest.fixture
+def fetch(with_engine):
+    def fetch_batch(**request) -> dict:
+        async def fetch(engine):
+            # No whole week in the range, so only daily rows are read
+            batch = MetricsBatchRequest(start_date="2024-03-05", end_date="2024-03-08", **request)
+            return {metrics.page_url: metrics async for metrics in iter_bigquery_metrics_batch(batch, engine)}
+
+        return with_engine(fetch)
+
+    return fetch_batch
+
+
+def test_batch_by_page_urls_groups_pages_and_merges_sessions(fetch):
+    results = fetch(page_urls=["https://shop.example.com/a", "https://shop.example.com/b", "https://missing.example.com/"])
+    assert list(results) == ["https://shop.example.com/a", "https://shop.example.com/b"]
+
+    page = results["https://shop.example.com/a"]
+    # s2 is active on both days and counted once
+    assert page.total_sessions == 3
+    assert page.cart_percentage == pytest.approx(100.0)
+    assert page.average_order_value == pytest.approx(20.0)
+    assert page.average_scroll_percentage == pytest.approx(200.0 / 3)
+
+
+def test_batch_by_prefix_and_all_pages(fetch):
+    assert list(fetch(page_url_prefix="https://shop.example.com/")) == ["https://shop.example.com/a", "https://shop.example.com/b"]
+    assert len(fetch(all_pages=True)) == 3
+
+
+def test_batch_with_no_matching_pages(fetch):
+    assert fetch(page_urls=[]) == {}
+
+
+def test_metrics_ratios_treat_missing_counters_as_zero():
+    assert metrics_ratios(None, None, None, None, None, None) == {
+        "cart_percentage": 0, "conversion_rate": 0, "average_order_value": 0,
+        "revenue_per_session": 0, "total_sessions": 0, "average_scroll_percentage": 0,
+    }
+
+
+def test_parse_date_range_rejects_invalid_dates():
+    assert parse_date_range("2024-03-05", "2024-03-08") == ("2024-03-05", "2024-03-08")
+    with pytest.raises(HTTPException) as e:
+        parse_date_range("2024-03-05", "tomorrow")
+    assert e.value.status_code == 400
+
+
+def test_single_page_endpoints_match_the_batch(fetch, with_engine):
+    request = MetricsRequest(page_url="https://shop.example.com/a", start_date="2024-03-05", end_date="2024-03-08")
+    batch = fetch(page_urls=[request.page_url])[request.page_url]
+    assert with_engine(lambda engine: get_bigquery_metrics(request, engine)) == batch
+    assert with_engine(lambda engine: get_bigquery_metrics_parallel(request, engine)) == batch
+
+
+def test_parallel_metrics_reject_invalid_dates(with_engine):
+    request = MetricsRequest(page_url="https://shop.example.com/a", start_date="2024-03-05", end_date="08/03/2024")
+    with pytest.raises(HTTPException) as e:
+        with_engine(lambda engine: get_bigquery_metrics_parallel(request, engine))
+    assert e.value.status_code == 400
@@ -0,0 +1,81 @@
+import pytest
+from fastapi import HTTPException
+from common import hll
+from common.local_backend import connect
+from bigquery import breakdown_grouping_set, get_bigquery_breakdown
+from classes import MetricsBreakdownRequest
+from config import dimension_metrics_table_id, local_database
+
+PAGE = "https://shop.example.com/a"
+# page_url, event_date, grouping_set, platform, device, sessions, add_to_cart_events, checkout_completed, total_revenue
+CUBE_ROWS = [
+    (PAGE, "2024-03-05", "platform", "web", None, ["s1", "s2"], 1, 1, 20.0),
+    (PAGE, "2024-03-06", "platform", "web", None, ["s2", "s3"], 1, 0, 0.0),
+    (PAGE, "2024-03-06", "platform", "ios", None, ["s4"], 0, 1, 10.0),
+    (PAGE, "2024-03-05", "platform,device", "web", "desktop", ["s1"], 1, 1, 20.0),
+    (PAGE, "2024-03-05", "platform,device", "web", "mobile", ["s2"], 0, 0, 0.0),
+    ("https://shop.example.com/b", "2024-03-05", "platform", "android", None, ["s5"], 0, 0, 0.0),
+    # Outside the requested range
+    (PAGE, "2024-03-09", "platform", "ios", None, ["s6", "s7"], 2, 2, 50.0),
+]
+
+
+@pytest.fixture(scope="module", autouse=True)
+def cube():
+    table = dimension_metrics_table_id.split('.')[-1]
+    connection = connect(local_database)
+    with connection:
+        connection.execute(f'DELETE FROM "{table}"')
+        connection.executemany(
+            f'INSERT INTO "{table}" VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [(page_url, event_date, grouping_set, platform, device, len(sessions), add_to_cart, checkouts, revenue,
+              0.0, 0, hll.init(sessions))
+             for page_url, event_date, grouping_set, platform, device, sessions, add_to_cart, checkouts, revenue in CUBE_ROWS])
+    connection.close()
+
+
+def fetch(with_engine, **request):
+    async def fetch_breakdown(engine):
+        return await get_bigquery_breakdown(
+            MetricsBreakdownRequest(start_date="2024-03-05", end_date="2024-03-08", **request), engine)
+
+    return with_engine(fetch_breakdown)
+
+
+def test_grouping_sets_follow_the_configured_dimension_order():
+    assert breakdown_grouping_set(["platform"]) == "platform"
+    assert breakdown_grouping_set(["device", "platform"]) == "platform,device"
+
+
+@pytest.mark.parametrize("dimensions", [[], ["country"], ["platform", "country"], ["platform", "platform"]])
+def test_dimensions_outside_the_cube_are_rejected(dimensions, with_engine):
+    with pytest.raises(HTTPException) as e:
+        breakdown_grouping_set(dimensions)
+    assert e.value.status_code == 400
+
+    with pytest.raises(HTTPException) as e:
+        fetch(with_engine, page_url=PAGE, dimensions=dimensions)
+    assert e.value.status_code == 400
+
+
+def test_breakdown_of_a_page_by_platform(with_engine):
+    breakdown = fetch(with_engine, page_url=PAGE, dimensions=["platform"])
+    assert breakdown.dimensions == ["platform"]
+    # Most sessions first; sessions merge across days
+    assert [(row.dimensions, row.total_sessions) for row in breakdown.rows] == [({"platform": "web"}, 3),
+                                                                              ({"platform": "ios"}, 1)]
+    web = breakdown.rows[0]
+    assert web.cart_percentage == pytest.approx(200 / 3)
+    assert web.average_order_value == 20.0
+
+
+def test_breakdown_by_several_dimensions_reads_their_grouping_set(with_engine):
+    breakdown = fetch(with_engine, page_url=PAGE, dimensions=["device", "platform"])
+    assert breakdown.dimensions == ["platform", "device"]
+    assert sorted(row.dimensions["device"] for row in breakdown.rows) == ["desktop", "mobile"]
+
+
+def test_breakdown_of_every_page(with_engine):
+    breakdown = fetch(with_engine, dimensions=["platform"])
+    assert breakdown.page_url is None
+    assert {row.dimensions["platform"]: row.total_sessions for row in breakdown.rows} == {"web": 3, "ios": 1, "android": 1}
@@ -0,0 +1,138 @@
+import pytest
+from google.api_core.exceptions import BadRequest
+import bigquery
+from common import hll
+from common.local_backend import connect
+from bigquery import client, get_bigquery_counters
+from classes import MetricsRequest
+from config import local_database, page_daily_metrics_table_id, page_monthly_metrics_table_id
+from engine import QueryBudgetExceeded
+
+PAGE = "https://shop.example.com/budget"
+# A whole calendar month, which the monthly rollup covers in one row
+REQUEST = MetricsRequest(page_url=PAGE, start_date="2024-02-01", end_date="2024-02-29")
+BUDGET = 10_000_000
+# Bytes processed by a query reading the daily table, and by one only reading the rollups
+DAILY_BYTES, ROLLUP_BYTES = 100_000_000, 1_000_000
+
+
+class BudgetClient:
+    """
+    The local backend's client, billing queries like BigQuery: reading the daily table goes over
+    BUDGET, reading only the rollups does not. A job over its `maximum_bytes_billed` fails like in
+    BigQuery, and dry runs report the bytes the job would process.
+    """
+
+    def __init__(self):
+        self.project = client.project
+        self.jobs: list[tuple[str, bool]] = []
+
+    def query(self, query: str, job_config=None, **kwargs):
+        processed = DAILY_BYTES if f"`{page_daily_metrics_table_id}`" in query else ROLLUP_BYTES
+        dry_run = bool(getattr(job_config, 'dry_run', False))
+        self.jobs.append(("day" if processed == DAILY_BYTES else "rollups", dry_run))
+        job = client.query(query, job_config=job_config, **kwargs)
+        job.total_bytes_processed = job.total_bytes_billed = processed
+        limit = getattr(job_config, 'maximum_bytes_billed', None)
+        if not dry_run and limit and processed > limit:
+            job.result = self.over_limit
+        return job
+
+    @staticmethod
+    def over_limit(**kwargs):
+        raise BadRequest("Query exceeded limit for bytes billed", errors=[{'reason': 'bytesBilledLimitExceeded'}])
+
+    def cancel_job(self, job_id: str, **kwargs) -> None:
+        pass
+
+
+@pytest.fixture(scope="module", autouse=True)
+def page_metrics():
+    daily_table = page_daily_metrics_table_id.split('.')[-1]
+    monthly_table = page_monthly_metrics_table_id.split('.')[-1]
+    days = [(f"2024-02-{day:02d}", f"s{day}") for day in range(1, 30)]
+    connection = connect(local_database)
+    with connection:
+        for table in (daily_table, monthly_table):
+            connection.execute(f'DELETE FROM "{table}" WHERE page_url = ?', (PAGE,))
+        connection.executemany(f'INSERT INTO "{daily_table}" VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                               [(PAGE, event_date, 1, 1, 0, 0.0, 0.0, 0, hll.init([session_id]))
+                                for event_date, session_id in days])
+        connection.execute(f'INSERT INTO "{monthly_table}" VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                           (PAGE, "2024-02-01", len(days), len(days), 0, 0.0, 0.0, 0,
+                            hll.init([session_id for _, session_id in days])))
+    yield
+    with connection:
+        for table in (daily_table, monthly_table):
+            connection.execute(f'DELETE FROM "{table}" WHERE page_url = ?', (PAGE,))
+    connection.close()
+
+
+@pytest.fixture(autouse=True)
+def budget(monkeypatch):
+    monkeypatch.setattr(bigquery, "max_bytes_billed", {"get_metrics": BUDGET})
+    monkeypatch.setattr(bigquery, "over_budget", "fallback")
+
+
+def fetch_counters(with_engine, budget_client: BudgetClient, granularities: list[str], **kwargs) -> tuple[dict, dict]:
+    """
+    The page's counters over REQUEST read with `granularities`, and the engine's stats.
+    """
+    async def fetch(engine):
+        return await get_bigquery_counters(REQUEST, engine, granularities), engine.stats()
+
+    return with_engine(fetch, budget_client, **kwargs)
+
+
+def test_over_budget_queries_fall_back_to_the_rollups(with_engine):
+    budget_client = BudgetClient()
+    # Only weekly rollups: February 2024 is read from weeks and days
+    counters, stats = fetch_counters(with_engine, budget_client, ["week"])
+    assert budget_client.jobs == [("day", False), ("rollups", False)]
+    assert stats["over_budget"] == 1
+    # The same counters, from the single monthly row
+    assert counters['aggregate_rows'] == 1
+    assert (counters['add_to_cart_events'], counters['number_of_sessions']) == (29, 29)
+
+
+def test_queries_within_budget_do_not_fall_back(with_engine):
+    budget_client = BudgetClient()
+    counters, stats = fetch_counters(with_engine, budget_client, ["month", "week"])
+    assert budget_client.jobs == [("rollups", False)]
+    assert stats["over_budget"] == 0
+    assert counters['aggregate_rows'] == 1
+
+
+def test_over_budget_queries_are_rejected_with_400(with_engine, monkeypatch):
+    monkeypatch.setattr(bigquery, "over_budget", "reject")
+    budget_client = BudgetClient()
+    with pytest.raises(QueryBudgetExceeded) as e:
+        fetch_counters(with_engine, budget_client, ["week"])
+    assert e.value.status_code == 400
+    assert e.value.max_bytes_billed == BUDGET
+    assert budget_client.jobs == [("day", False)]
+
+
+def test_nothing_cheaper_to_fall_back_to(with_engine, monkeypatch):
+    monkeypatch.setattr(bigquery, "max_bytes_billed", {"get_metrics": ROLLUP_BYTES // 2})
+    budget_client = BudgetClient()
+    with pytest.raises(QueryBudgetExceeded):
+        with_engine(lambda engine: get_bigquery_counters(REQUEST, engine, ["month", "week"]), budget_client)
+    assert budget_client.jobs == [("rollups", False)]
+
+
+def test_dry_run_estimates_stop_queries_before_they_run(with_engine, monkeypatch):
+    budget_client = BudgetClient()
+    counters, stats = fetch_counters(with_engine, budget_client, ["week"], dry_run=True)
+    # The daily query never runs; the rollup query is estimated, then run
+    assert budget_client.jobs == [("day", True), ("rollups", True), ("rollups", False)]
+    assert (stats["over_budget"], stats["queries"]["metrics"]["dry_runs"]) == (1, 2)
+    assert counters['aggregate_rows'] == 1
+
+    monkeypatch.setattr(bigquery, "over_budget", "reject")
+    budget_client = BudgetClient()
+    with pytest.raises(QueryBudgetExceeded) as e:
+        fetch_counters(with_engine, budget_client, [], dry_run=True)
+    assert e.value.status_code == 400
+    assert e.value.estimated_bytes == DAILY_BYTES
+    assert budget_client.jobs == [("day", True)]
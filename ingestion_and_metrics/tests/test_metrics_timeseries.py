@@ -0,0 +1,81 @@
+import pytest
+import bigquery
+from common import hll
+from common.local_backend import connect
+from bigquery import iter_bigquery_timeseries
+from classes import MetricsTimeseriesRequest
+from config import local_database, page_daily_metrics_table_id, page_weekly_metrics_table_id
+
+PAGE = "https://shop.example.com/timeseries"
+# Monday 4 March 2024 to Thursday 14 March: a whole ISO week, then four days of the next one
+DAYS = [f"2024-03-{day:02d}" for day in range(4, 15)]
+
+
+@pytest.fixture(scope="module", autouse=True)
+def page_metrics():
+    daily_table = page_daily_metrics_table_id.split('.')[-1]
+    weekly_table = page_weekly_metrics_table_id.split('.')[-1]
+    # Three sessions and one add to cart a day
+    sessions = {event_date: [f"{event_date}-{n}" for n in range(3)] for event_date in DAYS}
+    connection = connect(local_database)
+    with connection:
+        for table in (daily_table, weekly_table):
+            connection.execute(f'DELETE FROM "{table}" WHERE page_url = ?', (PAGE,))
+        connection.executemany(f'INSERT INTO "{daily_table}" VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                               [(PAGE, event_date, 3, 1, 0, 0.0, 0.0, 0, hll.init(sessions[event_date]))
+                                for event_date in DAYS])
+        week = [session_id for event_date in DAYS[:7] for session_id in sessions[event_date]]
+        connection.execute(f'INSERT INTO "{weekly_table}" VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                           (PAGE, DAYS[0], len(week), 7, 0, 0.0, 0.0, 0, hll.init(week)))
+    yield
+    with connection:
+        for table in (daily_table, weekly_table):
+            connection.execute(f'DELETE FROM "{table}" WHERE page_url = ?', (PAGE,))
+    connection.close()
+
+
+def fetch(with_engine, chunk_periods: int | None = None, start_date: str = DAYS[0], end_date: str = DAYS[-1],
+          granularity: str = "day") -> list:
+    async def fetch_chunks(engine):
+        request = MetricsTimeseriesRequest(page_url=PAGE, start_date=start_date, end_date=end_date, granularity=granularity)
+        return [chunk async for chunk in iter_bigquery_timeseries(request, engine, chunk_periods)]
+
+    return with_engine(fetch_chunks)
+
+
+def test_daily_series_in_a_single_chunk(with_engine):
+    chunks = fetch(with_engine)
+    assert len(chunks) == 1
+    assert chunks[0].period_start == DAYS
+    assert chunks[0].total_sessions == [3] * len(DAYS)
+
+
+def test_weekly_series_reads_the_weekly_rollup(with_engine):
+    [chunk] = fetch(with_engine, granularity="week")
+    assert chunk.period_start == ["2024-03-04", "2024-03-11"]
+    assert chunk.total_sessions == [21, 12]
+
+
+@pytest.mark.parametrize("chunk_periods, sizes", [(4, [4, 4, 3]), (11, [11]), (20, [11]), (1, [1] * 11)])
+def test_series_are_chunked_by_chunk_periods(chunk_periods, sizes, with_engine):
+    chunks = fetch(with_engine, chunk_periods)
+    assert [len(chunk.period_start) for chunk in chunks] == sizes
+    # Columns of a chunk stay parallel
+    assert all(len(chunk.cart_percentage) == len(chunk.period_start) for chunk in chunks)
+    assert [period for chunk in chunks for period in chunk.period_start] == DAYS
+
+
+def test_a_range_without_data_yields_one_empty_chunk(with_engine):
+    chunks = fetch(with_engine, 4, start_date="2023-01-01", end_date="2023-01-10")
+    assert len(chunks) == 1
+    assert chunks[0].period_start == [] and chunks[0].cart_percentage == []
+
+
+def test_ratios_are_rounded_to_timeseries_decimals(with_engine, monkeypatch):
+    [chunk] = fetch(with_engine, end_date=DAYS[1])
+    assert chunk.cart_percentage == [33.3333, 33.3333]
+
+    monkeypatch.setattr(bigquery, "timeseries_decimals", 1)
+    [chunk] = fetch(with_engine, end_date=DAYS[1])
+    assert chunk.cart_percentage == [33.3, 33.3]
+    assert chunk.total_sessions == [3, 3]
@@ -0,0 +1,116 @@
+import gzip
+import json
+import pytest
+from pydantic import ValidationError
+from parsing import BatchDecodeError, decode_body, event_to_row, is_json_error, parse_event, parse_event_batch
+
+
+def make_event(index: int) -> dict:
+    return {
+        "event_time": "2024-03-01T12:00:00Z",
+        "event_name": "page_viewed",
+        "event_id": f"evt-{index}",
+        "session_id": "sess-1",
+        "page_url": "https://www.example.com/",
+    }
+
+
+def test_parse_event_builds_insert_row():
+    event = parse_event(json.dumps({**make_event(0), "order_value": 12.5, "country": None}).encode())
+    assert event_to_row(event) == {
+        "event_time": "2024-03-01T12:00:00Z",
+        "event_name": "page_viewed",
+        "event_id": "evt-0",
+        "session_id": "sess-1",
+        "page_url": "https://www.example.com/",
+        "order_value": 12.5,
+    }
+
+
+def test_parse_event_tells_invalid_json_from_invalid_fields():
+    with pytest.raises(ValidationError) as e:
+        parse_event(b'{"event_id": ')
+    assert is_json_error(e.value)
+
+    with pytest.raises(ValidationError) as e:
+        parse_event(json.dumps({**make_event(0), "order_value": "a lot"}).encode())
+    assert not is_json_error(e.value)
+
+
+def test_decode_body_returns_plain_body():
+    assert decode_body(b'[]', max_bytes=10) == b'[]'
+
+
+def test_decode_body_gunzips_by_content_encoding_and_magic():
+    body = json.dumps([make_event(0)]).encode()
+    assert decode_body(gzip.compress(body), content_encoding="gzip") == body
+    assert decode_body(gzip.compress(body)) == body
+
+
+def test_decode_body_accepts_gzip_body_at_the_limit():
+    body = b'x' * 100
+    assert decode_body(gzip.compress(body), max_bytes=100) == body
+
+
+def test_decode_body_rejects_decompressed_body_over_the_limit():
+    # A small compressed body that inflates past the limit (a gzip bomb) is refused
+    body = gzip.compress(b' ' * 10_000)
+    assert len(body) < 100
+    with pytest.raises(BatchDecodeError, match="Decompressed body exceeds 1000 bytes"):
+        decode_body(body, max_bytes=1000)
+
+
+def test_decode_body_rejects_uncompressed_body_over_the_limit():
+    with pytest.raises(BatchDecodeError, match="Body exceeds 10 bytes"):
+        decode_body(b'x' * 11, max_bytes=10)
+
+
+def test_decode_body_rejects_invalid_gzip():
+    with pytest.raises(BatchDecodeError, match="Invalid gzip body"):
+        decode_body(b'not gzip', content_encoding="gzip")
+    with pytest.raises(BatchDecodeError, match="Invalid gzip body"):
+        decode_body(gzip.compress(b'[]')[:-4])
+
+
+def test_parse_event_batch_json_array():
+    events, errors = parse_event_batch(json.dumps([make_event(0), make_event(1)]).encode())
+    assert [event.event_id for event in events] == ["evt-0", "evt-1"]
+    assert errors == []
+
+
+def test_parse_event_batch_ndjson():
+    body = b'\n'.join(json.dumps(make_event(i)).encode() for i in range(3)) + b'\n\n'
+    events, errors = parse_event_batch(body)
+    assert [event.event_id for event in events] == ["evt-0", "evt-1", "evt-2"]
+    assert errors == []
+
+
+def test_parse_event_batch_reports_invalid_items_by_index():
+    items = [make_event(0), {**make_event(1), "event_time": "yesterday"}, make_event(2)]
+    events, errors = parse_event_batch(json.dumps(items).encode())
+    assert [event.event_id for event in events] == ["evt-0", "evt-2"]
+    assert [error["index"] for error in errors] == [1]
+    assert errors[0]["errors"][0].startswith("event_time:")
+
+    body = json.dumps(make_event(0)).encode() + b'\n{"event_id": \n' + json.dumps(make_event(2)).encode()
+    events, errors = parse_event_batch(body)
+    assert [event.event_id for event in events] == ["evt-0", "evt-2"]
+    assert [error["index"] for error in errors] == [1]
+
+
+def test_parse_event_batch_empty_body():
+    assert parse_event_batch(b'  \n') == ([], [])
+
+
+def test_parse_event_batch_rejects_invalid_array():
+    with pytest.raises(BatchDecodeError, match="Invalid JSON array"):
+        parse_event_batch(b'[{"event_id": "evt-0"}')
+
+
+def test_parse_event_batch_enforces_max_events():
+    items = [make_event(i) for i in range(3)]
+    assert len(parse_event_batch(json.dumps(items).encode(), max_events=3)[0]) == 3
+    with pytest.raises(BatchDecodeError, match="limit is 2"):
+        parse_event_batch(json.dumps(items).encode(), max_events=2)
+    with pytest.raises(BatchDecodeError, match="limit is 2"):
+        parse_event_batch(b'\n'.join(json.dumps(item).encode() for item in items), max_events=2)
@@ -0,0 +1,195 @@
+import asyncio
+from datetime import date, datetime, timedelta, timezone
+import pytest
+import realtime
+from common import hll
+from common.local_backend import connect, to_timestamp
+from bigquery import get_aggregation_watermark, get_bigquery_counters
+from classes import EventPayload, MetricsRequest
+from config import local_database, metadata_table_id, page_daily_metrics_table_id
+from realtime import RealtimeCounters
+
+PAGE = "https://shop.example.com/realtime"
+DAY = date(2024, 4, 10)
+WATERMARK = datetime(2024, 4, 10, 12, 0, tzinfo=timezone.utc)
+
+
+def event(seconds: float, event_name: str = "page_viewed", session_id: str = "s1", page_url: str = PAGE,
+          **fields) -> EventPayload:
+    """
+    An event `seconds` after the watermark.
+    """
+    return EventPayload(event_time=WATERMARK + timedelta(seconds=seconds), event_name=event_name,
+                        session_id=session_id, page_url=page_url, **fields)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(realtime.time, "monotonic", clock)
+    return clock
+
+
+def counters(**values) -> dict:
+    return {"aggregate_rows": 0, "add_to_cart_events": None, "checkout_completed_events": None,
+            "number_of_sessions": None, "total_revenue": None, "total_scroll_sum": None,
+            "total_scroll_events": None, "watermark": WATERMARK, **values}
+
+
+def test_buckets_are_evicted_once_the_watermark_passed_them_for_the_retention(clock):
+    watermarks = [WATERMARK]
+    counters_ = RealtimeCounters(lambda: watermarks[-1], retention_s=120)
+    counters_.add(event(-30))
+    counters_.add(event(30))
+    asyncio.run(counters_.refresh_watermark())
+    assert counters_.stats()["buckets"] == 2
+
+    # Not evicted until the watermark has been observed for the retention
+    watermarks.append(WATERMARK + timedelta(minutes=1))
+    clock.now += 119
+    asyncio.run(counters_.refresh_watermark())
+    assert counters_.stats()["buckets"] == 2
+
+    clock.now += 1
+    asyncio.run(counters_.refresh_watermark())
+    assert counters_.evicted_buckets == 1
+    assert counters_.stats()["retained_events"] == 1
+
+    # Then once the later watermark has been there for the retention too
+    clock.now += 120
+    asyncio.run(counters_.refresh_watermark())
+    assert counters_.evicted_buckets == 2
+    assert counters_.stats()["buckets"] == 0
+
+    # Events behind an evicted watermark are left to the late events script
+    counters_.add(event(10))
+    assert counters_.behind_watermark == 1
+    assert counters_.stats()["buckets"] == 0
+
+
+def test_merging_behind_an_evicted_watermark_is_counted_as_stale(clock):
+    counters_ = RealtimeCounters(lambda: WATERMARK + timedelta(minutes=1), retention_s=0)
+    counters_.add(event(30))
+    asyncio.run(counters_.refresh_watermark())
+    assert counters_.evicted_buckets == 1
+    # Warehouse counters cached before the watermark moved miss the evicted events
+    assert counters_.merge(counters(), PAGE, DAY, DAY) is None
+    assert counters_.stale_merges == 1
+
+
+def test_failed_watermark_loads_keep_every_bucket(clock):
+    def failing_load():
+        raise RuntimeError("metadata table unavailable")
+
+    counters_ = RealtimeCounters(failing_load, retention_s=0)
+    counters_.add(event(-30))
+    asyncio.run(counters_.refresh_watermark())
+    assert counters_.watermark is None
+    assert counters_.stats()["buckets"] == 1
+
+
+def test_max_events_drops_the_oldest_buckets():
+    counters_ = RealtimeCounters(lambda: None, max_events=2)
+    counters_.add(event(1))
+    counters_.add(event(2))
+    counters_.add(event(2, session_id="s2"))
+    assert counters_.dropped_buckets == 1
+    assert counters_.stats()["retained_events"] == 2
+
+    # Events in the oldest bucket are dropped rather than evicting newer ones, and those of a dropped
+    # bucket are not counted into it again
+    counters_.add(event(2, session_id="s3"))
+    counters_.add(event(1))
+    assert (counters_.dropped_events, counters_.behind_watermark) == (1, 1)
+    assert counters_.stats()["buckets"] == 1
+
+    counters_.add(event(5))
+    assert counters_.dropped_buckets == 2
+    assert counters_.tail(PAGE, DAY, DAY, None)["total_scroll_events"] == 1
+
+
+def test_merge_only_adds_events_after_the_watermark():
+    counters_ = RealtimeCounters(lambda: None, bucket_s=60)
+    # Same one-minute bucket, on both sides of the watermark at 12:00:30
+    watermark = WATERMARK + timedelta(seconds=30)
+    counters_.add(event(10, "checkout_completed", order_value=50.0))
+    counters_.add(event(40, "checkout_completed", session_id="s2", order_value=20.0))
+    counters_.add(event(50, "page_scroll", session_id="s2", percent_scroll=80.0))
+    counters_.add(event(70, "product_added_to_cart", session_id="s3"))
+    # Another page and another day
+    counters_.add(event(40, page_url="https://shop.example.com/other"))
+    counters_.add(event(86400))
+
+    warehouse = counters(aggregate_rows=1, add_to_cart_events=0, checkout_completed_events=1, number_of_sessions=1,
+                         total_revenue=50.0, total_scroll_sum=0.0, total_scroll_events=0, watermark=watermark)
+    assert counters_.merge(warehouse, PAGE, DAY, DAY) == {
+        "add_to_cart_events": 1,
+        "checkout_completed_events": 2,
+        "number_of_sessions": 3,
+        "total_revenue": 70.0,
+        "total_scroll_sum": 80.0,
+        "total_scroll_events": 1,
+    }
+
+
+def test_merge_without_warehouse_rows_or_recent_events():
+    counters_ = RealtimeCounters(lambda: None)
+    assert counters_.merge(counters(), PAGE, DAY, DAY) is None
+    counters_.add(event(-10))
+    assert counters_.merge(counters(), PAGE, DAY, DAY) is None
+
+    counters_.add(event(10, "checkout_completed", order_value=5.0))
+    assert counters_.merge(counters(), PAGE, DAY, DAY)["total_revenue"] == 5.0
+
+    warehouse = counters(aggregate_rows=1, add_to_cart_events=2, checkout_completed_events=0, number_of_sessions=1,
+                         total_revenue=0.0, total_scroll_sum=0.0, total_scroll_events=0,
+                         watermark=WATERMARK + timedelta(minutes=1))
+    assert counters_.merge(warehouse, PAGE, DAY, DAY) == {name: value for name, value in warehouse.items()
+                                                          if name not in ("aggregate_rows", "watermark")}
+
+
+@pytest.fixture
+def warehouse():
+    """
+    One day of the page in page_daily_metrics, aggregated up to WATERMARK.
+    """
+    daily_table = page_daily_metrics_table_id.split('.')[-1]
+    metadata_table = metadata_table_id.split('.')[-1]
+    connection = connect(local_database)
+    with connection:
+        connection.execute(f'DELETE FROM "{daily_table}" WHERE page_url = ?', (PAGE,))
+        connection.execute(f'INSERT INTO "{daily_table}" VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                           (PAGE, DAY.isoformat(), 1, 0, 1, 50.0, 0.0, 0, hll.init(["s1"])))
+        connection.execute(f'INSERT OR REPLACE INTO "{metadata_table}" VALUES (?, ?)',
+                           ('page_daily_metrics_query', to_timestamp(WATERMARK)))
+    yield
+    with connection:
+        connection.execute(f'DELETE FROM "{daily_table}" WHERE page_url = ?', (PAGE,))
+        connection.execute(f'DELETE FROM "{metadata_table}" WHERE query_name = ?', ('page_daily_metrics_query',))
+    connection.close()
+
+
+def test_merge_into_the_warehouse_counters(warehouse, with_engine):
+    assert get_aggregation_watermark() == WATERMARK
+    counters_ = RealtimeCounters(get_aggregation_watermark)
+    # Already in the daily row
+    counters_.add(event(-20, "checkout_completed", order_value=50.0))
+    counters_.add(event(20, "checkout_completed", session_id="s2", order_value=30.0))
+
+    async def fetch(engine):
+        await counters_.refresh_watermark()
+        warehouse_counters = await get_bigquery_counters(
+            MetricsRequest(page_url=PAGE, start_date=DAY.isoformat(), end_date=DAY.isoformat()), engine)
+        return counters_.merge(warehouse_counters, PAGE, DAY, DAY)
+
+    merged = with_engine(fetch)
+    assert counters_.watermark == WATERMARK
+    assert (merged["checkout_completed_events"], merged["number_of_sessions"], merged["total_revenue"]) == (2, 2, 80.0)
@@ -0,0 +1,110 @@
+import asyncio
+import json
+import os
+from spool import CHECKPOINT_FILE, REJECTED_FILE, Spool, SpoolShipper
+
+
+def rows(start: int, count: int) -> list[dict]:
+    return [{"event_id": f"evt-{i}"} for i in range(start, start + count)]
+
+
+def test_read_and_commit_resume_from_the_checkpoint(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append(rows(0, 5))
+
+    batch, position = spool.read_batch(3)
+    assert batch == rows(0, 3)
+    spool.commit(position)
+    spool.close()
+
+    spool = Spool(str(tmp_path))
+    batch, position = spool.read_batch(10)
+    assert batch == rows(3, 2)
+    spool.commit(position)
+    assert spool.read_batch(10)[0] == []
+    assert spool.depth_bytes() == 0
+
+
+def test_segments_roll_over_and_are_deleted_once_read(tmp_path):
+    spool = Spool(str(tmp_path), segment_bytes=64)
+    for start in range(0, 20, 2):
+        spool.append(rows(start, 2))
+    assert len(spool.segments()) > 1
+
+    batch, position = spool.read_batch(100)
+    assert batch == rows(0, 20)
+    spool.commit(position)
+    assert spool.segments() == [position[0]]
+
+
+def test_recovery_after_a_truncated_write(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append(rows(0, 3))
+    spool.close()
+
+    # A crash in the middle of a write leaves a partial row at the end of the active segment
+    segment = os.path.join(str(tmp_path), sorted(name for name in os.listdir(tmp_path) if name.startswith("segment-"))[-1])
+    with open(segment, 'ab') as f:
+        f.write(b'{"event_id": "evt-3", "page_u')
+
+    spool = Spool(str(tmp_path))
+    with open(segment, 'rb') as f:
+        assert f.read().endswith(b'\n')
+    spool.append(rows(4, 2))
+
+    batch, _ = spool.read_batch(100)
+    assert batch == rows(0, 3) + rows(4, 2)
+
+
+def test_read_batch_skips_an_unterminated_last_row(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append(rows(0, 2))
+    segment = os.path.join(str(tmp_path), f"segment-{0:012d}.ndjson")
+    with open(segment, 'ab') as f:
+        f.write(b'{"event_id": "evt-2"')
+
+    # A row still being written is not read until its newline lands
+    batch, position = spool.read_batch(100)
+    assert batch == rows(0, 2)
+    with open(segment, 'ab') as f:
+        f.write(b'}\n')
+    assert spool.read_batch(100, position)[0] == rows(2, 1)
+
+
+def test_commit_survives_a_restart(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append(rows(0, 4))
+    spool.commit(spool.read_batch(2)[1])
+    spool.close()
+
+    with open(os.path.join(str(tmp_path), CHECKPOINT_FILE), 'r') as f:
+        checkpoint = json.load(f)
+    assert Spool(str(tmp_path)).checkpoint == (checkpoint['segment'], checkpoint['offset'])
+
+
+def test_shipper_retries_and_rejects_rows(tmp_path, monkeypatch):
+    spool = Spool(str(tmp_path))
+    spool.append(rows(0, 3))
+    calls = []
+
+    def sink(batch: list[dict]) -> list[dict]:
+        calls.append(batch)
+        if len(calls) == 1:
+            return [
+                {"index": 0, "errors": [{"reason": "backendError"}]},
+                {"index": 2, "errors": [{"reason": "invalid"}]},
+            ]
+        return []
+
+    # Skip the backoff between attempts
+    sleep = asyncio.sleep
+    monkeypatch.setattr(asyncio, 'sleep', lambda delay: sleep(0))
+
+    shipper = SpoolShipper(spool, sink)
+    assert asyncio.run(shipper.ship_once()) == 3
+    assert calls == [rows(0, 3), rows(0, 1)]
+    assert shipper.rows_shipped == 2
+    assert shipper.rows_rejected == 1
+    with open(os.path.join(str(tmp_path), REJECTED_FILE), 'r') as f:
+        assert [json.loads(line) for line in f] == [{"event_id": "evt-2"}]
+    assert spool.read_batch(10)[0] == []
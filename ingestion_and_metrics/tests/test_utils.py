@@ -0,0 +1,94 @@
+import random
+import pytest
+from datetime import date, timedelta
+from utils import PAGE_URL_FILTER, _next_month, decompose_range, metrics_source, page_url_job_config
+
+
+def covered_days(segments: list[tuple[str, date, date]]) -> list[date]:
+    days = []
+    for granularity, first, last in segments:
+        period = first
+        while period <= last:
+            if granularity == "month":
+                end = _next_month(period)
+                days.extend(period + timedelta(days=i) for i in range((end - period).days))
+                period = end
+            else:
+                length = 7 if granularity == "week" else 1
+                days.extend(period + timedelta(days=i) for i in range(length))
+                period += timedelta(days=length)
+    return days
+
+
+@pytest.mark.parametrize("start, end, segments", [
+    # A whole calendar month
+    (date(2024, 3, 1), date(2024, 3, 31), [("month", date(2024, 3, 1), date(2024, 3, 1))]),
+    # Months across a year end
+    (date(2023, 12, 1), date(2024, 1, 31), [("month", date(2023, 12, 1), date(2024, 1, 1))]),
+    # Mid-month start: days up to the first Monday, a whole week, days up to the month, then months
+    (date(2024, 2, 14), date(2024, 4, 30), [
+        ("day", date(2024, 2, 14), date(2024, 2, 18)),
+        ("week", date(2024, 2, 19), date(2024, 2, 19)),
+        ("day", date(2024, 2, 26), date(2024, 2, 29)),
+        ("month", date(2024, 3, 1), date(2024, 4, 1)),
+    ]),
+    # Mid-month end: whole weeks after the last whole month, then days
+    (date(2024, 3, 1), date(2024, 4, 17), [
+        ("month", date(2024, 3, 1), date(2024, 3, 1)),
+        ("week", date(2024, 4, 1), date(2024, 4, 8)),
+        ("day", date(2024, 4, 15), date(2024, 4, 17)),
+    ]),
+    # Whole ISO weeks, Monday to Sunday
+    (date(2024, 3, 4), date(2024, 3, 17), [("week", date(2024, 3, 4), date(2024, 3, 11))]),
+    # An ISO week that straddles two months
+    (date(2024, 4, 29), date(2024, 5, 5), [("week", date(2024, 4, 29), date(2024, 4, 29))]),
+    # Mid-week to mid-week without a whole week
+    (date(2024, 3, 6), date(2024, 3, 10), [("day", date(2024, 3, 6), date(2024, 3, 10))]),
+    # Ending on a Saturday leaves the last week to daily rows
+    (date(2024, 3, 4), date(2024, 3, 16), [
+        ("week", date(2024, 3, 4), date(2024, 3, 4)),
+        ("day", date(2024, 3, 11), date(2024, 3, 16)),
+    ]),
+    (date(2024, 3, 5), date(2024, 3, 5), [("day", date(2024, 3, 5), date(2024, 3, 5))]),
+])
+def test_decompose_range(start, end, segments):
+    assert decompose_range(start, end, ["month", "week"]) == segments
+
+
+def test_decompose_range_with_fewer_granularities():
+    assert decompose_range(date(2024, 3, 1), date(2024, 3, 31), ["week"]) == [
+        ("day", date(2024, 3, 1), date(2024, 3, 3)),
+        ("week", date(2024, 3, 4), date(2024, 3, 25)),
+    ]
+    assert decompose_range(date(2024, 2, 14), date(2024, 4, 3), ["month"]) == [
+        ("day", date(2024, 2, 14), date(2024, 2, 29)),
+        ("month", date(2024, 3, 1), date(2024, 3, 1)),
+        ("day", date(2024, 4, 1), date(2024, 4, 3)),
+    ]
+    assert decompose_range(date(2024, 1, 1), date(2024, 12, 31), []) == [("day", date(2024, 1, 1), date(2024, 12, 31))]
+
+
+@pytest.mark.parametrize("granularities", [["month", "week"], ["month"], ["week"], []])
+def test_decompose_range_covers_every_day_once(granularities):
+    rng = random.Random(0)
+    for _ in range(500):
+        start = date(2023, 1, 1) + timedelta(days=rng.randrange(730))
+        end = start + timedelta(days=rng.randrange(400))
+        days = covered_days(decompose_range(start, end, granularities))
+        assert days == [start + timedelta(days=i) for i in range((end - start).days + 1)]
+
+
+def test_decompose_range_reads_few_rows():
+    segments = decompose_range(date(2023, 1, 18), date(2024, 1, 12), ["month", "week"])
+    days = len(covered_days([segment for segment in segments if segment[0] == "day"]))
+    weeks = sum((last - first).days // 7 + 1 for granularity, first, last in segments if granularity == "week")
+    assert days + weeks <= 30
+
+
+def test_metrics_source_sends_the_page_url_as_a_parameter():
+    page_url = "https://www.example.com/' OR '1'='1"
+    query = metrics_source(PAGE_URL_FILTER, "2024-02-14", "2024-04-30")
+    assert page_url not in query
+    assert query.count("@page_url") == len(decompose_range(date(2024, 2, 14), date(2024, 4, 30)))
+    [parameter] = page_url_job_config(page_url).query_parameters
+    assert (parameter.name, parameter.value) == ("page_url", page_url)
@@ -0,0 +1,99 @@
+import contextvars
+import logging
+import random
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Iterator
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class Trace:
+    def __init__(self, name: str, attributes: dict):
+        self.name = name
+        self.attributes = attributes
+        self.started_at = datetime.now(timezone.utc)
+        self.started = time.perf_counter()
+        self.duration = 0.0
+        self.spans: list[tuple[str, float, float]] = []
+
+    def add_span(self, name: str, started: float, ended: float) -> None:
+        self.spans.append((name, started - self.started, ended - started))
+
+    def as_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "attributes": self.attributes,
+            "started_at": self.started_at.isoformat(),
+            "duration_ms": self.duration * 1000,
+            "spans": [{"name": name, "offset_ms": offset * 1000, "duration_ms": duration * 1000}
+                      for name, offset, duration in sorted(self.spans, key=lambda span: span[1])],
+        }
+
+
+_current_trace: contextvars.ContextVar[Trace | None] = contextvars.ContextVar("trace", default=None)
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """
+    Time a block as a span of the current trace; does nothing outside a sampled request.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add_span(name, started, time.perf_counter())
+
+
+def add_span(name: str, started: float, ended: float) -> None:
+    """
+    Record an already timed block (`time.perf_counter` values) as a span of the current trace.
+    """
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_span(name, started, ended)
+
+
+class Tracer:
+    """
+    Traces a `sample_rate` fraction of requests. Spans are recorded by `span` and `add_span` in
+    the request's context, including tasks it starts. Sampled requests slower than
+    `slow_threshold` seconds are logged with their breakdown and the last `max_traces` are kept.
+    """
+
+    def __init__(self, sample_rate: float = 0.0, slow_threshold: float = 0.5, max_traces: int = 100):
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.traces: deque[dict] = deque(maxlen=max_traces)
+        self.sampled = 0
+        self.slow = 0
+
+    @contextmanager
+    def trace(self, name: str, **attributes: Any) -> Iterator[Trace | None]:
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            yield None
+            return
+        trace = Trace(name, attributes)
+        token = _current_trace.set(trace)
+        self.sampled += 1
+        try:
+            yield trace
+        finally:
+            _current_trace.reset(token)
+            trace.duration = time.perf_counter() - trace.started
+            if trace.duration >= self.slow_threshold:
+                self.slow += 1
+                self.traces.append(trace.as_dict())
+                breakdown = ", ".join(f"{span['name']} {span['duration_ms']:.1f} ms" for span in self.traces[-1]["spans"])
+                logger.warning(f"Slow {name} ({trace.duration * 1000:.1f} ms) {attributes}: {breakdown}")
+
+    def stats(self) -> dict:
+        return {"sample_rate": self.sample_rate, "sampled": self.sampled, "slow": self.slow}
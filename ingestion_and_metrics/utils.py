@@ -1,86 +1,182 @@
-import asyncio
-from concurrent.futures import ThreadPoolExecutor
 import logging
+from datetime import date, timedelta
+from fastapi import HTTPException
 from google.cloud import bigquery
-from config import checkout_completed_table_id, add_to_cart_table_id, sessions_table_id, revenue_table_id, scroll_table_id
+from engine import QueryEngine
+from config import page_daily_metrics_table_id, page_weekly_metrics_table_id, page_monthly_metrics_table_id, rollup_granularities
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-loop = asyncio.get_event_loop()
-executor = ThreadPoolExecutor(max_workers=4)
+# Distinct sessions over a range of daily rows. Merging the HLL sketches counts a session seen on
+# several days once; ranges containing rows written before sessions were sketched fall back to
+# summing the daily counts.
+SESSIONS_AGGREGATE = "IF(COUNTIF(sessions_sketch IS NULL) = 0, HLL_COUNT.MERGE(sessions_sketch), SUM(number_of_sessions))"
 
-def run_query(query: str, client:  bigquery.Client):
-    query_job = client.query(query)
-    return list(query_job.result())
+# Table and key column of each granularity; the aggregator keeps the rollups (rollups_query)
+METRICS_TABLES = {
+    "month": (page_monthly_metrics_table_id, "period_start"),
+    "week": (page_weekly_metrics_table_id, "period_start"),
+    "day": (page_daily_metrics_table_id, "event_date"),
+}
+# First day of the period containing `key`, for the time series granularities
+PERIOD_STARTS = {
+    "day": "{key}",
+    "week": "DATE_TRUNC({key}, ISOWEEK)",
+}
+# Filter of the single page queries; the URL itself is sent as the @page_url query parameter
+PAGE_URL_FILTER = "page_url = @page_url"
+METRICS_COLUMNS = "page_url, number_of_sessions, add_to_cart_events, checkout_completed, total_revenue, total_scroll_sum, total_scroll_events, sessions_sketch"
 
 
-async def get_checkout_completed_events(page_url: str, start_date: str, end_date: str, client: bigquery.Client) -> int:
+def _next_month(day: date) -> date:
+    return date(day.year + day.month // 12, day.month % 12 + 1, 1)
+
+
+def decompose_range(start: date, end: date, granularities: list[str] = rollup_granularities) -> list[tuple[str, date, date]]:
+    """
+    Cover the days from `start` to `end` with whole calendar months, then whole ISO weeks, then
+    single days, as (granularity, first period start, last period start) segments of consecutive
+    periods. Besides one row per month, a range of any width reads at most ~30 weekly and daily rows
+    per page.
+    """
+    segments = []
+
+    def add_weeks_and_days(first: date, last: date):
+        monday = first + timedelta(days=(7 - first.weekday()) % 7)
+        weeks = ((last - monday).days + 1) // 7 if "week" in granularities and monday <= last else 0
+        if not weeks:
+            if first <= last:
+                segments.append(("day", first, last))
+            return
+        if first < monday:
+            segments.append(("day", first, monday - timedelta(days=1)))
+        segments.append(("week", monday, monday + timedelta(weeks=weeks - 1)))
+        if monday + timedelta(weeks=weeks) <= last:
+            segments.append(("day", monday + timedelta(weeks=weeks), last))
+
+    first_month = start if start.day == 1 else _next_month(start)
+    last_month = None
+    month = first_month
+    while "month" in granularities and _next_month(month) - timedelta(days=1) <= end:
+        last_month = month
+        month = _next_month(month)
+    if last_month is None:
+        add_weeks_and_days(start, end)
+    else:
+        add_weeks_and_days(start, first_month - timedelta(days=1))
+        segments.append(("month", first_month, last_month))
+        add_weeks_and_days(_next_month(last_month), end)
+    return segments
+
+
+def page_url_job_config(page_url: str) -> bigquery.QueryJobConfig:
+    return bigquery.QueryJobConfig(query_parameters=[bigquery.ScalarQueryParameter("page_url", "STRING", page_url)])
+
+
+def metrics_source(page_filter: str, start_date: str, end_date: str, granularities: list[str] = rollup_granularities,
+                   period: str | None = None) -> str:
+    """
+    Subquery with the daily metric columns of the pages matching `page_filter` from `start_date` to
+    `end_date`, read from the monthly, weekly and daily tables per decompose_range. The counters sum
+    and the sketches merge across granularities like across days. With a `period` ("day" or "week")
+    rows also get the `period_start` they fall in, and only the rollup of that period is read.
+    `page_filter` is pasted into the SQL, so it must reference request values as query parameters
+    (e.g. PAGE_URL_FILTER), never inline them.
+    """
+    start, end = date.fromisoformat(start_date), date.fromisoformat(end_date)
+    period_start = ""
+    if period is not None:
+        # A rollup row is only in a single period when it is one
+        granularities = [granularity for granularity in granularities if granularity == period]
+    selects = []
+    # An empty range still needs a source, which matches no rows
+    for granularity, first, last in decompose_range(start, end, granularities) or [("day", start, end)]:
+        table_id, key = METRICS_TABLES[granularity]
+        if period is not None:
+            # Rollup rows of the period are keyed by its first day already
+            period_start = (key if granularity == period else PERIOD_STARTS[period].format(key=key)) + " AS period_start, "
+        selects.append(f"SELECT {period_start}{METRICS_COLUMNS} FROM `{table_id}` "
+                       f"WHERE {key} BETWEEN '{first.isoformat()}' AND '{last.isoformat()}' AND {page_filter}")
+    return "(\n        " + "\n        UNION ALL\n        ".join(selects) + "\n    )"
+
+
+async def get_checkout_completed_events(page_url: str, start_date: str, end_date: str, engine: QueryEngine, max_bytes_billed: int | None = None) -> int:
     try:
         query = f"""
         SELECT SUM(checkout_completed) AS checkout_completed_events
-        FROM `{checkout_completed_table_id}`
-        WHERE page_url = '{page_url}' AND event_date BETWEEN '{start_date}' AND '{end_date}'
+        FROM {metrics_source(PAGE_URL_FILTER, start_date, end_date)}
         """
-        result = await loop.run_in_executor(executor, run_query, query, client)
+        result = await engine.run(query, name="checkout_completed_events", job_config=page_url_job_config(page_url),
+                                  max_bytes_billed=max_bytes_billed)
         return result[0]['checkout_completed_events'] if result else 0
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.exception(f"Failed to run query for checkout events between {start_date} and {end_date} for {page_url}", e)
+        logger.exception(f"Failed to run query for checkout events between {start_date} and {end_date} for {page_url}")
         return 0
 
 
 # Async function to get number_of_sessions
-async def get_number_of_sessions(page_url: str, start_date: str, end_date: str, client: bigquery.Client) -> int:
+async def get_number_of_sessions(page_url: str, start_date: str, end_date: str, engine: QueryEngine, max_bytes_billed: int | None = None) -> int:
     try:
         query = f"""
-        SELECT SUM(number_of_sessions) AS number_of_sessions
-        FROM `{sessions_table_id}`
-        WHERE page_url = '{page_url}' AND event_date BETWEEN '{start_date}' AND '{end_date}'
+        SELECT {SESSIONS_AGGREGATE} AS number_of_sessions
+        FROM {metrics_source(PAGE_URL_FILTER, start_date, end_date)}
         """
-        result = await loop.run_in_executor(executor, run_query, query, client)
+        result = await engine.run(query, name="number_of_sessions", job_config=page_url_job_config(page_url),
+                                  max_bytes_billed=max_bytes_billed)
         return result[0]['number_of_sessions'] if result else 0
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.exception(f"Failed to run query for sessions between {start_date} and {end_date} for {page_url}", e)
+        logger.exception(f"Failed to run query for sessions between {start_date} and {end_date} for {page_url}")
         return 0
 
 # Async function to get total_revenue
-async def get_total_revenue(page_url: str, start_date: str, end_date: str, client: bigquery.Client) -> float:
+async def get_total_revenue(page_url: str, start_date: str, end_date: str, engine: QueryEngine, max_bytes_billed: int | None = None) -> float:
     try:
         query = f"""
         SELECT SUM(total_revenue) AS total_revenue
-        FROM `{revenue_table_id}`
-        WHERE page_url = '{page_url}' AND event_date BETWEEN '{start_date}' AND '{end_date}'
+        FROM {metrics_source(PAGE_URL_FILTER, start_date, end_date)}
         """
-        result = await loop.run_in_executor(executor, run_query, query, client)
+        result = await engine.run(query, name="total_revenue", job_config=page_url_job_config(page_url),
+                                  max_bytes_billed=max_bytes_billed)
         return result[0]['total_revenue'] if result else 0
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.exception(f"Failed to run query for revenue between {start_date} and {end_date} for {page_url}", e)
+        logger.exception(f"Failed to run query for revenue between {start_date} and {end_date} for {page_url}")
         return 0
 
 
 # Async function to get add_to_cart_events
-async def get_add_to_cart_events(page_url: str, start_date: str, end_date: str, client: bigquery.Client) -> int:
+async def get_add_to_cart_events(page_url: str, start_date: str, end_date: str, engine: QueryEngine, max_bytes_billed: int | None = None) -> int:
     try:
         query = f"""
         SELECT SUM(add_to_cart_events) AS add_to_cart_events
-        FROM `{add_to_cart_table_id}`
-        WHERE page_url = '{page_url}' AND event_date BETWEEN '{start_date}' AND '{end_date}'
+        FROM {metrics_source(PAGE_URL_FILTER, start_date, end_date)}
         """
-        result = await loop.run_in_executor(executor, run_query, query, client)
+        result = await engine.run(query, name="add_to_cart_events", job_config=page_url_job_config(page_url),
+                                  max_bytes_billed=max_bytes_billed)
         return result[0]['add_to_cart_events'] if result else 0
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.exception(f"Failed to run query for add to cart events between {start_date} and {end_date} for {page_url}", e)
+        logger.exception(f"Failed to run query for add to cart events between {start_date} and {end_date} for {page_url}")
         return 0
     
-async def get_scroll_events(page_url: str, start_date: str, end_date: str, client: bigquery.Client) -> tuple[float, int]:
+async def get_scroll_events(page_url: str, start_date: str, end_date: str, engine: QueryEngine, max_bytes_billed: int | None = None) -> tuple[float, int]:
     try:
         query = f"""
-        SELECT SUM(total_scroll_sum) AS total_scroll_sum, SUM(total_events) AS total_scroll_events
-        FROM `{scroll_table_id}`
-        WHERE page_url = '{page_url}' AND event_date BETWEEN '{start_date}' AND '{end_date}'
+        SELECT SUM(total_scroll_sum) AS total_scroll_sum, SUM(total_scroll_events) AS total_scroll_events
+        FROM {metrics_source(PAGE_URL_FILTER, start_date, end_date)}
         """
-        result = await loop.run_in_executor(executor, run_query, query, client)
-        return result[0]['total_scroll_sum'], result[0]['total_scroll_events'] if result else 0.0, 0
+        result = await engine.run(query, name="scroll_events", job_config=page_url_job_config(page_url),
+                                  max_bytes_billed=max_bytes_billed)
+        return (result[0]['total_scroll_sum'], result[0]['total_scroll_events']) if result else (0.0, 0)
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.exception(f"Failed to run query for add to cart events between {start_date} and {end_date} for {page_url}", e)
+        logger.exception(f"Failed to run query for add to cart events between {start_date} and {end_date} for {page_url}")
         return 0.0, 0
\ No newline at end of file
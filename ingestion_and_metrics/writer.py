@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import time
+from contextlib import suppress
+from typing import Callable
+from common.instrumentation import registry
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+FLUSH_SECONDS = registry.histogram("writer_flush_seconds", "Latency of writer batch flushes")
+FLUSH_ROWS = registry.counter("writer_rows_total", "Rows flushed by the writer by outcome", ("outcome",))
+
+
+class BatchWriter:
+    """
+    Buffers rows in a bounded in-memory queue and flushes them from a background task
+    once either `batch_size` rows are pending or `flush_interval` seconds have passed
+    since the first pending row arrived.
+
+    `flush_rows` is a blocking callable taking a list of rows and returning the
+    per-row errors in the `insert_rows_json` format; it is run in a worker thread.
+    """
+
+    def __init__(self, flush_rows: Callable[[list[dict]], list[dict]], batch_size: int = 500,
+                 flush_interval: float = 0.2, queue_size: int = 10000):
+        self.flush_rows = flush_rows
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._batch: list[dict] = []
+        self._task: asyncio.Task | None = None
+        self._inflight: asyncio.Future | None = None
+
+        self.flushes = 0
+        self.rows_written = 0
+        self.rows_failed = 0
+        self.flush_failures = 0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self.total_flush_latency = 0.0
+
+    async def submit(self, row: dict) -> None:
+        await self.queue.put(row)
+
+    def qsize(self) -> int:
+        return self.queue.qsize() + len(self._batch)
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Stop the background task and flush everything that is still buffered.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        if self._inflight is not None:
+            with suppress(Exception):
+                await self._inflight
+
+        while not self.queue.empty():
+            self._batch.append(self.queue.get_nowait())
+        while self._batch:
+            batch, self._batch = self._batch[:self.batch_size], self._batch[self.batch_size:]
+            await self._flush(batch)
+
+    async def _run(self) -> None:
+        while True:
+            await self._collect()
+            batch, self._batch = self._batch, []
+            self._inflight = asyncio.ensure_future(self._flush(batch))
+            # Shield the flush so shutdown waits for it instead of abandoning the batch
+            await asyncio.shield(self._inflight)
+            self._inflight = None
+
+    async def _collect(self) -> None:
+        loop = asyncio.get_running_loop()
+        self._batch.append(await self.queue.get())
+        deadline = loop.time() + self.flush_interval
+
+        while len(self._batch) < self.batch_size:
+            try:
+                self._batch.append(self.queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return
+            try:
+                self._batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                return
+
+    async def _flush(self, batch: list[dict]) -> None:
+        started = time.perf_counter()
+        try:
+            errors = await asyncio.to_thread(self.flush_rows, batch)
+        except Exception as e:
+            self.flush_failures += 1
+            self.rows_failed += len(batch)
+            FLUSH_ROWS.labels("failed").inc(len(batch))
+            logger.exception(f"Failed to flush batch of {len(batch)} rows: {e}")
+            return
+        finally:
+            latency = time.perf_counter() - started
+            self.flushes += 1
+            self.last_batch_size = len(batch)
+            self.max_batch_size = max(self.max_batch_size, len(batch))
+            self.last_flush_latency = latency
+            self.max_flush_latency = max(self.max_flush_latency, latency)
+            self.total_flush_latency += latency
+            FLUSH_SECONDS.observe(latency)
+
+        failed_rows = len(errors or [])
+        self.rows_failed += failed_rows
+        self.rows_written += len(batch) - failed_rows
+        FLUSH_ROWS.labels("written").inc(len(batch) - failed_rows)
+        FLUSH_ROWS.labels("failed").inc(failed_rows)
+        for error in errors or []:
+            row = batch[error['index']] if 0 <= error.get('index', -1) < len(batch) else {}
+            logger.error(f"Row {row.get('event_id')} was not inserted: {error.get('errors')}")
+        logger.info(f"Flushed {len(batch)} rows in {latency * 1000:.1f} ms ({failed_rows} failed)")
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.qsize(),
+            "queue_capacity": self.queue.maxsize,
+            "flushes": self.flushes,
+            "flush_failures": self.flush_failures,
+            "rows_written": self.rows_written,
+            "rows_failed": self.rows_failed,
+            "last_batch_size": self.last_batch_size,
+            "max_batch_size": self.max_batch_size,
+            "avg_batch_size": (self.rows_written + self.rows_failed) / self.flushes if self.flushes else 0,
+            "last_flush_latency_ms": self.last_flush_latency * 1000,
+            "max_flush_latency_ms": self.max_flush_latency * 1000,
+            "avg_flush_latency_ms": self.total_flush_latency / self.flushes * 1000 if self.flushes else 0,
+        }
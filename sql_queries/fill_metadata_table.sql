@@ -4,4 +4,5 @@ VALUES
     ('checkout_completed_query', TIMESTAMP('1970-01-01 00:00:00 UTC')),
     ('sessions_query', TIMESTAMP('1970-01-01 00:00:00 UTC')),
     ('total_revenue_query', TIMESTAMP('1970-01-01 00:00:00 UTC')),
-    ('scroll_query', TIMESTAMP('1970-01-01 00:00:00 UTC'));
+    ('scroll_query', TIMESTAMP('1970-01-01 00:00:00 UTC')),
+    ('page_daily_metrics_query', TIMESTAMP('1970-01-01 00:00:00 UTC'));
@@ -0,0 +1,13 @@
+CREATE TABLE `your_project.your_dataset.page_daily_metrics` (
+    page_url STRING,
+    event_date DATE,
+    number_of_sessions INT64,
+    add_to_cart_events INT64,
+    checkout_completed INT64,
+    total_revenue FLOAT64,
+    total_scroll_sum FLOAT64,
+    total_scroll_events INT64,
+    sessions_sketch BYTES
+)
+PARTITION BY event_date
+CLUSTER BY page_url;
@@ -0,0 +1,27 @@
+CREATE TABLE `your_project.your_dataset.page_weekly_metrics` (
+    page_url STRING,
+    period_start DATE,
+    number_of_sessions INT64,
+    add_to_cart_events INT64,
+    checkout_completed INT64,
+    total_revenue FLOAT64,
+    total_scroll_sum FLOAT64,
+    total_scroll_events INT64,
+    sessions_sketch BYTES
+)
+PARTITION BY period_start
+CLUSTER BY page_url;
+
+CREATE TABLE `your_project.your_dataset.page_monthly_metrics` (
+    page_url STRING,
+    period_start DATE,
+    number_of_sessions INT64,
+    add_to_cart_events INT64,
+    checkout_completed INT64,
+    total_revenue FLOAT64,
+    total_scroll_sum FLOAT64,
+    total_scroll_events INT64,
+    sessions_sketch BYTES
+)
+PARTITION BY period_start
+CLUSTER BY page_url;